@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of stats by request and by request and referrer: vectorized engine against the former group by group
+path, that applies RequestAnalyzer._get_stats to each group.
+
+Usage, from the repository root: python -m benchmarks.grouped_stats [requests] [rows]
+"""
+
+from __future__ import print_function, division
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from performance_tools.urls_flow.analysis import RequestAnalyzer
+
+
+def synthetic_flow(requests, rows, referrers=3, seed=0):
+    """Make a URL flow with Zipf-distributed traffic and lognormal times.
+
+    :param requests: Number of distinct requests.
+    :type requests: int
+    :param rows: Number of rows.
+    :type rows: int
+    :param referrers: Number of distinct referrers.
+    :type referrers: int
+    :param seed: Random seed.
+    :type seed: int
+    :return: URL flow.
+    :rtype: pandas.DataFrame
+    """
+    random_state = np.random.RandomState(seed)
+    popularity = 1. / np.arange(1, requests + 1)
+    request_codes = random_state.choice(requests, rows, p=popularity / popularity.sum())
+    timestamps = pd.Timestamp('2015-06-01') + pd.to_timedelta(random_state.randint(0, 7 * 86400, rows), unit='s')
+    return pd.DataFrame({
+        'Timestamp': timestamps.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'Referrer': np.array(['/referrer/{:d}'.format(i) for i in range(referrers)])[
+            random_state.randint(0, referrers, rows)],
+        'Request': np.array(['/request/{:d}'.format(i) for i in range(requests)])[request_codes],
+        'Time': random_state.lognormal(-2, 1, rows),
+    }, columns=['Timestamp', 'Referrer', 'Request', 'Time'])
+
+
+def benchmark(requests=12000, rows=600000, repeat=3):
+    """Time both paths and check that their results are the same.
+
+    :param requests: Number of distinct requests.
+    :type requests: int
+    :param rows: Number of rows.
+    :type rows: int
+    :param repeat: Number of repetitions of the vectorized path, the best one is reported.
+    :type repeat: int
+    :return: Rows of (grouping, number of groups, group by group time, vectorized time).
+    :rtype: list
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        input_file = os.path.join(directory, 'flow.csv')
+        synthetic_flow(requests, rows).to_csv(input_file, index=False)
+        analyzer = RequestAnalyzer(input_file)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results = []
+    for (name, by, vectorized) in (('Request', 'Request', analyzer.stats_by_request),
+                                   ('Request and referrer', ['Request', 'Referrer'],
+                                    analyzer.stats_by_request_and_referrer)):
+        # Group by group path is timed only once, it takes too long
+        start = timeit.default_timer()
+        expected = analyzer.data.groupby(by, sort=True)[['Time']].apply(analyzer._get_stats)
+        apply_time = timeit.default_timer() - start
+
+        stats = vectorized()
+        if not np.allclose(stats.values.astype(float), expected.values.astype(float), rtol=1e-9, equal_nan=True):
+            raise AssertionError("Stats by {} differ from group by group stats".format(name))
+
+        results.append((name, len(stats), apply_time, min(timeit.repeat(vectorized, number=1, repeat=repeat))))
+
+    return results
+
+
+def main(requests=12000, rows=600000):
+    print("{:d} requests, {:d} rows".format(requests, rows))
+    for (name, groups, apply_time, vectorized_time) in benchmark(requests, rows):
+        print("{:<22}{:>8d} groups {:>10.3f}s -> {:.3f}s ({:.0f}x)".format(
+            name, groups, apply_time, vectorized_time, apply_time / vectorized_time))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
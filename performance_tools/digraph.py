@@ -1,13 +1,266 @@
 import csv
+import json
+import os
+from contextlib import contextmanager
+from heapq import heappop, heappush, nsmallest
+from itertools import islice
+from multiprocessing import Pool
 import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import gmres
 from pygraphviz import AGraph as DotGraph
 
+from performance_tools.exceptions import DigraphException
+from performance_tools.utils.columnar import encode_strings, load_columnar
+from performance_tools.utils.histogram import LatencyAggregates
+
+# Arc weights are transition counts, so they are stored using a wide integer type to avoid overflows.
+ARCS_DTYPE = np.int64
+
+VERTEX_STYLES = {
+    'initial': {'fillcolor': '#4CAF50', 'style': 'filled', 'fontcolor': '#FFFFFF'},
+    'end': {'fillcolor': '#2196F3', 'style': 'filled', 'fontcolor': '#FFFFFF'},
+    'inner': {'fillcolor': '#9E9E9E', 'style': 'filled'},
+}
+
+
+@contextmanager
+def _output_file(output):
+    """Open output if it's a filename, or use it directly if it's a file-like object.
+    """
+    if hasattr(output, 'write'):
+        yield output
+    else:
+        with open(output, 'w') as f:
+            yield f
+
+
+def _dot_id(value):
+    """Quote a value as a DOT language identifier.
+    """
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def render_dot(task):
+    """Lay out and draw a graph written in DOT language using Graphviz. It can be used by a pool of processes, as
+    only the DOT source is sent to them.
+
+    :param task: DOT source, output filename and Graphviz layout program.
+    :type task: tuple
+    :return: Output filename.
+    :rtype: str
+    """
+    source, filename, prog = task
+    dot = DotGraph(string=source)
+    dot.layout(prog=prog)
+    dot.draw(filename)
+    return filename
+
+
+def _csr_positions(indptr, rows):
+    """Get positions in CSR data arrays of all entries stored in given rows.
+
+    :param indptr: CSR index pointer array.
+    :type indptr: numpy.array
+    :param rows: Row indexes.
+    :type rows: numpy.array
+    :return: Positions of entries and the position in rows array that each entry belongs to.
+    :rtype: tuple
+    """
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    row_ids = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum(), dtype=np.int64) - offsets[row_ids] + starts[row_ids]
+    return positions, row_ids
+
+
+def _select_arcs(indptr, indices, data, num_vertices, indexes):
+    """Select arcs between given vertices from CSR arrays. Only rows of selected vertices are read.
+
+    :param indptr: CSR index pointer array.
+    :type indptr: numpy.array
+    :param indices: CSR column indexes array.
+    :type indices: numpy.array
+    :param data: CSR data array.
+    :type data: numpy.array
+    :param num_vertices: Total number of vertices.
+    :type num_vertices: int
+    :param indexes: Sorted indexes of selected vertices.
+    :type indexes: numpy.array
+    :return: Positions of selected arcs in data array and arcs matrix between selected vertices.
+    :rtype: tuple
+    """
+    selected = np.zeros(num_vertices, dtype=bool)
+    selected[indexes] = True
+    new_indexes = np.zeros(num_vertices, dtype=np.int64)
+    new_indexes[indexes] = np.arange(len(indexes))
+
+    positions, rows = _csr_positions(indptr, indexes)
+    columns = np.asarray(indices[positions])
+    kept = selected[columns]
+    positions, rows, columns = positions[kept], rows[kept], columns[kept]
+
+    selected_indptr = np.zeros(len(indexes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(indexes)), out=selected_indptr[1:])
+    arcs = sparse.csr_matrix((np.asarray(data[positions]), new_indexes[columns], selected_indptr),
+                             shape=(len(indexes), len(indexes)))
+
+    return positions, arcs
+
+
+def _arcs_keys(rows, columns, num_vertices):
+    """Encode arcs as integer keys, sorted as arcs are stored in a canonical CSR matrix.
+    """
+    return np.asarray(rows, dtype=np.int64) * num_vertices + np.asarray(columns, dtype=np.int64)
+
+
+def _merge_arcs(rows, columns, weights, num_vertices, latency=None):
+    """Sum up weights, and merge latency aggregates, of repeated arcs.
+
+    :param rows: Origin of each arc.
+    :type rows: numpy.array
+    :param columns: Destination of each arc.
+    :type columns: numpy.array
+    :param weights: Weight of each arc.
+    :type weights: numpy.array
+    :param num_vertices: Total number of vertices.
+    :type num_vertices: int
+    :param latency: Latency aggregates of each arc.
+    :type latency: LatencyAggregates
+    :return: Canonical CSR arcs matrix and latency aggregates aligned with its data.
+    :rtype: tuple
+    """
+    base = max(num_vertices, 1)
+    keys, inverse = np.unique(_arcs_keys(rows, columns, base), return_inverse=True)
+    inverse = inverse.ravel()
+    merged_weights = np.zeros(len(keys), dtype=weights.dtype)
+    np.add.at(merged_weights, inverse, weights)
+
+    indptr = np.zeros(num_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // base, minlength=num_vertices), out=indptr[1:])
+    arcs = sparse.csr_matrix((merged_weights, keys % base, indptr), shape=(num_vertices, num_vertices))
+
+    if latency is not None:
+        latency = latency.reduce(inverse, len(keys))
+
+    return arcs, latency
+
+
+class _VertexTable(object):
+    """Vertex names stored as a buffer of utf-8 encoded names, their offsets and their lexicographic order. Names
+    are decoded only when accessed.
+    """
+
+    def __init__(self, buffer, offsets, order):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._order = order
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._buffer[self._offsets[index]:self._offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        buffer = self._buffer.tobytes()
+        offsets = self._offsets.tolist()
+        for (start, end) in zip(offsets[:-1], offsets[1:]):
+            yield buffer[start:end].decode('utf-8')
+
+    def index(self, vertex):
+        """Get a vertex index given his name, using a binary search over names order.
+
+        :param vertex: Vertex name.
+        :type vertex: str
+        :return: Vertex index.
+        :rtype: int
+        """
+        key = vertex if isinstance(vertex, bytes) else vertex.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            index = self._order[middle]
+            name = self._buffer[self._offsets[index]:self._offsets[index + 1]].tobytes()
+            if name == key:
+                return int(index)
+            elif name < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        raise KeyError(vertex)
+
 
 class Digraph(object):
-    def __init__(self, vertices, arcs):
-        self._vertices = vertices
-        self._arcs = arcs
+    def __init__(self, vertices, arcs, latency=None):
+        """Digraph init method.
+
+        :param vertices: Vertices, ordered as their index in arcs matrix.
+        :type vertices: iter
+        :param arcs: Square matrix of arc weights, dense or sparse.
+        :type arcs: scipy.sparse.spmatrix
+        :param latency: Latency aggregates of each arc, aligned with arcs stored in canonical CSR order.
+        :type latency: performance_tools.utils.histogram.LatencyAggregates
+        """
+        self._vertices = list(vertices)
+        self._arcs = self._sparse_arcs(arcs)
+        self._latency = latency
         self._indexed_vertices = {v: i for (i, v) in enumerate(self._vertices)}
+        self._index_degrees()
+        # Arcs by destination, built the first time predecessors are needed
+        self._reverse_arcs = None
+
+    @staticmethod
+    def _sparse_arcs(arcs):
+        """Convert arcs to a canonical CSR matrix: wide weights, sorted indexes and no duplicated nor zero entries.
+
+        :param arcs: Arcs matrix.
+        :return: Arcs matrix.
+        :rtype: scipy.sparse.csr_matrix
+        """
+        arcs = sparse.csr_matrix(arcs)
+        if arcs.dtype.kind in 'biu' and arcs.dtype != ARCS_DTYPE:
+            arcs = arcs.astype(ARCS_DTYPE)
+
+        # Arcs could be read-only memory-mapped arrays, so they are only modified when necessary
+        if not arcs.has_canonical_format:
+            arcs.sum_duplicates()
+        if not arcs.data.all():
+            arcs.eliminate_zeros()
+        return arcs
+
+    def _index_degrees(self):
+        """Calculate in and out degrees, and in and out weights, of all vertices.
+        """
+        num_vertices = len(self._vertices)
+        self._out_degree = np.diff(self._arcs.indptr).astype(np.int64)
+        self._in_degree = np.bincount(self._arcs.indices, minlength=num_vertices).astype(np.int64)
+        self._out_weight = np.asarray(self._arcs.sum(axis=1)).ravel().astype(self._arcs.dtype)
+        self._in_weight = np.bincount(self._arcs.indices, weights=self._arcs.data,
+                                      minlength=num_vertices).astype(self._arcs.dtype)
+
+    def in_degrees(self, weighted=False):
+        """Get in degree of each vertex, ordered by vertex index.
+
+        :param weighted: If true, sum of arc weights will be returned instead of number of arcs.
+        :type weighted: bool
+        :return: In degrees.
+        :rtype: numpy.array
+        """
+        return self._in_weight if weighted else self._in_degree
+
+    def out_degrees(self, weighted=False):
+        """Get out degree of each vertex, ordered by vertex index.
+
+        :param weighted: If true, sum of arc weights will be returned instead of number of arcs.
+        :type weighted: bool
+        :return: Out degrees.
+        :rtype: numpy.array
+        """
+        return self._out_weight if weighted else self._out_degree
 
     def initial_vertices(self):
         """Return the list of all initial vertices.
@@ -15,8 +268,7 @@ class Digraph(object):
         :return: Initial vertices.
         :rtype: list
         """
-        return set([v for v in self._vertices if
-                    self._arcs[:, self.get_index(v)].sum() == 0 and self._arcs[self.get_index(v), :].sum() > 0])
+        return {self._vertices[i] for i in np.flatnonzero((self._in_degree == 0) & (self._out_degree > 0))}
 
     def end_vertices(self):
         """Return the list of all end vertices.
@@ -24,109 +276,628 @@ class Digraph(object):
         :return: End vertices.
         :rtype: list
         """
-        return set([v for v in self._vertices if
-                    self._arcs[:, self.get_index(v)].sum() > 0 and self._arcs[self.get_index(v), :].sum() == 0])
+        return {self._vertices[i] for i in np.flatnonzero((self._in_degree > 0) & (self._out_degree == 0))}
+
+    def add_arcs(self, arcs):
+        """Add arcs from an iterable of (origin, destination), (origin, destination, weight) or
+        (origin, destination, weight, time) tuples. Unknown vertices are added too. Degrees are updated only for the
+        affected vertices, and times are aggregated into arcs latency if digraph has it.
+
+        :param arcs: Arcs.
+        :type arcs: iter
+        """
+        origins, destinations, weights, times = [], [], [], []
+        for arc in arcs:
+            origins.append(self._add_vertex(arc[0]))
+            destinations.append(self._add_vertex(arc[1]))
+            weights.append(arc[2] if len(arc) > 2 else 1)
+            times.append(arc[3] if len(arc) > 3 else None)
+
+        # Grow arcs matrix and degrees if new vertices were added
+        num_vertices, previous_num_vertices = len(self._vertices), self._arcs.shape[0]
+        if num_vertices > previous_num_vertices:
+            grow = num_vertices - previous_num_vertices
+            indptr = np.concatenate((self._arcs.indptr, np.repeat(self._arcs.indptr[-1], grow)))
+            self._arcs = sparse.csr_matrix((self._arcs.data, self._arcs.indices, indptr),
+                                           shape=(num_vertices, num_vertices))
+            self._out_degree, self._in_degree, self._out_weight, self._in_weight = [
+                np.concatenate((d, np.zeros(grow, dtype=d.dtype)))
+                for d in (self._out_degree, self._in_degree, self._out_weight, self._in_weight)
+            ]
+
+        new_arcs = sparse.coo_matrix((np.array(weights, dtype=self._arcs.dtype), (origins, destinations)),
+                                     shape=(num_vertices, num_vertices)).tocsr().tocoo()
+        created = np.asarray(self._arcs[new_arcs.row, new_arcs.col]).ravel() == 0
+
+        previous_keys = self._arcs_keys()
+        self._arcs = self._sparse_arcs(self._arcs + new_arcs.tocsr())
+        self._reverse_arcs = None
+
+        if self._latency is not None:
+            # Realign latency aggregates with the new arcs positions and merge the new samples
+            keys = self._arcs_keys()
+            samples = LatencyAggregates.from_samples(np.arange(len(times)), times, len(times), self._latency.edges)
+            positions = np.searchsorted(keys, np.concatenate((
+                previous_keys, _arcs_keys(origins, destinations, num_vertices)
+            )))
+            self._latency = LatencyAggregates.concatenate([self._latency, samples]).reduce(positions, len(keys))
+        self._out_degree += np.bincount(new_arcs.row[created], minlength=num_vertices)
+        self._in_degree += np.bincount(new_arcs.col[created], minlength=num_vertices)
+        self._out_weight += np.bincount(new_arcs.row, weights=new_arcs.data,
+                                        minlength=num_vertices).astype(self._arcs.dtype)
+        self._in_weight += np.bincount(new_arcs.col, weights=new_arcs.data,
+                                       minlength=num_vertices).astype(self._arcs.dtype)
+
+    def _arcs_keys(self):
+        rows = np.repeat(np.arange(self._arcs.shape[0]), np.diff(self._arcs.indptr))
+        return _arcs_keys(rows, self._arcs.indices, len(self._vertices))
+
+    def _add_vertex(self, vertex):
+        try:
+            index = self._indexed_vertices[vertex]
+        except KeyError:
+            index = len(self._vertices)
+            self._indexed_vertices[vertex] = index
+            self._vertices.append(vertex)
+
+        return index
+
+    def successors(self, vertex, min_weight=None):
+        """Get indexes of all vertices reachable from given vertex through a single arc.
+
+        :param vertex: Vertex index.
+        :type vertex: int
+        :param min_weight: If given, only arcs with at least this weight will be considered.
+        :type min_weight: int
+        :return: Successors indexes.
+        :rtype: numpy.array
+        """
+        start, end = self._arcs.indptr[vertex], self._arcs.indptr[vertex + 1]
+        successors = self._arcs.indices[start:end]
+        if min_weight is not None:
+            successors = successors[self._arcs.data[start:end] >= min_weight]
+
+        return successors
+
+    def predecessors(self, vertex, min_weight=None):
+        """Get indexes of all vertices that reach given vertex through a single arc.
+
+        :param vertex: Vertex index.
+        :type vertex: int
+        :param min_weight: If given, only arcs with at least this weight will be considered.
+        :type min_weight: int
+        :return: Predecessors indexes.
+        :rtype: numpy.array
+        """
+        if self._reverse_arcs is None:
+            self._reverse_arcs = self._arcs.tocsc()
+
+        start, end = self._reverse_arcs.indptr[vertex], self._reverse_arcs.indptr[vertex + 1]
+        predecessors = self._reverse_arcs.indices[start:end]
+        if min_weight is not None:
+            predecessors = predecessors[self._reverse_arcs.data[start:end] >= min_weight]
+
+        return predecessors
+
+    def neighborhood(self, vertex, min_weight=None):
+        """Make a digraph with given vertex, its predecessors and its successors, and all arcs between them.
+
+        :param vertex: Vertex label or index.
+        :type vertex: str or int
+        :param min_weight: If given, only neighbors through arcs with at least this weight will be considered.
+        :type min_weight: int
+        :return: Subgraph.
+        :rtype: Digraph
+        """
+        index = self._parse_vertex(vertex)
+        indexes = np.concatenate(([index], self.predecessors(index, min_weight), self.successors(index, min_weight)))
+        return self.subgraph([self._vertices[i] for i in indexes])
 
-    def draw_all_paths(self, initial, end, filename, relative_value=False):
-        paths = self.all_paths(initial, end)
+    def draw_all_paths(self, initial, end, filename, relative_value=False, max_depth=None, max_paths=None,
+                       min_weight=None, top=None, rank='product', workers=1):
+        """Draw each path between two vertices in a different file using Graphviz. Paths are drawn as they are found,
+        so limits can be used to render only the dominant flows of big digraphs.
 
-        for path in paths:
-            name, extension = filename.rsplit('.', 1)
-            path_filename = "{}_{}.{}".format(name, "-".join([str(self.get_index(p)) for p in path]), extension)
-            self._draw_path(path, path_filename, relative_value)
+        :param initial: Initial vertex.
+        :param end: End vertex.
+        :param filename: Output filename to draw, that will be suffixed with vertices indexes of each path.
+        :type filename: str
+        :param relative_value: If true, arc values will be printed as percentages.
+        :type relative_value: bool
+        :param max_depth: Maximum number of arcs of each path.
+        :type max_depth: int
+        :param max_paths: Maximum number of paths.
+        :type max_paths: int
+        :param min_weight: Minimum weight of arcs used in paths.
+        :type min_weight: int
+        :param top: If given, draw only the top most travelled paths.
+        :type top: int
+        :param rank: Paths ranking used with top: product of transition probabilities or minimum arc weight.
+        :type rank: str
+        :param workers: Number of processes that lay out and render paths. If 1, paths are rendered in this process.
+        :type workers: int
+        """
+        name, extension = filename.rsplit('.', 1)
+        paths = self._paths(initial, end, max_depth, max_paths, min_weight, top, rank)
+        tasks = ((self._path_graph([self._vertices[p] for p in path], relative_value).string(),
+                  "{}_{}.{}".format(name, "-".join([str(p) for p in path]), extension), 'dot') for path in paths)
+
+        if workers == 1:
+            for task in tasks:
+                render_dot(task)
+            return
+
+        pool = Pool(workers)
+        try:
+            for _ in pool.imap_unordered(render_dot, tasks, chunksize=4):
+                pass
+        finally:
+            pool.terminate()
+
+    @staticmethod
+    def _format_value(value, total, relative_value=False):
+        if relative_value:
+            return "{:.2f}%".format(value * 100. / total)
 
-    def _draw_path(self, path, filename, relative_value=False):
+        return str(value)
+
+    def _path_graph(self, path, relative_value=False):
         dot = DotGraph(strict=True, directed=True)
 
         # Add initial vertices
-        dot.add_node(
-            path[0],
-            fillcolor='#4CAF50',
-            style='filled',
-            fontcolor='#FFFFFF'
-        )
+        dot.add_node(path[0], **VERTEX_STYLES['initial'])
 
         if len(path) > 1:
             # Add end vertices
-            dot.add_node(
-                path[-1],
-                fillcolor='#2196F3',
-                style='filled',
-                fontcolor='#FFFFFF',
-            )
+            dot.add_node(path[-1], **VERTEX_STYLES['end'])
 
             # Add rest of vertices
-            dot.add_nodes_from(
-                path[1:-1],
-                fillcolor='#9E9E9E',
-                style='filled'
-            )
+            dot.add_nodes_from(path[1:-1], **VERTEX_STYLES['inner'])
 
-            total = self._arcs.sum()
+            total = self._out_weight.sum()
             while len(path) > 1:
                 i, j = path[0:2]
                 value = self._arcs[self.get_index(i), self.get_index(j)]
                 if value:
-                    if relative_value:
-                        value = value * 100. / total
-                        formatted_value = "{:.2f}%".format(value)
-                    else:
-                        formatted_value = str(value)
-                    dot.add_edge(i, j, label=formatted_value)
+                    dot.add_edge(i, j, label=self._format_value(value, total, relative_value))
                 path = path[1:]
 
-        dot.layout(prog='dot')
-        dot.draw(filename)
+        return dot
+
+    def _parse_vertex(self, vertex):
+        if isinstance(vertex, (int, np.integer)):
+            return vertex
 
-    def all_paths(self, initial, end):
+        return self.get_index(vertex)
+
+    def all_paths(self, initial, end, max_depth=None, max_paths=None, min_weight=None, top=None, rank='product'):
         """Get all paths between two vertices. Initial and end vertices can be the label or the index.
 
         :param initial: Initial vertex.
         :param end: End vertex.
+        :param max_depth: Maximum number of arcs of each path.
+        :type max_depth: int
+        :param max_paths: Maximum number of paths.
+        :type max_paths: int
+        :param min_weight: Minimum weight of arcs used in paths.
+        :type min_weight: int
+        :param top: If given, return only the top most travelled paths, sorted by rank.
+        :type top: int
+        :param rank: Paths ranking used with top: product of transition probabilities or minimum arc weight.
+        :type rank: str
         :return: List of paths.
         :rtype: list
         """
-        # Parse parameters
-        if not isinstance(initial, int):
-            initial = self.get_index(initial)
+        paths = self._paths(initial, end, max_depth, max_paths, min_weight, top, rank)
 
-        if not isinstance(end, int):
-            end = self.get_index(end)
+        # Replace vertex index with his name
+        named_paths = [[self._vertices[sp] for sp in p] for p in paths]
 
-        # Get all paths
-        paths = self._all_paths(initial, end)
+        return named_paths
 
-        # Use list for associate vertex name with his own index
-        vertices = list(self._vertices)
+    def iter_paths(self, initial, end, max_depth=None, min_weight=None):
+        """Lazily iterate over all paths between two vertices in depth-first order. Initial and end vertices can be
+        the label or the index.
 
-        # Replace vertex index with his name
-        named_paths = [[vertices[sp] for sp in p] for p in paths]
+        :param initial: Initial vertex.
+        :param end: End vertex.
+        :param max_depth: Maximum number of arcs of each path.
+        :type max_depth: int
+        :param min_weight: Minimum weight of arcs used in paths.
+        :type min_weight: int
+        :return: Paths generator.
+        :rtype: generator
+        """
+        for path in self._iter_paths(self._parse_vertex(initial), self._parse_vertex(end), max_depth, min_weight):
+            yield [self._vertices[p] for p in path]
 
-        return named_paths
+    def top_paths(self, initial, end, k=10, rank='product', max_depth=None, min_weight=None):
+        """Lazily iterate over the most travelled paths between two vertices, from the most to the least travelled
+        one. Paths can be ranked by the product of the transition probabilities of their arcs, that is the
+        probability of following the whole path, or by their minimum arc weight, that is the traffic bottleneck.
+
+        :param initial: Initial vertex.
+        :param end: End vertex.
+        :param k: Maximum number of paths.
+        :type k: int
+        :param rank: Paths ranking: 'product' or 'min'.
+        :type rank: str
+        :param max_depth: Maximum number of arcs of each path.
+        :type max_depth: int
+        :param min_weight: Minimum weight of arcs used in paths.
+        :type min_weight: int
+        :return: Generator of (path, score) tuples.
+        :rtype: generator
+        """
+        paths = self._top_paths(self._parse_vertex(initial), self._parse_vertex(end), k, rank, max_depth, min_weight)
+        for path, score in paths:
+            yield [self._vertices[p] for p in path], score
+
+    def _paths(self, initial, end, max_depth=None, max_paths=None, min_weight=None, top=None, rank='product'):
+        initial, end = self._parse_vertex(initial), self._parse_vertex(end)
+
+        if top is not None:
+            k = top if max_paths is None else min(top, max_paths)
+            paths = (p for (p, _) in self._top_paths(initial, end, k, rank, max_depth, min_weight))
+        else:
+            paths = islice(self._iter_paths(initial, end, max_depth, min_weight), max_paths)
+
+        return paths
+
+    def _iter_paths(self, i, e, max_depth=None, min_weight=None):
+        """Iterative depth-first search of simple paths. Only a successors iterator per vertex of current path is
+        stored.
+        """
+        if i == e:
+            yield [i]
+            return
+
+        path = [i]
+        in_path = np.zeros(len(self._vertices), dtype=bool)
+        in_path[i] = True
+        stack = [iter(self.successors(i, min_weight))]
+
+        while stack:
+            vertex = next(stack[-1], None)
+
+            if vertex is None:
+                # All successors visited, so go back
+                stack.pop()
+                in_path[path.pop()] = False
+            elif vertex == e:
+                yield path + [e]
+            elif not in_path[vertex] and (max_depth is None or len(path) < max_depth):
+                path.append(vertex)
+                in_path[vertex] = True
+                stack.append(iter(self.successors(vertex, min_weight)))
+
+    def _arc_score(self, score, vertex, weight, rank):
+        """Score of a path extended with an arc, or with each of many arcs, of given origin vertex and weight.
+        """
+        if rank == 'product':
+            return score * weight / float(self._out_weight[vertex])
+
+        return np.minimum(score, weight)
+
+    def _best_path(self, i, e, score, rank, max_depth=None, min_weight=None, blocked_vertices=(), blocked_arcs=(),
+                   min_score=None):
+        """Best-first search of the best simple path between two vertices, avoiding given vertices and arcs. Both
+        ranks never increase when a path is extended, so the first path that reaches the end vertex is the best one.
+        A vertex is expanded again only if it's reached through fewer arcs, so depth limit is honored and paths never
+        repeat vertices.
+
+        :return: Best path and its score, or None if there is no path with at least the minimum score.
+        :rtype: tuple
+        """
+        # Fewest arcs of expanded paths that reached each vertex
+        min_depth = np.full(len(self._vertices), np.iinfo(np.int64).max, dtype=np.int64)
+        min_depth[list(blocked_vertices)] = -1
+
+        # Paths are stored as linked lists of (vertex, parent) to share their prefixes
+        heap = [(-score, 0, 0, (i, None))]
+        counter = 1
+        while heap:
+            score, _, depth, node = heappop(heap)
+            vertex = node[0]
+
+            if min_score is not None and -score < min_score:
+                return None
+
+            if vertex == e:
+                path = []
+                while node is not None:
+                    path.append(node[0])
+                    node = node[1]
+                return path[::-1], -score
+
+            if depth >= min_depth[vertex] or (max_depth is not None and depth >= max_depth):
+                continue
+            min_depth[vertex] = depth
+
+            start, end = self._arcs.indptr[vertex], self._arcs.indptr[vertex + 1]
+            successors, weights = self._arcs.indices[start:end], self._arcs.data[start:end]
+            scores = self._arc_score(-score, vertex, weights, rank)
+            valid = min_depth[successors] > depth + 1
+            if min_weight is not None:
+                valid &= weights >= min_weight
+            if min_score is not None:
+                valid &= scores >= min_score
+
+            for successor, successor_score in zip(successors[valid].tolist(), scores[valid].tolist()):
+                if (vertex, successor) not in blocked_arcs:
+                    heappush(heap, (-successor_score, counter, depth + 1, (successor, node)))
+                    counter += 1
+
+        return None
+
+    def _top_paths(self, i, e, k=10, rank='product', max_depth=None, min_weight=None):
+        """Yen's algorithm of k best simple paths. Each path found is followed by candidates that share a prefix with
+        it and then deviate through the best path that avoids the prefix and the arcs already taken after it, so
+        paths are exact and found sorted by score. As Lawler proposed, prefixes shorter than the one a path shares
+        with the path it deviates from are skipped, because they would repeat candidates, and searches stop as soon
+        as they can't beat the candidates already waiting for the remaining paths.
+        """
+        if rank not in ('product', 'min'):
+            raise ValueError("Invalid rank '{}', it must be 'product' or 'min'".format(rank))
 
-    def _all_paths(self, i, e, path=None):
-        if path is None:
-            path = []
+        initial_score = 1. if rank == 'product' else np.inf
+        if k <= 0:
+            return
 
         if i == e:
-            path.append(i)
-            result = path
+            yield [i], initial_score
+            return
+
+        best = self._best_path(i, e, initial_score, rank, max_depth, min_weight)
+        if best is None:
+            return
+
+        found = []
+        # Candidates are (score, counter, path, index of the vertex where path deviates)
+        candidates = [(-best[1], 0, best[0], 0)]
+        seen = {tuple(best[0])}
+        counter = 1
+        while candidates:
+            score, _, path, deviation = heappop(candidates)
+            found.append(path)
+            yield path, -score
+
+            if len(found) >= k:
+                return
+
+            root_score = initial_score
+            for j in range(len(path) - 1):
+                if j >= deviation:
+                    root = path[:j + 1]
+                    blocked_arcs = {(p[j], p[j + 1]) for p in found if p[:j + 1] == root}
+                    needed = k - len(found)
+                    min_score = -nsmallest(needed, candidates)[-1][0] if len(candidates) >= needed else None
+                    spur = self._best_path(path[j], e, root_score, rank, None if max_depth is None else max_depth - j,
+                                           min_weight, root[:-1], blocked_arcs, min_score)
+                    if spur is not None and tuple(root[:-1] + spur[0]) not in seen:
+                        seen.add(tuple(root[:-1] + spur[0]))
+                        heappush(candidates, (-spur[1], counter, root[:-1] + spur[0], j))
+                        counter += 1
+
+                weight = self._arcs.data[self._arc_position(path[j], path[j + 1])]
+                root_score = self._arc_score(root_score, path[j], weight, rank)
+
+    def transition_matrix(self):
+        """Row-normalize arc weights, so each arc value is the probability of following it from its origin vertex.
+        Rows of vertices without outgoing arcs are empty.
+
+        :return: Transition matrix.
+        :rtype: scipy.sparse.csr_matrix
+        """
+        transitions = self._arcs.astype(float)
+        transitions.data /= np.repeat(self._out_weight, self._out_degree)
+        return transitions
+
+    def _flow(self):
+        """Model the digraph as a flow of sessions: traffic of a vertex is the maximum of its in and out weights,
+        sessions enter a vertex when out weight exceeds in weight and exit when in weight exceeds out weight.
+
+        :return: Transient transition matrix, entry weights and exit probabilities.
+        :rtype: tuple
+        """
+        traffic = np.maximum(self._in_weight, self._out_weight).astype(float)
+        entries = np.maximum(self._out_weight - self._in_weight, 0).astype(float)
+        exits = np.ones(len(self._vertices))
+        np.divide(np.maximum(self._in_weight - self._out_weight, 0), traffic, out=exits, where=traffic > 0)
+
+        transitions = self._arcs.astype(float)
+        transitions.data /= np.repeat(traffic, self._out_degree)
+
+        return transitions, entries, exits
+
+    @staticmethod
+    def _solve(transitions, b, max_iter=None):
+        """Solve (I - transitions) x = b using an iterative sparse solver.
+        """
+        system = sparse.identity(transitions.shape[0], format='csr') - transitions
+        x, info = gmres(system, b, maxiter=max_iter)
+        if info != 0:
+            raise DigraphException("Solver didn't converge, there could be cycles without exits")
+
+        return x
+
+    def _series(self, values, name=None):
+        return pd.Series(values, index=self._vertices, name=name)
+
+    def exit_probabilities(self):
+        """Probability of a session ending after each vertex visit, estimated as the share of traffic that reaches
+        a vertex and doesn't leave it.
+
+        :return: Exit probabilities.
+        :rtype: pandas.Series
+        """
+        _, _, exits = self._flow()
+        return self._series(exits, 'Exit probability')
+
+    def stationary_distribution(self, max_iter=None):
+        """Share of all visits that each vertex receives, when sessions start at entry vertices following the
+        observed traffic, follow arcs with their transition probabilities and end following exit probabilities.
+
+        :param max_iter: Maximum number of solver iterations.
+        :type max_iter: int
+        :return: Stationary distribution.
+        :rtype: pandas.Series
+        """
+        transitions, entries, _ = self._flow()
+        if not entries.sum():
+            raise DigraphException("Digraph doesn't have entry traffic")
+
+        visits = self._solve(transitions.T.tocsr(), entries / entries.sum(), max_iter)
+        return self._series(visits / visits.sum(), 'Stationary distribution')
+
+    def expected_path_length(self, max_iter=None):
+        """Expected number of arcs that a session starting at each vertex will follow before exit.
+
+        :param max_iter: Maximum number of solver iterations.
+        :type max_iter: int
+        :return: Expected path lengths.
+        :rtype: pandas.Series
+        """
+        transitions, _, _ = self._flow()
+        visits = self._solve(transitions, np.ones(len(self._vertices)), max_iter)
+        return self._series(visits - 1, 'Expected path length')
+
+    def pagerank(self, damping=0.85, tol=1.0e-6, max_iter=100):
+        """Calculate PageRank of each vertex using arc weights. Random jumps and jumps from vertices without
+        outgoing arcs are uniformly distributed.
+
+        :param damping: Damping factor.
+        :type damping: float
+        :param tol: Error tolerance, per vertex.
+        :type tol: float
+        :param max_iter: Maximum number of iterations.
+        :type max_iter: int
+        :return: PageRank.
+        :rtype: pandas.Series
+        """
+        num_vertices = len(self._vertices)
+        transitions = self.transition_matrix().T.tocsr()
+        dangling = self._out_degree == 0
+        jump = np.ones(num_vertices) / num_vertices
+
+        rank = jump
+        for _ in range(max_iter):
+            previous_rank = rank
+            rank = damping * (transitions.dot(rank) + previous_rank[dangling].sum() * jump) + (1 - damping) * jump
+            if np.abs(rank - previous_rank).sum() < num_vertices * tol:
+                return self._series(rank, 'PageRank')
+
+        raise DigraphException("PageRank didn't converge in {:d} iterations".format(max_iter))
+
+    def hotspots(self, stats, column='Mean', method='stationary'):
+        """Rank vertices by their contribution to the user-facing latency: share of visits of each vertex multiplied
+        by its time. Stats are usually the result of RequestAnalyzer.stats_by_request.
+
+        :param stats: Time stats indexed by request.
+        :type stats: pandas.DataFrame
+        :param column: Stats column used as time of each request.
+        :type column: str
+        :param method: Visits share: 'stationary' distribution or 'pagerank'.
+        :type method: str
+        :return: Visits share, time, contribution and share of total latency of each vertex, sorted by contribution.
+        :rtype: pandas.DataFrame
+        """
+        if method == 'stationary':
+            visits = self.stationary_distribution()
+        elif method == 'pagerank':
+            visits = self.pagerank()
         else:
-            result = []
-            for vertice, value in [(ve, va) for ve, va in enumerate(self._arcs[i]) if va > 0 and ve != i]:
-                if vertice not in path:
-                    clone_path = path[:]
-                    clone_path.append(i)
-                    partial_result = self._all_paths(vertice, e, clone_path)
-                    if partial_result:
-                        appended = False
-                        for r in [res for res in partial_result if isinstance(res, list)]:
-                            result.append(r)
-                            appended = True
-                        if not appended:
-                            result.append(partial_result)
-
-        return result
+            raise ValueError("Invalid method '{}', it must be 'stationary' or 'pagerank'".format(method))
+
+        hotspots = pd.DataFrame({'Visits': visits, 'Time': stats[column]}, columns=['Visits', 'Time']).dropna()
+        hotspots['Contribution'] = hotspots['Visits'] * hotspots['Time']
+        hotspots['Share'] = hotspots['Contribution'] / hotspots['Contribution'].sum()
+
+        return hotspots.sort_values('Contribution', ascending=False)
+
+    @property
+    def latency(self):
+        """Latency aggregates of each arc, aligned with arcs data, or None if digraph doesn't have times.
+        """
+        return self._latency
+
+    def _check_latency(self):
+        if self._latency is None:
+            raise DigraphException("Digraph doesn't have latency data")
+
+    def arcs_latency(self):
+        """Latency stats of each arc: count, sum, mean, min, max and approximate median of request times.
+
+        :return: Latency stats indexed by referrer and request.
+        :rtype: pandas.DataFrame
+        """
+        self._check_latency()
+        arcs = self._arcs.tocoo()
+        index = pd.MultiIndex.from_arrays([[self._vertices[i] for i in arcs.row],
+                                           [self._vertices[j] for j in arcs.col]], names=['Referrer', 'Request'])
+        return self._latency.to_frame(index)
+
+    def vertices_latency(self):
+        """Latency stats of each vertex, aggregated from all its incoming arcs: count, sum, mean, min, max and
+        approximate median of request times.
+
+        :return: Latency stats indexed by request.
+        :rtype: pandas.DataFrame
+        """
+        self._check_latency()
+        latency = self._latency.reduce(self._arcs.indices, len(self._vertices))
+        return latency.to_frame(pd.Index(self._vertices, name='Request'))
+
+    def _arc_position(self, i, j):
+        start, end = self._arcs.indptr[i], self._arcs.indptr[i + 1]
+        position = start + np.searchsorted(self._arcs.indices[start:end], j)
+        if position == end or self._arcs.indices[position] != j:
+            raise KeyError((self._vertices[i], self._vertices[j]))
+
+        return position
+
+    def _path_latency(self, path, means):
+        return sum(means[self._arc_position(i, j)] for (i, j) in zip(path[:-1], path[1:]))
+
+    def path_latency(self, path):
+        """Expected cumulative response time of a path: sum of mean request time of each of its arcs.
+
+        :param path: Path as a list of vertices, labels or indexes.
+        :type path: list
+        :return: Expected response time.
+        :rtype: float
+        """
+        self._check_latency()
+        return self._path_latency([self._parse_vertex(v) for v in path], self._latency.mean())
+
+    def critical_paths(self, initial, end, k=10, candidates=100, rank='product', max_depth=None, min_weight=None):
+        """Get the slowest heavily-travelled paths between two vertices: the most travelled candidate paths, ranked
+        by their expected cumulative response time.
+
+        :param initial: Initial vertex.
+        :param end: End vertex.
+        :param k: Maximum number of paths.
+        :type k: int
+        :param candidates: Number of most travelled paths considered.
+        :type candidates: int
+        :param rank: Traffic ranking of candidates: 'product' or 'min'.
+        :type rank: str
+        :param max_depth: Maximum number of arcs of each path.
+        :type max_depth: int
+        :param min_weight: Minimum weight of arcs used in paths.
+        :type min_weight: int
+        :return: List of (path, traffic score, expected response time) tuples, slowest first. Paths with arcs
+        without any time have unknown response time (NaN) and are the last ones.
+        :rtype: list
+        """
+        self._check_latency()
+        means = self._latency.mean()
+        paths = self._top_paths(self._parse_vertex(initial), self._parse_vertex(end), candidates, rank, max_depth,
+                                min_weight)
+        paths = sorted(((p, score, self._path_latency(p, means)) for (p, score) in paths),
+                       key=lambda t: -np.inf if np.isnan(t[2]) else t[2], reverse=True)
+
+        return [([self._vertices[v] for v in p], score, latency) for (p, score, latency) in paths[:k]]
 
     def get_index(self, vertex):
         """Get a vertex index given his name.
@@ -138,103 +909,472 @@ class Digraph(object):
         """
         return self._indexed_vertices[vertex]
 
-    def draw(self, filename, relative_value=False, prog='dot'):
-        """Draw digraph using Graphviz.
+    def _pruned_arcs(self, top=None, min_weight=None, min_percentage=None):
+        """Get arcs that fulfill all given constraints, as (origins, destinations, weights) arrays.
+
+        :param top: Keep only the top N arcs with more weight.
+        :type top: int
+        :param min_weight: Keep only arcs with at least this weight.
+        :type min_weight: int
+        :param min_percentage: Keep only arcs with at least this percentage of total weight.
+        :type min_percentage: float
+        :return: Origins, destinations and weights.
+        :rtype: tuple
+        """
+        arcs = self._arcs.tocoo()
+        rows, columns, weights = arcs.row, arcs.col, arcs.data
+
+        kept = np.ones(len(weights), dtype=bool)
+        if min_weight is not None:
+            kept &= weights >= min_weight
+        if min_percentage is not None:
+            kept &= weights * 100. / weights.sum() >= min_percentage
+        rows, columns, weights = rows[kept], columns[kept], weights[kept]
+
+        if top is not None and top < len(weights):
+            kept = np.sort(np.argpartition(-weights, top)[:top])
+            rows, columns, weights = rows[kept], columns[kept], weights[kept]
+
+        return rows, columns, weights
+
+    def _vertices_kinds(self, indexes):
+        """Get kind of given vertices: initial, end or inner.
+        """
+        kinds = np.full(len(indexes), 'inner', dtype=object)
+        kinds[(self._in_degree[indexes] == 0) & (self._out_degree[indexes] > 0)] = 'initial'
+        kinds[(self._in_degree[indexes] > 0) & (self._out_degree[indexes] == 0)] = 'end'
+        return kinds
+
+    def _drawing_elements(self, top=None, min_weight=None, min_percentage=None):
+        """Get vertices and arcs that will be drawn. If arcs are pruned, only vertices of remaining arcs are drawn.
+        """
+        rows, columns, weights = self._pruned_arcs(top, min_weight, min_percentage)
+        if top is None and min_weight is None and min_percentage is None:
+            indexes = np.arange(len(self._vertices))
+        else:
+            indexes = np.unique(np.concatenate((rows, columns)))
+
+        return indexes, self._vertices_kinds(indexes), rows, columns, weights
+
+    def draw(self, filename, relative_value=False, prog='dot', top=None, min_weight=None, min_percentage=None):
+        """Draw digraph using Graphviz. Arcs can be pruned to draw only the main flows of big digraphs.
 
         :param filename: Output filename to draw.
         :type filename: str
         :param relative_value: If true, arc values will be printed as percentages.
         :type relative_value: bool
+        :param prog: Graphviz layout program.
+        :type prog: str
+        :param top: Draw only the top N arcs with more weight.
+        :type top: int
+        :param min_weight: Draw only arcs with at least this weight.
+        :type min_weight: int
+        :param min_percentage: Draw only arcs with at least this percentage of total weight.
+        :type min_percentage: float
         """
         dot = DotGraph(strict=True, directed=True)
+        indexes, kinds, rows, columns, weights = self._drawing_elements(top, min_weight, min_percentage)
 
-        # Add initial vertices
-        dot.add_nodes_from(
-            self.initial_vertices(),
-            fillcolor='#4CAF50',
-            style='filled',
-            fontcolor='#FFFFFF'
-        )
+        # Add initial, end and rest of vertices
+        for kind in ('initial', 'end', 'inner'):
+            dot.add_nodes_from([self._vertices[i] for i in indexes[kinds == kind]], **VERTEX_STYLES[kind])
 
-        # Add end vertices
-        dot.add_nodes_from(
-            self.end_vertices(),
-            fillcolor='#2196F3',
-            style='filled',
-            fontcolor='#FFFFFF',
-        )
-
-        # Add rest of vertices
-        dot.add_nodes_from(
-            self._vertices - self.initial_vertices() - self.end_vertices(),
-            fillcolor='#9E9E9E',
-            style='filled'
-        )
-
-        total = self._arcs.sum()
-        for (i, j) in ((i, j) for i in self._vertices for j in self._vertices):
-            value = self._arcs[self.get_index(i), self.get_index(j)]
-            if value:
-                if relative_value:
-                    value = value * 100. / total
-                    formatted_value = "{:.2f}%".format(value)
-                else:
-                    formatted_value = str(value)
-                dot.add_edge(i, j, label=formatted_value)
+        total = self._out_weight.sum()
+        for (i, j, value) in zip(rows, columns, weights):
+            dot.add_edge(self._vertices[i], self._vertices[j], label=self._format_value(value, total, relative_value))
 
         dot.layout(prog=prog)
         dot.draw(filename)
 
+    def to_dot(self, output, relative_value=False, top=None, min_weight=None, min_percentage=None):
+        """Write digraph in Graphviz DOT language, streaming it to the output without building a graph in memory.
+
+        :param output: Output filename or file-like object.
+        :type output: str
+        :param relative_value: If true, arc values will be printed as percentages.
+        :type relative_value: bool
+        :param top: Write only the top N arcs with more weight.
+        :type top: int
+        :param min_weight: Write only arcs with at least this weight.
+        :type min_weight: int
+        :param min_percentage: Write only arcs with at least this percentage of total weight.
+        :type min_percentage: float
+        """
+        indexes, kinds, rows, columns, weights = self._drawing_elements(top, min_weight, min_percentage)
+        styles = {k: ", ".join('{}={}'.format(a, _dot_id(v)) for (a, v) in sorted(style.items()))
+                  for (k, style) in VERTEX_STYLES.items()}
+        total = self._out_weight.sum()
+
+        with _output_file(output) as f:
+            f.write('strict digraph {\n')
+            for (i, kind) in zip(indexes, kinds):
+                f.write('\t{} [{}];\n'.format(_dot_id(self._vertices[i]), styles[kind]))
+            for (i, j, value) in zip(rows, columns, weights):
+                f.write('\t{} -> {} [label={}];\n'.format(_dot_id(self._vertices[i]), _dot_id(self._vertices[j]),
+                                                         _dot_id(self._format_value(value, total, relative_value))))
+            f.write('}\n')
+
+    def to_json(self, output, top=None, min_weight=None, min_percentage=None):
+        """Write digraph as node-link JSON, streaming it to the output without building a graph in memory. Nodes
+        have id and kind, links have source, target and weight.
+
+        :param output: Output filename or file-like object.
+        :type output: str
+        :param top: Write only the top N arcs with more weight.
+        :type top: int
+        :param min_weight: Write only arcs with at least this weight.
+        :type min_weight: int
+        :param min_percentage: Write only arcs with at least this percentage of total weight.
+        :type min_percentage: float
+        """
+        indexes, kinds, rows, columns, weights = self._drawing_elements(top, min_weight, min_percentage)
+
+        with _output_file(output) as f:
+            f.write('{"directed": true, "multigraph": false, "graph": {}, "nodes": [')
+            for (n, (i, kind)) in enumerate(zip(indexes, kinds)):
+                f.write('{}\n{}'.format(',' if n else '', json.dumps({'id': self._vertices[i], 'kind': kind})))
+            f.write('], "links": [')
+            for (n, (i, j, value)) in enumerate(zip(rows, columns, weights)):
+                link = {'source': self._vertices[i], 'target': self._vertices[j], 'weight': value.item()}
+                f.write('{}\n{}'.format(',' if n else '', json.dumps(link, sort_keys=True)))
+            f.write(']}\n')
+
     def subgraph(self, vertices):
-        vertices = set(sorted(vertices))
-        rows = [False] * len(self._vertices)
-        for i in [self._indexed_vertices[v] for v in vertices]:
-            rows[i] = True
+        """Make a digraph with given vertices and all arcs between them.
+
+        :param vertices: Vertices of the subgraph.
+        :type vertices: iter
+        :return: Subgraph.
+        :rtype: Digraph
+        """
+        indexes = np.array(sorted(self.get_index(v) for v in set(vertices)), dtype=np.int64)
+        positions, arcs = _select_arcs(self._arcs.indptr, self._arcs.indices, self._arcs.data, len(self._vertices),
+                                       indexes)
+        latency = self._latency.take(positions) if self._latency is not None else None
+
+        return Digraph([self._vertices[i] for i in indexes], arcs, latency)
 
-        nprows = np.array(rows, dtype=bool)
+    def save(self, path):
+        """Save digraph in binary format. Digraph is stored in a directory that contains raw arrays of vertex names
+        and arcs in CSR format, so it can be memory-mapped when loaded.
 
-        arcs = self._arcs[nprows][:, nprows]
+        :param path: Output directory.
+        :type path: str
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        names = [v if isinstance(v, bytes) else v.encode('utf-8') for v in self._vertices]
+        buffer, offsets = encode_strings(names)
+        order = np.array(sorted(range(len(names)), key=names.__getitem__), dtype=np.int64)
+
+        arrays = {
+            'vertices': buffer,
+            'offsets': offsets,
+            'order': order,
+            'indptr': self._arcs.indptr,
+            'indices': self._arcs.indices,
+            'weights': self._arcs.data,
+        }
+        if self._latency is not None:
+            arrays.update({
+                'latency_count': self._latency.count,
+                'latency_total': self._latency.total,
+                'latency_minimum': self._latency.minimum,
+                'latency_maximum': self._latency.maximum,
+                'latency_histogram': self._latency.histogram,
+                'latency_edges': self._latency.edges,
+            })
 
-        return Digraph(vertices, arcs)
+        for (name, array) in arrays.items():
+            np.save(os.path.join(path, '{}.npy'.format(name)), array)
 
     @staticmethod
-    def from_csv(filename, separator=','):
-        """Make a digraph from a csv file. Format must be:
+    def load(path, vertices=None, mmap=True):
+        """Load a digraph saved in binary format. Arrays are memory-mapped by default, so loading is almost
+        instantaneous and memory is shared between processes that load the same digraph. If vertices are given, only
+        the arcs between them are read.
+
+        :param path: Digraph directory.
+        :type path: str
+        :param vertices: Load only the subgraph of these vertices.
+        :type vertices: iter
+        :param mmap: If true, arrays will be memory-mapped instead of read.
+        :type mmap: bool
+        :return: Digraph.
+        :rtype: Digraph
+        """
+        arrays = {name: np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r' if mmap else None)
+                  for name in ('vertices', 'offsets', 'order', 'indptr', 'indices', 'weights')}
+        table = _VertexTable(arrays['vertices'], arrays['offsets'], arrays['order'])
+
+        latency = None
+        if os.path.exists(os.path.join(path, 'latency_count.npy')):
+            latency = LatencyAggregates(*[
+                np.load(os.path.join(path, 'latency_{}.npy'.format(name)), mmap_mode='r' if mmap else None)
+                for name in ('count', 'total', 'minimum', 'maximum', 'histogram', 'edges')
+            ])
+
+        if vertices is None:
+            arcs = sparse.csr_matrix((arrays['weights'], arrays['indices'], arrays['indptr']),
+                                     shape=(len(table), len(table)))
+            return Digraph(list(table), arcs, latency)
+
+        indexes = np.array(sorted(table.index(v) for v in set(vertices)), dtype=np.int64)
+        positions, arcs = _select_arcs(arrays['indptr'], arrays['indices'], arrays['weights'], len(table), indexes)
+        if latency is not None:
+            latency = latency.take(positions)
+
+        return Digraph([table[i] for i in indexes], arcs, latency)
+
+    @staticmethod
+    def from_csv(filename, separator=',', batch_size=100000, latency=True):
+        """Make a digraph from a csv file in a single pass. Format must be:
         origin_vertex,destination_vertex
         origin_vertex,destination_vertex
         ...
 
-        :param filename: Input csv file.
+        Csv files with a header containing Referrer and Request columns, like the ones generated by URL flow
+        backends, are also accepted. If they contain a Time column, arcs latency is aggregated in the same pass.
+
+        :param filename: Input csv file or a file-like object.
         :type filename: str
         :param separator: Csv separator.
         :type separator: str
+        :param batch_size: Number of arcs accumulated before merging them into the digraph.
+        :type batch_size: int
+        :param latency: If true, aggregate arcs latency when times are available.
+        :type latency: bool
         :return: Digraph.
         :rtype: Digraph
         """
+        if hasattr(filename, 'read'):
+            return Digraph._from_csv_stream(filename, separator, batch_size, latency)
+
         with open(filename, 'r') as csvfile:
-            vertices = set()
+            return Digraph._from_csv_stream(csvfile, separator, batch_size, latency)
+
+    @staticmethod
+    def _from_csv_stream(csvfile, separator=',', batch_size=100000, latency=True):
+        reader = csv.reader(csvfile, delimiter=separator)
+
+        origin, destination, time = 0, 1, None
+        first_row = next(reader, None)
+        has_header = bool(first_row) and 'Referrer' in first_row and 'Request' in first_row
+        if has_header:
+            # Columns are indexed from the end because rows could have an additional leading index column
+            origin = first_row.index('Referrer') - len(first_row)
+            destination = first_row.index('Request') - len(first_row)
+            if latency and 'Time' in first_row:
+                time = first_row.index('Time') - len(first_row)
+
+        builder = DigraphBuilder(batch_size, latency=time is not None)
+        if first_row and not has_header:
+            builder.add_arc(first_row[origin], first_row[destination])
+
+        if time is None:
+            for row in reader:
+                builder.add_arc(row[origin], row[destination])
+        else:
+            for row in reader:
+                # Empty times, like the ones of NaN values written by pandas, are missing latency
+                builder.add_arc(row[origin], row[destination], time=float(row[time]) if row[time] else None)
+
+        return builder.build()
+
+    @staticmethod
+    def from_arcs(origins, destinations, weights, latency=None):
+        """Make a digraph from weighted arcs given by the names of their vertices, like those aggregated by a URL
+        flow backend. Repeated arcs are merged.
+
+        :param origins: Origin of each arc.
+        :type origins: list
+        :param destinations: Destination of each arc.
+        :type destinations: list
+        :param weights: Weight of each arc.
+        :type weights: list
+        :param latency: Latency aggregates of each arc.
+        :type latency: performance_tools.utils.histogram.LatencyAggregates
+        :return: Digraph.
+        :rtype: Digraph
+        """
+        codes, vertices = pd.factorize(np.concatenate([np.asarray(origins, dtype=object),
+                                                       np.asarray(destinations, dtype=object)]), sort=True)
+        rows, columns = codes[:len(origins)], codes[len(origins):]
+
+        arcs, latency = _merge_arcs(rows, columns, np.asarray(weights, dtype=ARCS_DTYPE), len(vertices), latency)
+        return Digraph(list(vertices), arcs, latency)
+
+    @staticmethod
+    def from_columnar(filename, latency=True):
+        """Make a digraph from a columnar file generated by URL flow backends. URLs dictionary is used as vertices,
+        so no URL is hashed while building the digraph.
+
+        :param filename: Columnar .npz file.
+        :type filename: str
+        :param latency: If true, aggregate arcs latency.
+        :type latency: bool
+        :return: Digraph.
+        :rtype: Digraph
+        """
+        columns = load_columnar(filename)
+        num_vertices = len(columns['urls'])
+        base = max(num_vertices, 1)
+
+        keys, inverse = np.unique(_arcs_keys(columns['referrer'], columns['request'], base), return_inverse=True)
+        inverse = inverse.ravel()
+        weights = np.bincount(inverse, minlength=len(keys)).astype(ARCS_DTYPE)
+        arcs_latency = LatencyAggregates.from_samples(inverse, columns['time'], len(keys)) if latency else None
 
-            # Get all vertices
-            reader = csv.reader(csvfile)
-            for (origin, destination) in reader:
-                vertices.add(origin)
-                vertices.add(destination)
+        arcs, arcs_latency = _merge_arcs(keys // base, keys % base, weights, num_vertices, arcs_latency)
+        return Digraph(columns['urls'], arcs, arcs_latency)
 
-            # Sort vertices
-            vertices = set(sorted(vertices))
+    @staticmethod
+    def from_backend(backend, regex=None, batch_size=100000, latency=True):
+        """Make a digraph directly from a URL flow backend, without any intermediate file. Each arc goes from the
+        referrer to the request of a hit, and request times are aggregated as arcs latency in the same pass.
+
+        :param backend: URL flow backend.
+        :type backend: performance_tools.urls_flow.backends.base.BaseURLFlowBackend
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param batch_size: Number of arcs accumulated before merging them into the digraph.
+        :type batch_size: int
+        :param latency: If true, aggregate arcs latency.
+        :type latency: bool
+        :return: Digraph.
+        :rtype: Digraph
+        """
+        builder = DigraphBuilder(batch_size, latency)
+        for result in backend:
+            for (_, referrer, request, time) in backend.extract_url_from_result(result, regex):
+                builder.add_arc(referrer, request, time=float(time) if latency else None)
 
-            # Return pointer to beginning
-            csvfile.seek(0)
+        return builder.build()
+
+
+class DigraphBuilder(object):
+    """Build a digraph incrementally. Vertices are indexed as soon as they appear and arcs are accumulated in
+    batches, so arcs can be consumed from any iterable in a single pass. Optionally, times of each arc are aggregated
+    as its latency.
+    """
+
+    def __init__(self, batch_size=100000, latency=False):
+        """DigraphBuilder init method.
+
+        :param batch_size: Number of arcs accumulated before merging them into the digraph.
+        :type batch_size: int
+        :param latency: If true, aggregate arcs latency from times.
+        :type latency: bool
+        """
+        self._batch_size = batch_size
+        self._with_latency = latency
 
-            # Create zeros array for arcs
-            arcs = np.zeros((len(vertices), len(vertices)), dtype=np.int8)
+        # Vertices
+        self._vertices = []
+        self._indexed_vertices = {}
+
+        # Pending arcs
+        self._origins = []
+        self._destinations = []
+        self._weights = []
+        self._times = []
+
+        # Merged arcs, stored as coordinates without duplicates
+        self._rows = np.empty(0, dtype=np.int64)
+        self._columns = np.empty(0, dtype=np.int64)
+        self._data = np.empty(0, dtype=ARCS_DTYPE)
+        self._latency = LatencyAggregates.from_samples([], [], 0) if latency else None
+
+    def add_vertex(self, vertex):
+        """Add a vertex if it doesn't exists.
+
+        :param vertex: Vertex name.
+        :type vertex: str
+        :return: Vertex index.
+        :rtype: int
+        """
+        try:
+            index = self._indexed_vertices[vertex]
+        except KeyError:
+            index = len(self._vertices)
+            self._indexed_vertices[vertex] = index
+            self._vertices.append(vertex)
 
-            # Index all vertices for fast accessing
-            indexed_vertices = {v: i for (i, v) in enumerate(vertices)}
+        return index
+
+    def add_arc(self, origin, destination, weight=1, time=None):
+        """Add an arc, adding its vertices if necessary. Weights of repeated arcs are summed up.
+
+        :param origin: Origin vertex name.
+        :type origin: str
+        :param destination: Destination vertex name.
+        :type destination: str
+        :param weight: Arc weight.
+        :type weight: int
+        :param time: Request time of this arc, None if it's missing.
+        :type time: float
+        """
+        self._origins.append(self.add_vertex(origin))
+        self._destinations.append(self.add_vertex(destination))
+        self._weights.append(weight)
+        if self._with_latency:
+            self._times.append(time)
+
+        if len(self._weights) >= self._batch_size:
+            self._merge()
+
+    def add_arcs(self, arcs):
+        """Add all arcs from an iterable of (origin, destination), (origin, destination, weight) or
+        (origin, destination, weight, time) tuples.
+
+        :param arcs: Arcs.
+        :type arcs: iter
+        """
+        for arc in arcs:
+            self.add_arc(*arc)
+
+    def _merge(self):
+        """Merge pending arcs into the accumulated ones.
+        """
+        if not self._weights:
+            return
+
+        latency = None
+        if self._with_latency:
+            samples = LatencyAggregates.from_samples(np.arange(len(self._times)), self._times, len(self._times))
+            latency = LatencyAggregates.concatenate([self._latency, samples])
+
+        arcs, self._latency = _merge_arcs(
+            np.concatenate((self._rows, np.array(self._origins, dtype=np.int64))),
+            np.concatenate((self._columns, np.array(self._destinations, dtype=np.int64))),
+            np.concatenate((self._data, np.array(self._weights, dtype=ARCS_DTYPE))),
+            len(self._vertices),
+            latency,
+        )
+        arcs = arcs.tocoo()
+
+        self._rows, self._columns, self._data = arcs.row.astype(np.int64), arcs.col.astype(np.int64), arcs.data
+        self._origins, self._destinations, self._weights, self._times = [], [], [], []
+
+    def build(self, sort=True):
+        """Build the digraph with all arcs added.
+
+        :param sort: If true, vertices will be indexed in lexicographic order instead of appearance order.
+        :type sort: bool
+        :return: Digraph.
+        :rtype: Digraph
+        """
+        self._merge()
 
-            # Store each arc (weight based)
-            reader = csv.reader(csvfile)
-            for (origin, destination) in reader:
-                arcs[indexed_vertices[origin], indexed_vertices[destination]] += 1
+        num_vertices = len(self._vertices)
+        vertices, rows, columns = self._vertices, self._rows, self._columns
+        if sort:
+            order = sorted(range(num_vertices), key=vertices.__getitem__)
+            new_indexes = np.empty(num_vertices, dtype=np.int64)
+            new_indexes[order] = np.arange(num_vertices)
+            vertices = [vertices[i] for i in order]
+            rows, columns = new_indexes[rows], new_indexes[columns]
 
-        return Digraph(vertices, arcs)
\ No newline at end of file
+        arcs, latency = _merge_arcs(rows, columns, self._data, num_vertices, self._latency)
+        return Digraph(vertices, arcs, latency)
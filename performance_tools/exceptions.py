@@ -12,4 +12,20 @@ class ProgressBarException(PerformanceException):
 
 
 class ElasticsearchException(PerformanceException):
-    pass
\ No newline at end of file
+    pass
+
+
+class DigraphException(PerformanceException):
+    pass
+
+
+class NginxException(PerformanceException):
+    pass
+
+
+class URLException(PerformanceException):
+    pass
+
+
+class SketchException(PerformanceException):
+    pass
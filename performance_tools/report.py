@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Batch rendering of static performance reports. Latency histograms of every route are binned at once, and charts
+and flow graphs are rendered without display by a pool of processes, so reports of thousands of routes can be
+generated unattended.
+"""
+
+from __future__ import unicode_literals, division
+
+import io
+import os
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from performance_tools.utils.histogram import HISTOGRAM_EDGES, binned_histograms
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Stats shown in report index
+REPORT_COLUMNS = ('Count By Week', 'Count By Day', 'Mean', 'Median', 'P95', 'P99')
+COUNT_COLUMNS = ('Count By Week',)
+
+# Stats marked in histograms, and their colors
+HISTOGRAM_MARKERS = (('Median', '#2196F3'), ('P95', '#FF9800'), ('P99', '#F44336'))
+
+INDEX_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; }}
+th, td {{ border: 1px solid #ddd; padding: 4px 8px; text-align: right; }}
+th:first-child, td:first-child {{ text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<p>{summary}</p>
+<table>
+<thead><tr>{header}</tr></thead>
+<tbody>
+{rows}
+</tbody>
+</table>
+</body>
+</html>
+"""
+
+
+def render_histogram(task):
+    """Render a histogram of pre-binned counts to an image file, without any display.
+
+    :param task: Output filename, title, count of each bin, bins edges and (label, value) markers.
+    :type task: tuple
+    :return: Output filename.
+    :rtype: str
+    """
+    filename, title, counts, edges, markers = task
+    figure = Figure(figsize=(8, 4))
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+
+    axes.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='g', alpha=0.6)
+    axes.set_xscale('log')
+    for (label, value, color) in markers:
+        axes.axvline(value, color=color, linewidth=1.5, label='{} = {:.3f}s'.format(label, value))
+
+    axes.set_title(title)
+    axes.set_xlabel('Time (s)')
+    axes.set_ylabel('Requests')
+    if markers:
+        axes.legend()
+
+    figure.savefig(filename)
+    return filename
+
+
+def _render(task):
+    """Render a chart or a graph in a worker process.
+    """
+    kind, arguments = task
+    if kind == 'graph':
+        # Drawing dependencies are only needed by graphs
+        from performance_tools.digraph import render_dot
+
+        return render_dot(arguments)
+
+    return render_histogram(arguments)
+
+
+def _format(column, value):
+    if np.isnan(value):
+        return '-'
+
+    return '{:d}'.format(int(value)) if column in COUNT_COLUMNS else '{:.3f}'.format(value)
+
+
+def write_report(directory, analyzer, digraph=None, workers=None, edges=None, min_count=1, top_arcs=20,
+                 graph_format='svg', title='Performance report'):
+    """Write a static report of all requests in a directory: a latency histogram of each request, the flow around it
+    if a digraph is given, and an index.html page with stats of each request linking all of them. Requests are
+    sorted by number of hits.
+
+    Histograms are the pre-binned counts of the analyzer, so analyzers that don't keep times, like streaming,
+    sharded or aggregated ones, are reported too.
+
+    :param directory: Output directory.
+    :type directory: str
+    :param analyzer: Analyzer of request times: RequestAnalyzer, StreamingRequestAnalyzer, ShardedRequestAnalyzer or
+    AggregatedRequestAnalyzer.
+    :type analyzer: object
+    :param digraph: Flow digraph. If given, the referrers and successors of each request are drawn.
+    :type digraph: performance_tools.digraph.Digraph
+    :param workers: Number of rendering processes, defaults to number of CPUs. If 1, all is rendered in this process.
+    :type workers: int
+    :param edges: Histogram bins edges, in seconds, of analyzers that bin times on demand (request and streaming
+    ones), defaults to HISTOGRAM_EDGES. Sharded and aggregated analyzers use the bins of their aggregates.
+    :type edges: numpy.array
+    :param min_count: Minimum number of hits of reported requests.
+    :type min_count: int
+    :param top_arcs: Maximum number of arcs drawn in each flow graph.
+    :type top_arcs: int
+    :param graph_format: Flow graphs file format, e.g: svg or png.
+    :type graph_format: str
+    :param title: Report title.
+    :type title: str
+    :return: Index filename.
+    :rtype: str
+    """
+    for subdirectory in ('histograms', 'graphs'):
+        if not os.path.isdir(os.path.join(directory, subdirectory)):
+            os.makedirs(os.path.join(directory, subdirectory))
+
+    stats = analyzer.stats_by_request()
+    histograms, edges = analyzer.latency_histograms() if edges is None else analyzer.latency_histograms(edges)
+    hits = histograms.values.sum(axis=1)
+    order = [i for i in np.argsort(-hits, kind='mergesort') if hits[i] >= min_count]
+
+    tasks, rows = [], []
+    for (n, i) in enumerate(order):
+        request = histograms.index[i]
+        request_stats = stats.loc[request] if request in stats.index else None
+        markers = [(label, request_stats[label], color) for (label, color) in HISTOGRAM_MARKERS
+                   if request_stats is not None and not np.isnan(request_stats[label])]
+        histogram = os.path.join('histograms', '{:05d}.png'.format(n))
+        tasks.append(('histogram', (os.path.join(directory, histogram), request, histograms.values[i], edges, markers)))
+
+        graph = None
+        if digraph is not None:
+            try:
+                neighborhood = digraph.neighborhood(request)
+            except KeyError:
+                # Request without arcs
+                neighborhood = None
+
+            if neighborhood is not None:
+                source = StringIO()
+                neighborhood.to_dot(source, top=top_arcs)
+                graph = os.path.join('graphs', '{:05d}.{}'.format(n, graph_format))
+                tasks.append(('graph', (source.getvalue(), os.path.join(directory, graph), 'dot')))
+
+        rows.append((request, request_stats, histogram, graph))
+
+    workers = workers or cpu_count()
+    if workers == 1:
+        for task in tasks:
+            _render(task)
+    else:
+        pool = Pool(workers)
+        try:
+            for _ in pool.imap_unordered(_render, tasks, chunksize=8):
+                pass
+        finally:
+            pool.terminate()
+
+    index = os.path.join(directory, 'index.html')
+    with io.open(index, 'w', encoding='utf-8') as f:
+        f.write(INDEX_TEMPLATE.format(
+            title=escape(title),
+            summary='{:d} requests, {:d} routes'.format(int(analyzer.number_of_requests()), len(rows)),
+            header=''.join('<th>{}</th>'.format(escape(c)) for c in ('Request',) + REPORT_COLUMNS +
+                           ('Histogram', 'Flow')),
+            rows='\n'.join(_index_row(*row) for row in rows),
+        ))
+
+    return index
+
+
+def _index_row(request, stats, histogram, graph):
+    cells = [escape(request)]
+    cells.extend(_format(c, stats[c]) if stats is not None else '-' for c in REPORT_COLUMNS)
+    cells.append('<a href="{0}"><img src="{0}" width="240"></a>'.format(escape(histogram.replace(os.sep, '/'))))
+    cells.append('<a href="{}">flow</a>'.format(escape(graph.replace(os.sep, '/'))) if graph is not None else '-')
+    return '<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(c) for c in cells))
@@ -1,58 +1,122 @@
 from collections import OrderedDict
 
 import numpy as np
+import pandas as pd
 from scipy import stats
 import matplotlib.pyplot as plt
 
+from performance_tools.utils.selection import CHUNK_SIZE, iter_chunks, select, summary, trimmed_moments
+
 
 class Distribution(object):
-    def __init__(self, data, spurious=0.1):
+    def __init__(self, data, spurious=0.1, chunk_size=CHUNK_SIZE):
         """Store time series and remove spurious data.
 
-        :param data: Time series data.
-        :type data: numpy.array
-        :param spurious: Spurious data coefficient.
+        Data isn't sorted nor copied: spurious data is removed selecting the values at the cut points, and stats are
+        calculated in a single pass over the remaining values, so memory-mapped arrays or lists of chunks larger than
+        memory can be used.
+
+        :param data: Time series data: array, memory-mapped array or list of arrays.
+        :type data: numpy.array or list
+        :param spurious: Spurious data coefficient (0-1), half of it is removed from each tail. 1 keeps all data.
         :type spurious: float
+        :param chunk_size: Number of values read at once.
+        :type chunk_size: int
         """
-        if spurious < 1:
-            self.data = self._remove_spurious(data, spurious)
-        elif spurious < 0 or spurious > 1:
-            raise AttributeError
-        else:
-            self.data = np.sort(data)
+        if spurious < 0 or spurious > 1:
+            raise AttributeError("Spurious data coefficient must be between 0 and 1")
 
-        self.mu, self.std, self.median, self.max, self.min = self._statistical_data()
+        self._source = data
+        self._chunk_size = chunk_size
+        self._data = None
 
-    def _remove_spurious(self, data, spurious=0.1):
-        spurious_coefficient = spurious / 2
-        num_spurious = int(len(data) * spurious_coefficient)
-        return np.sort(data)[num_spurious:-num_spurious]
+        self._count, minimum, maximum = summary(data, chunk_size)
+        if not self._count:
+            raise AttributeError("Time series is empty")
 
-    def _statistical_data(self):
-        mu, std = stats.norm.fit(self.data)
-        median = self.data[len(self.data) / 2]
-        max_ = self.data[-1]
-        min_ = self.data[0]
+        self._trim = self._num_spurious(self._count, spurious)
+        self.mu, self.std, self.median, self.max, self.min = self._statistical_data(minimum, maximum)
+
+    @staticmethod
+    def _num_spurious(count, spurious=0.1):
+        """Number of values removed from each tail.
+        """
+        if spurious == 1:
+            return 0
+
+        return int(count * spurious / 2)
+
+    def _statistical_data(self, minimum, maximum):
+        kept = self._count - 2 * self._trim
+        min_, median, max_ = select(self._source, [self._trim, self._trim + kept // 2, self._count - self._trim - 1],
+                                    (self._count, minimum, maximum), self._chunk_size)
+        _, mu, std = trimmed_moments(self._source, self._trim, min_, max_, self._count, self._chunk_size)
 
         return mu, std, median, max_, min_
 
-    def plot(self, normal=True, pareto=True):
+    def _chunks(self):
+        """Iterate over chunks of data without spurious values. Values equal to the cut points are kept as many times as
+        their positions between spurious ones.
+        """
+        if self.min == self.max:
+            yield np.full(self._count - 2 * self._trim, self.min)
+            return
+
+        not_above_min = below_max = 0
+        for chunk in iter_chunks(self._source, self._chunk_size):
+            not_above_min += np.count_nonzero(chunk <= self.min)
+            below_max += np.count_nonzero(chunk < self.max)
+
+        yield np.full(not_above_min - self._trim, self.min)
+        yield np.full(self._count - self._trim - below_max, self.max)
+        for chunk in iter_chunks(self._source, self._chunk_size):
+            yield chunk[(chunk > self.min) & (chunk < self.max)]
+
+    @property
+    def data(self):
+        """Sorted data without spurious values. It's built only when requested, so it needs memory for all of them.
+        """
+        if self._data is None:
+            self._data = np.sort(np.concatenate(list(self._chunks())))
+
+        return self._data
+
+    def histogram(self, bins=25):
+        """Calculate the histogram of data without spurious values, reading data in chunks.
+
+        :param bins: Number of bins.
+        :type bins: int
+        :return: Count of each bin and bins edges.
+        :rtype: tuple
+        """
+        edges = np.linspace(self.min, self.max, bins + 1) if self.min < self.max else \
+            np.array([self.min - 0.5, self.min + 0.5])
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for chunk in self._chunks():
+            counts += np.histogram(chunk, edges)[0]
+
+        return counts, edges
+
+    def plot(self, normal=True, pareto=True, filename=None):
         """Plot data.
 
         :param normal: If true, plot normal distribution.
         :type normal: bool
         :param pareto: If true, plot pareto distribution (80-20 law).
         :type pareto: bool
+        :param filename: If given, plot is saved to this file instead of being shown.
+        :type filename: str
         """
         if pareto:
             pareto = 1.161
 
         # Plot the histogram.
-        plt.hist(self.data, bins=25, normed=True, alpha=0.6, color='g')
+        counts, edges = self.histogram(bins=25)
+        plt.hist(edges[:-1], bins=edges, weights=counts, density=True, alpha=0.6, color='g')
 
         # Plot normal PDF.
         xmin, xmax = plt.xlim()
-        grid_granularity = 100 if len(self.data) > 100 else len(self.data)
+        grid_granularity = 100 if self._count - 2 * self._trim > 100 else self._count - 2 * self._trim
         x = np.linspace(xmin, xmax, grid_granularity)
         if normal:
             norm_pdf = stats.norm.pdf(x, self.mu, self.std)
@@ -67,7 +131,11 @@ class Distribution(object):
         plt.title(title)
 
         plt.legend()
-        plt.show()
+        if filename is not None:
+            plt.savefig(filename)
+            plt.close()
+        else:
+            plt.show()
 
     def __repr__(self):
         return "Max: {}\nMin: {}\nMean: {}\nStandard Deviation: {}\nMedian: {}".format(
@@ -75,37 +143,117 @@ class Distribution(object):
         )
 
 
+# Default classes of times, by their upper bound in seconds. The class without bound contains the remaining times.
+DEFAULT_CLASSES = {
+    'excellent': 0.4,
+    'good': 1.0,
+    'ok': 1.5,
+    'bad': 3.0,
+    'ugly': None,
+}
+
+
 class Classification(object):
     def __init__(self, data, **classes):
-        """Classify time series.
+        """Classify time series. Each time belongs to the class with the lowest upper bound greater than it, or to the
+        class without bound.
 
         :param data: Time series data.
         :type data: numpy.array
-        :keyword classes: Classes and values.
+        :keyword classes: Classes and their upper bounds, one of them without bound (None).
         """
         if len(classes) == 0:
-            classes = {
-                'excellent': 0.4,
-                'good': 1.0,
-                'ok': 1.5,
-                'bad': 3.0,
-                'ugly': None,
-            }
-
-        self.classes = OrderedDict(sorted(classes.items(), key=lambda t: t[1], reverse=True))
-        self.data = np.sort(data)
+            classes = DEFAULT_CLASSES
+
+        self.classes = self._sorted_classes(classes)
+        self.data = np.asarray(data, dtype=np.float64)
         self.classified_data = self._classify()
 
+    @staticmethod
+    def _sorted_classes(classes):
+        """Sort classes by upper bound, with the class without bound at the end.
+        """
+        classes = OrderedDict(sorted(classes.items(), key=lambda t: (t[1] is None, t[1])))
+        if None not in classes.values():
+            raise AttributeError("Classes must contain a class without upper bound (None)")
+
+        return classes
+
+    @staticmethod
+    def _bounds(classes):
+        return np.array([v for v in classes.values() if v is not None], dtype=np.float64)
+
+    @staticmethod
+    def _class_codes(times, bounds):
+        """Class of each time, as the position of its class in sorted classes.
+        """
+        return np.searchsorted(bounds, times, side='right')
+
     def _classify(self):
-        result = {k: 0 for k in self.classes.keys()}
+        times = self.data[~np.isnan(self.data)]
+        counts = np.bincount(self._class_codes(times, self._bounds(self.classes)), minlength=len(self.classes))
+        return OrderedDict(zip(self.classes.keys(), counts.tolist()))
+
+    @staticmethod
+    def _apdex_zones(times, threshold):
+        """Apdex zone of each time: satisfied (0) up to threshold, tolerating (1) up to four times threshold and
+        frustrated (2) beyond it.
+        """
+        return np.searchsorted(np.array([threshold, 4 * threshold], dtype=np.float64), times, side='left')
+
+    def apdex(self, threshold):
+        """Calculate the Apdex score: satisfied times plus half of tolerating times, divided by all times.
+
+        :param threshold: Satisfied time threshold (T), in seconds.
+        :type threshold: float
+        :return: Apdex score (0-1), NaN if there are no times.
+        :rtype: float
+        """
+        times = self.data[~np.isnan(self.data)]
+        if not len(times):
+            return np.nan
+
+        zones = np.bincount(self._apdex_zones(times, threshold), minlength=3)
+        return (zones[0] + zones[1] / 2.) / len(times)
+
+    @classmethod
+    def by_group(cls, data, by='Request', column='Time', apdex=None, **classes):
+        """Classify times of all groups at once, like routes of a URL flow.
+
+        :param data: Data with times and grouping columns.
+        :type data: pandas.DataFrame
+        :param by: Grouping columns.
+        :type by: str or list
+        :param column: Times column.
+        :type column: str
+        :param apdex: Satisfied time threshold (T) of Apdex score, in seconds. If not given, score isn't calculated.
+        :type apdex: float
+        :keyword classes: Classes and their upper bounds, one of them without bound (None).
+        :return: Number of times of each class and optionally Apdex score, by group.
+        :rtype: pandas.DataFrame
+        """
+        classes = cls._sorted_classes(classes or DEFAULT_CLASSES)
+
+        grouped = data.groupby(by, sort=True, observed=True)
+        index = grouped.size().index
+        groups = grouped.ngroup().values
+        times = data[column].values.astype(np.float64)
+
+        # Times without group or without value are ignored
+        valid = ~np.isnan(times) & ~pd.isnull(groups)
+        groups, times = groups[valid].astype(np.int64), times[valid]
 
-        for data in self.data:
-            current_klass = None
-            for klass, max_value in ((k, v) for k, v in self.classes.items()):
-                if data < max_value or (current_klass is None and max_value is None):
-                    current_klass = klass
+        codes = groups * len(classes) + cls._class_codes(times, cls._bounds(classes))
+        counts = np.bincount(codes, minlength=len(index) * len(classes)).reshape((len(index), len(classes)))
+        result = pd.DataFrame(counts, index=index, columns=list(classes.keys()))
 
-            result[current_klass] += 1
+        if apdex is not None:
+            zones = np.bincount(groups * 3 + cls._apdex_zones(times, apdex), minlength=len(index) * 3)
+            zones = zones.reshape((len(index), 3))
+            total = zones.sum(axis=1)
+            score = np.full(len(index), np.nan)
+            np.divide(zones[:, 0] + zones[:, 1] / 2., total, out=score, where=total > 0)
+            result['Apdex'] = score
 
         return result
 
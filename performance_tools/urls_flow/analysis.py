@@ -3,43 +3,106 @@
 import pandas as pd
 import numpy as np
 import os
+import shutil
+import tempfile
+import zlib
 from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+import re
+import warnings
+from pandas.tseries.frequencies import to_offset
+from performance_tools.exceptions import ElasticsearchException
 from performance_tools.urls_flow.backends import ElasticURLFlowBackend
+from performance_tools.urls_flow.backends.elasticsearch import PERCENTS
+from performance_tools.urls_flow.stats import grouped_time_stats, grouped_mann_whitney, grouped_bootstrap_quantile, \
+    sorted_group_quantiles
+from performance_tools.utils.columnar import ColumnarWriter, read_columnar, read_csv, load_columnar, encode_strings, \
+    decode_strings, parse_timestamps, is_columnar_file, string_types
+from performance_tools.utils.histogram import QuantileSketch, LatencyAggregates, LATENCY_EDGES, HISTOGRAM_EDGES, \
+    binned_histograms, bucket_edges
+from performance_tools.utils.url import get_normalizer
+
+# Days of a working week, assumed when data has no timestamps
+DEFAULT_DAYS = 5
+
+NAT = np.iinfo(np.int64).min
+
+# Seconds of Elasticsearch interval units
+INTERVAL_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def number_of_days(first, last):
+    """Number of days covered by a range of timestamps, at least one.
+
+    :param first: First timestamp, as datetime or milliseconds since epoch.
+    :type first: datetime or int
+    :param last: Last timestamp, as datetime or milliseconds since epoch.
+    :type last: datetime or int
+    :return: Number of days, or default days if any timestamp is missing.
+    :rtype: float
+    """
+    if first is None or last is None or pd.isnull(first) or pd.isnull(last):
+        return DEFAULT_DAYS
+
+    if isinstance(first, (int, np.integer)):
+        first, last = np.datetime64(int(first), 'ms'), np.datetime64(int(last), 'ms')
+
+    return max(float(np.ceil((last - first) / np.timedelta64(1, 'D'))), 1.)
 
 
 class RequestAnalyzer(object):
     """Class that gathers and analyze a web application based on his url's request time.
     """
 
-    def __init__(self, input_file, noise=0.1):
+    def __init__(self, input_file, noise=0.1, chunksize=None, cache=False):
         """RequestAnalysis init method.
 
-        :param input_file: Input CSV file.
-        :type input_file: str
+        :param input_file: Input CSV file or columnar .npz file, path or file object.
+        :type input_file: str or file
         :param noise: Percentage of data that will be considered noise (0-1).
         :type noise: float
+        :param chunksize: If given, CSV file is read in chunks of this number of rows, keeping only needed columns
+        with compact types: categorical URLs, timestamps and single precision times.
+        :type chunksize: int
+        :param cache: If true, CSV file is read in chunks and the result is cached in a sidecar file that is reused
+        while CSV file doesn't change.
+        :type cache: bool
         """
         self._noise = noise
         self._lower_quantile = self._noise / 2
         self._upper_quantile = 1 - (self._noise / 2)
-        self._data = pd.read_csv(input_file)
+        if is_columnar_file(input_file):
+            self._data = read_columnar(input_file)
+        elif chunksize or cache:
+            self._data = read_csv(input_file, chunksize or 100000, cache)
+        else:
+            self._data = pd.read_csv(input_file)
 
-        self._functions = OrderedDict((
+        self._timeline = None
+        self._functions = self._default_functions()
+        # Default functions are calculated for all groups at once, custom ones group by group
+        self._vectorized_functions = dict(self._functions)
+
+    def _default_functions(self):
+        return OrderedDict((
             ('Count By Week', len),
-            ('Count By Day', lambda x: len(x) / 5),
+            ('Count By Day', lambda x: len(x) / self.number_of_days()),
             ('Mean', np.mean),
             ('Std', np.std),
             ('Max', np.max),
             ('Min', np.min),
             ('Sum', np.sum),
             ('Median', np.median),
+            ('P90', lambda x: x.quantile(0.9)),
+            ('P95', lambda x: x.quantile(0.95)),
+            ('P99', lambda x: x.quantile(0.99)),
         ))
 
     @classmethod
     def from_elasticsearch(cls, output_file, host, port, query, date_from, date_to, size=50, regex=None):
         """Gather all data from Elasticsearch source.
 
-        :param output_file: Output csv file for gathered data.
+        :param output_file: Output file for gathered data, csv or columnar if its extension is .npz.
         :type output_file: str
         :param host: Elasticsearch host.
         :type host: str
@@ -53,14 +116,17 @@ class RequestAnalyzer(object):
         :type date_to: str
         :param size: Query block size.
         :type size: int
-        :param regex: Regular expression to parse URLs gathered.
-        :type regex: re
+        :param regex: Regular expression to parse URLs gathered or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
         :return: Analysis object constructed.
         :rtype: RequestAnalysis
         """
         output_file_path = os.path.realpath(os.path.join(os.path.curdir, output_file))
         es = ElasticURLFlowBackend(host=host, port=port, query=query, date_from=date_from, date_to=date_to, size=size)
-        es.to_csv(output_file_path, regex=regex, verbose=2)
+        if is_columnar_file(output_file_path):
+            es.to_columnar(output_file_path, regex=regex, verbose=2)
+        else:
+            es.to_csv(output_file_path, regex=regex, verbose=2)
         return cls(output_file_path)
 
     @property
@@ -77,6 +143,98 @@ class RequestAnalyzer(object):
         """
         return self._data['Request'].count()
 
+    def _timestamps(self):
+        """Get timestamps of all rows as datetimes, NaT if they are missing or invalid.
+
+        :return: Timestamps.
+        :rtype: numpy.array
+        """
+        if 'Timestamp' not in self._data:
+            return np.full(len(self._data), NAT, dtype=np.int64).astype('datetime64[ms]')
+
+        timestamps = self._data['Timestamp']
+        if timestamps.dtype.kind == 'M':
+            return timestamps.values
+
+        # CSV files read without chunks keep ISO 8601 strings
+        return parse_timestamps(timestamps.values).astype('datetime64[ms]')
+
+    def timeline(self):
+        """Get request and time of rows, indexed and sorted by timestamp. Rows without timestamp are ignored. Index is
+        built only once, and reused by all time series.
+
+        :return: Requests and times.
+        :rtype: pandas.DataFrame
+        """
+        if self._timeline is None:
+            timestamps = self._timestamps()
+            valid = ~pd.isnull(timestamps)
+            timeline = pd.DataFrame({
+                'Request': self._data['Request'].values[valid],
+                'Time': self._data['Time'].values[valid],
+            }, index=pd.DatetimeIndex(timestamps[valid], name='Timestamp'), columns=['Request', 'Time'])
+            self._timeline = timeline.sort_index(kind='mergesort')
+
+        return self._timeline
+
+    def number_of_days(self):
+        """Gets the number of days covered by data.
+
+        :return: Number of days, at least one, or five if data has no timestamps.
+        :rtype: float
+        """
+        index = self.timeline().index
+        if not len(index):
+            return DEFAULT_DAYS
+
+        return number_of_days(index[0], index[-1])
+
+    def time_series(self, freq='1h', by_request=False, requests=None, rolling=None, percentiles=(0.5, 0.95, 0.99)):
+        """Calculate throughput and time stats in windows of time, to correlate time spikes with load or deploys.
+
+        Fixed windows are calculated grouping the sorted timeline by period. Rolling windows are calculated over the
+        timeline, ending at each row, and then sampled at the end of each period. Neither filters rows of each window.
+
+        :param freq: Fixed frequency of windows, or of samples of rolling windows, e.g: '1min', '1h' or '1D'.
+        :type freq: str
+        :param by_request: If true, windows of each request are calculated.
+        :type by_request: bool
+        :param requests: Requests to analyze, all of them by default.
+        :type requests: list
+        :param rolling: Fixed length of rolling windows, e.g: '15min'. If not given, fixed windows are used.
+        :type rolling: str
+        :param percentiles: Percentiles (0-1).
+        :type percentiles: iter
+        :return: Count, throughput (requests per second), mean and percentiles of times of each window, indexed by
+        timestamp or by request and timestamp.
+        :rtype: pandas.DataFrame
+        """
+        timeline = self.timeline()
+        if requests is not None:
+            timeline = timeline[timeline['Request'].isin(list(requests))]
+        seconds = to_offset(rolling or freq).nanos / 1e9
+
+        if rolling is None:
+            keys = (['Request'] if by_request else []) + [pd.Grouper(freq=freq)]
+            windows = timeline.groupby(keys, observed=True)['Time']
+        elif by_request:
+            windows = timeline.groupby('Request', observed=True)['Time'].rolling(rolling)
+        else:
+            windows = timeline['Time'].rolling(rolling)
+
+        stats = OrderedDict((('Count', windows.count()), ('Mean', windows.mean())))
+        for q in percentiles:
+            stats['P{:g}'.format(q * 100)] = windows.quantile(q)
+        series = pd.DataFrame(stats, columns=list(stats.keys()))
+
+        if rolling is not None:
+            # Sample rolling windows that end at the last row of each period
+            keys = ([pd.Grouper(level='Request')] if by_request else []) + [pd.Grouper(level='Timestamp', freq=freq)]
+            series = series.groupby(keys, observed=True).last()
+
+        series.insert(1, 'Throughput', series['Count'] / seconds)
+        return series
+
     def time_stats(self):
         """Calculate global time stats: sum, mean, standard deviation, min and max.
 
@@ -97,11 +255,13 @@ class RequestAnalyzer(object):
 
         return pd.DataFrame(stats.values(), index=stats.keys(), columns=['Time'])
 
-    def _get_stats(self, df):
+    def _get_stats(self, df, functions=None):
         """Auxiliary function to extract relevant stats from analysis data.
 
         :param df: DataFrame.
         :type df: pandas.DataFrame
+        :param functions: Functions to apply, all of them by default.
+        :type functions: OrderedDict
         :return: Relevant stats calculated.
         :rtype: pandas.Series
         """
@@ -109,30 +269,775 @@ class RequestAnalyzer(object):
         df = df[df.Time <= df.Time.quantile(self._upper_quantile)]
         values = []
         index = []
-        for i, f in self._functions.items():
+        for i, f in (functions if functions is not None else self._functions).items():
             values.append(f(df.Time))
             index.append(i)
         return pd.Series(values, index=index)
 
+    def _grouped_stats(self, by):
+        """Calculate relevant stats of all groups, with the same results as applying _get_stats to each group.
+        Default functions are calculated for all groups at once, and only custom functions are applied group by
+        group.
+
+        :param by: Grouping columns.
+        :type by: str or list
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        stats = grouped_time_stats(self._data, by, self._lower_quantile, self._upper_quantile,
+                                   days=self.number_of_days())
+
+        custom = OrderedDict((name, f) for (name, f) in self._functions.items()
+                             if self._vectorized_functions.get(name) is not f)
+        if custom:
+            custom_stats = self._data.groupby(by, sort=True, observed=True)[['Time']].apply(
+                lambda df: self._get_stats(df, custom))
+            stats = pd.concat([stats.drop(columns=[c for c in custom if c in stats]),
+                               custom_stats.reindex(stats.index)], axis=1)
+
+        return stats[list(self._functions.keys())]
+
+    def stats_by_request(self):
+        """Extract relevant stats grouped by request.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        return self._grouped_stats('Request')
+
+    def stats_by_request_and_referrer(self):
+        """Extract relevant stats grouped by request and referrer.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        return self._grouped_stats(['Request', 'Referrer'])
+
+    def latency_histograms(self, edges=HISTOGRAM_EDGES):
+        """Count times of each request in histogram bins.
+
+        :param edges: Bins edges, in seconds. Times out of edges are counted in first and last bins.
+        :type edges: numpy.array
+        :return: Count of each bin by request, and bins edges.
+        :rtype: tuple
+        """
+        return binned_histograms(self._data, 'Request', 'Time', edges), edges
+
+    def classify(self, by_referrer=False, apdex=None, **classes):
+        """Classify times of each request, or of each request and referrer, into SLA classes. Noise isn't removed.
+
+        :param by_referrer: If true, times are classified by request and referrer.
+        :type by_referrer: bool
+        :param apdex: Satisfied time threshold (T) of Apdex score, in seconds. If not given, score isn't calculated.
+        :type apdex: float
+        :keyword classes: Classes and their upper bounds, one of them without bound (None).
+        :return: Number of times of each class and optionally Apdex score.
+        :rtype: pandas.DataFrame
+        """
+        # Plotting dependencies are only needed by time series classes
+        from performance_tools.times import Classification
+
+        return Classification.by_group(self._data, ['Request', 'Referrer'] if by_referrer else 'Request', 'Time',
+                                       apdex, **classes)
+
+
+class StreamingRequestAnalyzer(object):
+    """Analyze request times online, while they are extracted from a backend. Times of each request, and optionally
+    of each request and referrer, are aggregated in mergeable quantile sketches, so memory doesn't grow with the
+    number of rows and analyzers of different days or machines can be merged.
+
+    Stats aren't trimmed of noise, and quantiles are estimated with a bounded relative error.
+    """
+
+    def __init__(self, by_referrer=False, relative_accuracy=0.01):
+        """StreamingRequestAnalyzer init method.
+
+        :param by_referrer: If true, times are also aggregated by request and referrer.
+        :type by_referrer: bool
+        :param relative_accuracy: Maximum relative error of quantiles (0-1).
+        :type relative_accuracy: float
+        """
+        self._by_referrer = by_referrer
+        self._relative_accuracy = relative_accuracy
+
+        # URLs dictionary and (request, referrer) codes of each pair
+        self._urls = {}
+        self._pairs = {}
+
+        self._requests_sketch = QuantileSketch(relative_accuracy)
+        self._pairs_sketch = QuantileSketch(relative_accuracy) if by_referrer else None
+
+        # First and last timestamps, in milliseconds since epoch
+        self._first = None
+        self._last = None
+
+    @classmethod
+    def from_backend(cls, backend, regex=None, by_referrer=False, relative_accuracy=0.01):
+        """Analyze all rows of a backend, without any intermediate file.
+
+        :param backend: URL flow backend.
+        :type backend: performance_tools.urls_flow.backends.base.BaseURLFlowBackend
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param by_referrer: If true, times are also aggregated by request and referrer.
+        :type by_referrer: bool
+        :param relative_accuracy: Maximum relative error of quantiles (0-1).
+        :type relative_accuracy: float
+        :return: Analyzer.
+        :rtype: StreamingRequestAnalyzer
+        """
+        analyzer = cls(by_referrer, relative_accuracy)
+        for result in backend:
+            analyzer.update(backend.extract_url_from_result(result, regex))
+
+        return analyzer
+
+    def _encode(self, urls):
+        """Get the code of each URL, adding new ones to the dictionary. Missing URLs are -1.
+        """
+        codes, uniques = pd.factorize(np.asarray(urls, dtype=object))
+        mapping = np.array([self._urls.setdefault(url, len(self._urls)) for url in uniques] + [-1], dtype=np.int64)
+        return mapping[codes]
+
+    def _encode_pairs(self, requests, referrers):
+        pairs, inverse = np.unique(requests * len(self._urls) + referrers, return_inverse=True)
+        mapping = np.array([self._pairs.setdefault(divmod(int(pair), len(self._urls)), len(self._pairs))
+                            for pair in pairs], dtype=np.int64)
+        return mapping[inverse.ravel()]
+
+    def update(self, rows):
+        """Aggregate a batch of rows.
+
+        :param rows: List of (timestamp, referrer, request, time) rows.
+        :type rows: list
+        """
+        if not rows:
+            return
+
+        timestamps, referrers, requests, times = zip(*rows)
+        timestamps = parse_timestamps(timestamps)
+        timestamps = timestamps[timestamps != NAT]
+        if len(timestamps):
+            self._update_range(int(timestamps.min()), int(timestamps.max()))
+
+        requests = self._encode(requests)
+        times = np.array(times, dtype=float)
+
+        # Rows without request, or without referrer when aggregated by referrer, are ignored
+        valid = requests >= 0
+        self._requests_sketch.add(requests[valid], times[valid])
+
+        if self._by_referrer:
+            referrers = self._encode(referrers)
+            valid &= referrers >= 0
+            self._pairs_sketch.add(self._encode_pairs(requests[valid], referrers[valid]), times[valid])
+
+    def _update_range(self, first, last):
+        """Extend the range of timestamps of aggregated rows.
+
+        :param first: First timestamp, in milliseconds since epoch.
+        :type first: int
+        :param last: Last timestamp, in milliseconds since epoch.
+        :type last: int
+        """
+        if first is None:
+            return
+
+        self._first = first if self._first is None else min(self._first, first)
+        self._last = last if self._last is None else max(self._last, last)
+
+    def merge(self, other):
+        """Merge the aggregates of other analyzer into this one.
+
+        :param other: Analyzer with the same relative accuracy.
+        :type other: StreamingRequestAnalyzer
+        """
+        self._update_range(other._first, other._last)
+
+        mapping = self._encode(self._ordered(other._urls))
+        self._requests_sketch.merge(other._requests_sketch, mapping[:len(other._requests_sketch)])
+
+        if self._by_referrer and other._by_referrer:
+            pairs = np.array(self._ordered(other._pairs), dtype=np.int64).reshape((-1, 2))
+            keys = self._encode_pairs(mapping[pairs[:, 0]], mapping[pairs[:, 1]])
+            self._pairs_sketch.merge(other._pairs_sketch, keys[:len(other._pairs_sketch)])
+
+    @staticmethod
+    def _ordered(dictionary):
+        """Get the keys of a dictionary ordered by their values.
+        """
+        keys = [None] * len(dictionary)
+        for (key, value) in dictionary.items():
+            keys[value] = key
+
+        return keys
+
+    def number_of_requests(self):
+        """Gets the number of aggregated requests.
+
+        :return: Number of requests.
+        :rtype: int
+        """
+        return int(self._requests_sketch.count.sum())
+
+    def number_of_days(self):
+        """Gets the number of days covered by aggregated rows.
+
+        :return: Number of days, at least one, or five if rows have no timestamps.
+        :rtype: float
+        """
+        return number_of_days(self._first, self._last)
+
+    def _stats(self, sketch, index):
+        stats = sketch.to_frame(index)
+        stats = stats[stats['Count'] > 0].sort_index()
+        stats.insert(1, 'Count By Day', stats['Count'] / self.number_of_days())
+        return stats.rename(columns={'Count': 'Count By Week'})
+
+    def stats_by_request(self):
+        """Extract relevant stats grouped by request.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        urls = self._ordered(self._urls)[:len(self._requests_sketch)]
+        return self._stats(self._requests_sketch, pd.Index(urls, name='Request'))
+
+    def stats_by_request_and_referrer(self):
+        """Extract relevant stats grouped by request and referrer.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        if not self._by_referrer:
+            raise ValueError("Analyzer doesn't aggregate times by referrer")
+
+        urls = self._ordered(self._urls)
+        pairs = self._ordered(self._pairs)[:len(self._pairs_sketch)]
+        index = pd.MultiIndex.from_tuples([(urls[request], urls[referrer]) for (request, referrer) in pairs],
+                                          names=['Request', 'Referrer'])
+        return self._stats(self._pairs_sketch, index)
+
+    def latency_histograms(self, edges=HISTOGRAM_EDGES):
+        """Count times of each request in histogram bins, from the buckets of its sketch.
+
+        :param edges: Bins edges, in seconds, wider than sketch buckets. Times out of edges are counted in first and
+        last bins.
+        :type edges: numpy.array
+        :return: Count of each bin by request, and bins edges.
+        :rtype: tuple
+        """
+        urls = self._ordered(self._urls)[:len(self._requests_sketch)]
+        histograms = pd.DataFrame(self._requests_sketch.histogram(edges), index=pd.Index(urls, name='Request'),
+                                  columns=edges[:-1])
+        return histograms[self._requests_sketch.count > 0].sort_index(), edges
+
+    def save(self, filename):
+        """Save aggregates in a .npz file.
+
+        :param filename: Output file.
+        :type filename: str
+        """
+        buffer, offsets = encode_strings(self._ordered(self._urls))
+        arrays = {'urls': buffer, 'url_offsets': offsets}
+        if self._first is not None:
+            arrays['timestamp_range'] = np.array([self._first, self._last], dtype=np.int64)
+        arrays.update({'requests_' + k: v for (k, v) in self._requests_sketch.to_arrays().items()})
+        if self._by_referrer:
+            arrays['pairs'] = np.array(self._ordered(self._pairs), dtype=np.int64).reshape((-1, 2))
+            arrays.update({'pairs_' + k: v for (k, v) in self._pairs_sketch.to_arrays().items()})
+
+        with open(filename, 'wb') as output:
+            np.savez(output, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load aggregates saved in a .npz file.
+
+        :param filename: Input file.
+        :type filename: str
+        :return: Analyzer.
+        :rtype: StreamingRequestAnalyzer
+        """
+        with np.load(filename) as arrays:
+            requests_sketch = QuantileSketch.from_arrays({k[len('requests_'):]: arrays[k] for k in arrays.files
+                                                         if k.startswith('requests_')})
+            analyzer = cls('pairs' in arrays.files, requests_sketch.relative_accuracy)
+            analyzer._urls = {url: i for (i, url) in enumerate(decode_strings(arrays['urls'], arrays['url_offsets']))}
+            analyzer._requests_sketch = requests_sketch
+            if 'timestamp_range' in arrays.files:
+                analyzer._update_range(*[int(t) for t in arrays['timestamp_range']])
+            if 'pairs' in arrays.files:
+                analyzer._pairs = {(int(r), int(f)): i for (i, (r, f)) in enumerate(arrays['pairs'])}
+                analyzer._pairs_sketch = QuantileSketch.from_arrays({k[len('pairs_'):]: arrays[k] for k in arrays.files
+                                                                    if k.startswith('pairs_')})
+
+        return analyzer
+
+
+def _time_aggregates(bucket, percents):
+    """Get count, sum, min, max, sum of squares and percentiles of response times of an aggregation bucket.
+    """
+    time = bucket['time']
+    percentiles = {float(k): v for (k, v) in bucket['percentiles']['values'].items()}
+    return [time['count'], time['sum'] or 0., time['min'], time['max'], time['sum_of_squares'] or 0.] + \
+        [percentiles.get(float(p)) for p in percents]
+
+
+class AggregatedRequestAnalyzer(object):
+    """Analyze request times aggregated by Elasticsearch, so only a few kilobytes of stats are transferred instead of
+    every hit. Stats by request, stats by request and referrer and the digraph of the flow have the same shape as
+    the ones calculated from hits.
+
+    URLs are normalized once aggregated, so aggregates of URLs normalized into the same one are merged: counts, sums,
+    min and max are the ones of their buckets, but percentiles are the mean of their percentiles weighted by count.
+    Stats aren't trimmed of noise.
+
+    Terms aggregations only return the most frequent requests, and the most frequent referrers of each request, so
+    hits of the rest are left out of stats by request, or of stats by request and referrer and the digraph, and
+    counts near the cut-off can be underestimated in clusters of many shards. Hits left out are reported by
+    missing_hits, and a warning is issued, or an exception raised if strict. Aggregating raw URLs with id's spreads
+    the traffic of a route over many terms, so a larger size, or a field of normalized URLs, may be needed.
+    """
+
+    def __init__(self, result, regex=None, interval='1d', percents=PERCENTS, strict=False):
+        """AggregatedRequestAnalyzer init method.
+
+        :param result: Search result with aggregations, as returned by ElasticURLFlowBackend.aggregate.
+        :type result: dict
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param interval: Date histogram interval of the result.
+        :type interval: str
+        :param percents: Percentiles of the result (0-100).
+        :type percents: iter
+        :param strict: If true, raise an exception if any hit is left out of aggregations, instead of a warning.
+        :type strict: bool
+        :raise ElasticsearchException: If strict and terms aggregations are truncated.
+        """
+        self._result = result
+        self._regex = regex
+        self._interval = interval
+        self._percents = tuple(percents)
+        self._parse()
+        self._check_truncation(strict)
+
+    @classmethod
+    def from_elasticsearch(cls, host, port, query, date_from, date_to, regex=None, size=10000, interval='1d',
+                           referrers_size=10, strict=False, **fields):
+        """Aggregate request times in Elasticsearch.
+
+        :param host: Elasticsearch host.
+        :type host: str
+        :param port: Elasticsearch port.
+        :type port: int
+        :param query: Elastisearch query to be executed.
+        :type query: str
+        :param date_from: Query initial date.
+        :type date_from: str
+        :param date_to: Query end date.
+        :type date_to: str
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param size: Maximum number of requests aggregated.
+        :type size: int
+        :param interval: Date histogram interval, e.g: '1m', '1h' or '1d'.
+        :type interval: str
+        :param referrers_size: Maximum number of referrers aggregated for each request.
+        :type referrers_size: int
+        :param strict: If true, raise an exception if any hit is left out of aggregations, instead of a warning.
+        :type strict: bool
+        :param fields: Field names of ElasticURLFlowBackend, e.g: request_field='request.raw'.
+        :type fields: dict
+        :return: Analyzer.
+        :rtype: AggregatedRequestAnalyzer
+        :raise ElasticsearchException: If strict and terms aggregations are truncated.
+        """
+        es = ElasticURLFlowBackend(host=host, port=port, query=query, date_from=date_from, date_to=date_to, **fields)
+        return cls(es.aggregate(size, interval, referrers_size=referrers_size), regex, interval, strict=strict)
+
+    def _parse(self):
+        """Parse aggregations of requests and of requests and referrers.
+        """
+        normalizer = get_normalizer(self._regex)
+        requests, pairs, hits, rows, pair_rows, latency, request_latency = [], [], [], [], [], [], []
+        aggregation = self._result['aggregations']['requests']
+        missing_referrers = 0
+        for request_bucket in aggregation['buckets']:
+            request = normalizer(request_bucket['key']) or '-'
+            requests.append(request)
+            rows.append(_time_aggregates(request_bucket, self._percents))
+            request_latency.append([b['doc_count'] for b in request_bucket['latency']['buckets']])
+            missing_referrers += request_bucket['referrers'].get('sum_other_doc_count', 0)
+
+            for referrer_bucket in request_bucket['referrers']['buckets']:
+                referrer = normalizer(referrer_bucket['key'].strip('"')) or '-'
+                pairs.append((request, referrer))
+                hits.append(referrer_bucket['doc_count'])
+                pair_rows.append(_time_aggregates(referrer_bucket, self._percents))
+                latency.append([b['doc_count'] for b in referrer_bucket['latency']['buckets']])
+
+        columns = ['Count', 'Sum', 'Min', 'Max', 'Squares'] + ['P{:g}'.format(p) for p in self._percents]
+        self._requests = pd.DataFrame(rows, index=pd.Index(requests, name='Request'), columns=columns, dtype=float)
+        self._pairs = pd.DataFrame(pair_rows, index=pd.MultiIndex.from_tuples(pairs, names=['Request', 'Referrer']),
+                                   columns=columns, dtype=float)
+        self._hits = np.array(hits, dtype=np.int64)
+        self._latency = np.array(latency, dtype=np.uint32).reshape((len(pairs), len(LATENCY_EDGES) + 1))
+        self._request_latency = np.array(request_latency, dtype=np.int64).reshape(
+            (len(requests), len(LATENCY_EDGES) + 1))
+        self._missing_hits = aggregation.get('sum_other_doc_count', 0), missing_referrers
+
+    def _check_truncation(self, strict):
+        """Warn, or raise an exception if strict, if any hit is left out of aggregations.
+        """
+        missing_requests, missing_referrers = self._missing_hits
+        if not missing_requests and not missing_referrers:
+            return
+
+        message = "Aggregations are truncated: {:d} hits of other requests are left out of stats, and {:d} hits of " \
+                  "other referrers are left out of stats by request and referrer. Increase size or referrers_size " \
+                  "of aggregations.".format(missing_requests, missing_referrers)
+        if strict:
+            raise ElasticsearchException(message)
+
+        warnings.warn(message)
+
+    def missing_hits(self):
+        """Gets the number of hits left out of truncated terms aggregations.
+
+        :return: Hits of requests not aggregated, and hits of aggregated requests whose referrer is not aggregated.
+        :rtype: tuple
+        """
+        return self._missing_hits
+
+    def number_of_requests(self):
+        """Gets the number of requests.
+
+        :return: Number of requests.
+        :rtype: int
+        """
+        return self._result['hits']['total']
+
+    def number_of_days(self):
+        """Gets the number of days covered by data.
+
+        :return: Number of days, at least one, or five if data has no timestamps.
+        :rtype: float
+        """
+        aggregations = self._result['aggregations']
+        first, last = aggregations['first']['value'], aggregations['last']['value']
+        if first is None or last is None:
+            return DEFAULT_DAYS
+
+        return number_of_days(int(first), int(last))
+
+    def _stats(self, aggregates):
+        """Merge aggregates of URLs normalized into the same one and calculate their stats.
+        """
+        percentiles = ['P{:g}'.format(p) for p in self._percents]
+        aggregates = aggregates[aggregates['Count'] > 0]
+        weighted = aggregates[percentiles].mul(aggregates['Count'], axis=0)
+        grouped = pd.concat([aggregates.drop(columns=percentiles), weighted], axis=1).groupby(
+            level=list(range(aggregates.index.nlevels)), sort=True)
+        merged = grouped.agg(OrderedDict(
+            [('Count', 'sum'), ('Sum', 'sum'), ('Min', 'min'), ('Max', 'max'), ('Squares', 'sum')] +
+            [(p, 'sum') for p in percentiles]))
+
+        count = merged['Count']
+        mean = merged['Sum'] / count
+        stats = OrderedDict((
+            ('Count By Week', count.astype(np.int64)),
+            ('Count By Day', count / self.number_of_days()),
+            ('Mean', mean),
+            ('Std', np.sqrt((merged['Squares'] / count - mean ** 2).clip(lower=0))),
+            ('Max', merged['Max']),
+            ('Min', merged['Min']),
+            ('Sum', merged['Sum']),
+        ))
+        for p in percentiles:
+            stats['Median' if p == 'P50' else p] = merged[p] / count
+
+        return pd.DataFrame(stats, columns=list(stats.keys()))
+
+    def stats_by_request(self):
+        """Extract relevant stats grouped by request.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        return self._stats(self._requests)
+
+    def stats_by_request_and_referrer(self):
+        """Extract relevant stats grouped by request and referrer.
+
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        return self._stats(self._pairs)
+
+    def latency_histograms(self):
+        """Count times of each request in the latency buckets aggregated by Elasticsearch. Histograms of requests
+        aren't truncated by the number of referrers aggregated.
+
+        :return: Count of each bucket by request, and buckets edges, the first and last ones closed.
+        :rtype: tuple
+        """
+        edges = bucket_edges(LATENCY_EDGES)
+        histograms = pd.DataFrame(self._request_latency, index=self._requests.index, columns=edges[:-1])
+        return histograms.groupby(level=0, sort=True).sum(), edges
+
+    def time_series(self):
+        """Get count, throughput (requests per second), mean and percentiles of times of each date histogram
+        interval.
+
+        :return: Time series indexed by timestamp.
+        :rtype: pandas.DataFrame
+        """
+        buckets = self._result['aggregations']['histogram']['buckets']
+        columns = ['Count', 'Sum', 'Min', 'Max', 'Squares'] + ['P{:g}'.format(p) for p in self._percents]
+        aggregates = pd.DataFrame([_time_aggregates(b, self._percents) for b in buckets], columns=columns, dtype=float)
+
+        aggregates.index = pd.DatetimeIndex(pd.to_datetime([b['key'] for b in buckets], unit='ms'), name='Timestamp')
+
+        series = aggregates[columns[5:]].copy()
+        series.insert(0, 'Count', np.array([b['doc_count'] for b in buckets], dtype=np.int64))
+        series.insert(1, 'Throughput', series['Count'] / self._interval_seconds())
+        series.insert(2, 'Mean', aggregates['Sum'] / aggregates['Count'])
+        return series
+
+    def _interval_seconds(self):
+        match = re.match(r'^(\d*)([smhdw])$', self._interval)
+        if match is None:
+            # Calendar intervals, like month or year, have no fixed length
+            return np.nan
+
+        return int(match.group(1) or 1) * INTERVAL_SECONDS[match.group(2)]
+
+    def arcs(self):
+        """Get the arcs of the flow, from referrers to requests, weighted by number of hits.
+
+        :return: Origins, destinations, weights and latency aggregates of arcs.
+        :rtype: tuple
+        """
+        latency = LatencyAggregates(
+            self._pairs['Count'].values.astype(np.int64),
+            self._pairs['Sum'].values,
+            self._pairs['Min'].fillna(np.inf).values,
+            self._pairs['Max'].fillna(-np.inf).values,
+            self._latency,
+        )
+        index = self._pairs.index
+        return index.get_level_values('Referrer').tolist(), index.get_level_values('Request').tolist(), self._hits, \
+            latency
+
+    def digraph(self):
+        """Make the digraph of the flow, with latency aggregates of each arc.
+
+        :return: Digraph.
+        :rtype: performance_tools.digraph.Digraph
+        """
+        # Drawing dependencies are only needed by digraphs
+        from performance_tools.digraph import Digraph
+
+        return Digraph.from_arcs(*self.arcs())
+
+
+def _shard_file(task):
+    """Split the rows of an input file into shards by request, saving each shard in a columnar file.
+
+    :param task: Input file index and name, number of shards, output directory and chunk size of CSV files.
+    :type task: tuple
+    :return: Columnar file of each shard, and first and last timestamps in milliseconds since epoch.
+    :rtype: tuple
+    """
+    index, input_file, shards, directory, chunksize = task
+    if is_columnar_file(input_file):
+        data = read_columnar(input_file)
+    else:
+        data = read_csv(input_file, chunksize)
+
+    requests = data['Request'].cat
+    categories_shard = np.array([zlib.crc32(url.encode('utf-8')) & 0xffffffff for url in requests.categories],
+                                dtype=np.int64) % shards
+    # Rows without request are ignored
+    rows_shard = np.where(requests.codes >= 0, categories_shard[requests.codes], -1)
+    timestamps = data['Timestamp'].values.astype('datetime64[ms]').astype(np.int64)
+
+    # Files are named by input index, because inputs of different directories can have the same name
+    name = os.path.splitext(os.path.basename(input_file))[0] if isinstance(input_file, string_types) else 'input'
+    files = {}
+    for shard in np.unique(rows_shard[rows_shard >= 0]):
+        rows = rows_shard == shard
+        files[int(shard)] = os.path.join(directory, '{:05d}-{}-{:d}.npz'.format(index, name, shard))
+        writer = ColumnarWriter(files[int(shard)])
+        writer.write_columns(timestamps[rows], data['Referrer'].values[rows], data['Request'].values[rows],
+                             data['Time'].values[rows])
+        writer.close()
+
+    valid = timestamps[timestamps != NAT]
+    if not len(valid):
+        return files, None, None
+
+    return files, int(valid.min()), int(valid.max())
+
+
+def _shard_stats(task):
+    """Calculate stats of a shard, by request and by request and referrer.
+
+    :param task: Columnar files of the shard, noise quantiles, stats by referrer flag, number of days of data and
+    histogram bins edges. A shard without files has empty stats.
+    :type task: tuple
+    :return: Stats by request, stats by request and referrer, number of requests and latency histograms by request.
+    :rtype: tuple
+    """
+    files, lower_quantile, upper_quantile, by_referrer, days, edges = task
+    columns = [load_columnar(f) for f in files]
+    # Missing URLs have -1 code, so they are decoded as a trailing None
+    urls = [np.array(c['urls'] + [None], dtype=object) for c in columns]
+    data = pd.DataFrame({
+        'Referrer': np.concatenate([u[c['referrer']] for (u, c) in zip(urls, columns)] + [np.empty(0, dtype=object)]),
+        'Request': np.concatenate([u[c['request']] for (u, c) in zip(urls, columns)] + [np.empty(0, dtype=object)]),
+        'Time': np.concatenate([c['time'] for c in columns] + [np.empty(0, dtype=np.float32)]),
+    })
+
+    by_request = grouped_time_stats(data, 'Request', lower_quantile, upper_quantile, days=days)
+    by_pair = grouped_time_stats(data, ['Request', 'Referrer'], lower_quantile, upper_quantile,
+                                 days=days) if by_referrer else None
+    return by_request, by_pair, len(data), binned_histograms(data, 'Request', 'Time', edges)
+
+
+class ShardedRequestAnalyzer(object):
+    """Analyze many input files at once using a pool of processes. Rows of all files are split into shards by
+    hashing the request, so all times of a request are in the same shard, and exact stats of each shard, noise
+    trimming included, are calculated by a different process. No process loads the whole dataset, so only stats
+    by request and by request and referrer are available.
+    """
+
+    def __init__(self, input_files, noise=0.1, workers=None, shards=None, by_referrer=True, chunksize=100000,
+                 histogram_edges=HISTOGRAM_EDGES):
+        """ShardedRequestAnalyzer init method.
+
+        :param input_files: Input CSV or columnar .npz files.
+        :type input_files: list
+        :param noise: Percentage of data that will be considered noise (0-1).
+        :type noise: float
+        :param workers: Number of processes, defaults to number of CPUs.
+        :type workers: int
+        :param shards: Number of shards, defaults to number of processes.
+        :type shards: int
+        :param by_referrer: If true, stats by request and referrer are also calculated.
+        :type by_referrer: bool
+        :param chunksize: Number of rows of each chunk read from CSV files.
+        :type chunksize: int
+        :param histogram_edges: Bins edges of latency histograms, in seconds.
+        :type histogram_edges: numpy.array
+        """
+        self._input_files = list(input_files)
+        self._noise = noise
+        self._lower_quantile = self._noise / 2
+        self._upper_quantile = 1 - (self._noise / 2)
+        self._workers = workers or cpu_count()
+        self._shards = shards or self._workers
+        self._by_referrer = by_referrer
+        self._chunksize = chunksize
+        self._histogram_edges = histogram_edges
+        self._stats = None
+
+    def _analyze(self):
+        """Shard all input files and calculate stats of each shard.
+        """
+        directory = tempfile.mkdtemp(prefix='performance-tools-')
+        pool = Pool(self._workers) if self._workers > 1 else None
+        map_function = pool.map if pool is not None else map
+        try:
+            shards_files = [[] for _ in range(self._shards)]
+            first, last = [], []
+            tasks = [(i, f, self._shards, directory, self._chunksize) for (i, f) in enumerate(self._input_files)]
+            for (files, file_first, file_last) in map_function(_shard_file, tasks):
+                for (shard, shard_file) in files.items():
+                    shards_files[shard].append(shard_file)
+                if file_first is not None:
+                    first.append(file_first)
+                    last.append(file_last)
+
+            days = number_of_days(min(first), max(last)) if first else DEFAULT_DAYS
+            # If no input has rows, stats of a single empty shard are calculated, so they have the same columns
+            shards_files = [files for files in shards_files if files] or [[]]
+            tasks = [(files, self._lower_quantile, self._upper_quantile, self._by_referrer, days,
+                      self._histogram_edges) for files in shards_files]
+            results = list(map_function(_shard_stats, tasks))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        by_request = pd.concat([r[0] for r in results]).sort_index()
+        by_pair = pd.concat([r[1] for r in results]).sort_index() if self._by_referrer else None
+        histograms = pd.concat([r[3] for r in results]).sort_index()
+        self._stats = by_request, by_pair, sum(r[2] for r in results), days, histograms
+
+    def number_of_requests(self):
+        """Gets the number of requests.
+
+        :return: Number of requests.
+        :rtype: int
+        """
+        if self._stats is None:
+            self._analyze()
+
+        return self._stats[2]
+
+    def number_of_days(self):
+        """Gets the number of days covered by data.
+
+        :return: Number of days, at least one, or five if data has no timestamps.
+        :rtype: float
+        """
+        if self._stats is None:
+            self._analyze()
+
+        return self._stats[3]
+
     def stats_by_request(self):
         """Extract relevant stats grouped by request.
 
         :return: Stats.
-        :rtype: pandas.GroupedDataFrame
+        :rtype: pandas.DataFrame
         """
-        return self._data.groupby('Request').apply(self._get_stats)
+        if self._stats is None:
+            self._analyze()
+
+        return self._stats[0]
 
     def stats_by_request_and_referrer(self):
         """Extract relevant stats grouped by request and referrer.
 
         :return: Stats.
-        :rtype: pandas.GroupedDataFrame
+        :rtype: pandas.DataFrame
+        """
+        if not self._by_referrer:
+            raise ValueError("Analyzer doesn't calculate stats by referrer")
+
+        if self._stats is None:
+            self._analyze()
+
+        return self._stats[1]
+
+    def latency_histograms(self):
+        """Count times of each request in the histogram bins given at init.
+
+        :return: Count of each bin by request, and bins edges.
+        :rtype: tuple
         """
-        return self._data.groupby(['Request', 'Referrer']).apply(self._get_stats)
+        if self._stats is None:
+            self._analyze()
+
+        return self._stats[4], self._histogram_edges
 
 
 class RequestComparator(object):
-    """Class that uses different analyzers to compare results.
+    """Class that uses different analyzers to compare results. Stats of each analyzer are calculated only once, no
+    matter how many comparisons are made.
     """
 
     def __init__(self, *analyzers):
@@ -145,6 +1050,7 @@ class RequestComparator(object):
             analyzers = []
 
         self._analyzers = analyzers
+        self._stats = {}
 
     @property
     def analyzers(self):
@@ -153,8 +1059,22 @@ class RequestComparator(object):
     @analyzers.deleter
     def analyzers(self):
         del self._analyzers
+        self._stats = {}
 
-    def compare_requests(self, old=None, new=None, indexes=None):
+    def _stats_by_request(self, analyzer):
+        """Get the stats by request of an analyzer, calculating them only the first time.
+
+        :param analyzer: Analyzer.
+        :type analyzer: RequestAnalyzer
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        try:
+            return self._stats[id(analyzer)]
+        except KeyError:
+            return self._stats.setdefault(id(analyzer), analyzer.stats_by_request())
+
+    def compare_requests(self, old=None, new=None, indexes=None, column='Mean'):
         """Compare requests stats of two or more analyzers.
 
         :param old: Index of the analyzer that represents old data.
@@ -163,48 +1083,153 @@ class RequestComparator(object):
         :type new: int
         :param indexes: Indexes of analyzers to compare.
         :type indexes: iter
+        :param column: Stat to compare, e.g: Mean, Median or P95.
+        :type column: str
         :return: DataFrame with the comparison.
         :rtype: pandas.DataFrame
         """
         if old is not None and new is not None:
             old_analyzer = self._analyzers[old]
             new_analyzer = self._analyzers[new]
-            comparison = self._compare_two_requests(old_analyzer, new_analyzer)
+            comparison = self._compare_two_requests(old_analyzer, new_analyzer, column)
         elif indexes:
-            analyzers = [a for (i, a) in enumerate(self._analyzers) if i in indexes]
-            comparison = self._compare_more_than_two_requests(analyzers)
+            indexes = [i for i in range(len(self._analyzers)) if i in indexes]
+            comparison = self._compare_more_than_two_requests(indexes, column)
         else:
             raise TypeError("compare_requests takes old and new, or indexes arguments")
 
         return comparison
 
-    def _compare_two_requests(self, old, new):
+    def _compare_two_requests(self, old, new, column='Mean'):
         """Compare all requests stats from two analyzers.
 
         :param old: Analyzer that represents old data.
         :type old: RequestAnalyzer
         :param new: Analyzer that represents new data.
         :type new: RequestAnalyzer
+        :param column: Stat to compare.
+        :type column: str
         :return: Comparison.
         :rtype: pandas.DataFrame
         """
-        # Prepare series for merging
-        old_series = old.stats_by_request()['Mean'].reset_index()
-        new_series = new.stats_by_request()['Mean'].reset_index()
-
         # Merge
-        merged = pd.merge(old_series, new_series, on='Request', how='outer').set_index(['Request'])
+        merged = pd.concat([self._stats_by_request(old)[column], self._stats_by_request(new)[column]], axis=1,
+                           keys=['Old', 'New'], join='outer')
         merged.index.name = None
-        merged.columns = ['Old', 'New']
 
-        # Add differences
+        # Add differences, improvements are percentages
         merged['Difference'] = merged['New'] - merged['Old']
         merged['Absolute improvement'] = - (merged['New'] - merged['Old']) / merged['Old'] * 100.
-        merged['Absolute improvement'] = merged['Absolute improvement'].map("{:,.2f}%".format)
         merged['Relative improvement'] = merged['Old'] / merged['New'] * 100.
-        merged['Relative improvement'] = merged['Relative improvement'].map("{:,.2f}%".format)
 
         return merged
 
-    def _compare_more_than_two_requests(self, analyzers):
-        pass
\ No newline at end of file
+    def _compare_more_than_two_requests(self, indexes, column='Mean'):
+        """Compare all requests stats from many analyzers, aligned in a single outer join on request. Differences
+        and improvements of each analyzer are relative to the first one.
+
+        :param indexes: Indexes of analyzers to compare, the first one is the baseline.
+        :type indexes: list
+        :param column: Stat to compare.
+        :type column: str
+        :return: Comparison, with stat, difference, absolute improvement and relative improvement columns of each
+        analyzer index.
+        :rtype: pandas.DataFrame
+        """
+        values = pd.concat([self._stats_by_request(self._analyzers[i])[column] for i in indexes], axis=1,
+                           keys=indexes, join='outer')
+        values.index.name = None
+
+        baseline = values[indexes[0]]
+        others = values[indexes[1:]]
+        difference = others.sub(baseline, axis=0)
+
+        # Improvements are percentages
+        return pd.concat([
+            values,
+            difference,
+            - difference.div(baseline, axis=0) * 100.,
+            others.rdiv(baseline, axis=0) * 100.,
+        ], axis=1, keys=[column, 'Difference', 'Absolute improvement', 'Relative improvement'])
+
+    def detect_regressions(self, old, new, method='mannwhitney', alpha=0.05, min_samples=20, min_effect=0.05, q=0.5,
+                           iterations=1000, random_state=None):
+        """Detect requests whose times changed significantly between two analyzers. All requests are tested at once.
+
+        Mann-Whitney method tests if times of a request are stochastically greater or lower, and bootstrap method
+        builds a confidence interval of the difference of a quantile. In both cases a change is reported only if
+        the relative change of the quantile is at least the minimum effect.
+
+        :param old: Index of the analyzer that represents old data.
+        :type old: int
+        :param new: Index of the analyzer that represents new data.
+        :type new: int
+        :param method: Test method: mannwhitney or bootstrap.
+        :type method: str
+        :param alpha: Significance level.
+        :type alpha: float
+        :param min_samples: Minimum number of old and new times of a request to be tested.
+        :type min_samples: int
+        :param min_effect: Minimum relative change of the quantile (0-1).
+        :type min_effect: float
+        :param q: Quantile used to measure the effect and, in bootstrap method, the one compared (0-1).
+        :type q: float
+        :param iterations: Number of bootstrap resamples.
+        :type iterations: int
+        :param random_state: Bootstrap random seed or state.
+        :type random_state: int or numpy.random.RandomState
+        :return: Test results of each request, with Regression and Improvement flags.
+        :rtype: pandas.DataFrame
+        """
+        samples = [self._analyzers[old].data, self._analyzers[new].data]
+        requests = np.concatenate([np.asarray(s['Request'], dtype=object) for s in samples])
+        times = np.concatenate([s['Time'].values.astype(np.float64) for s in samples])
+        is_new = np.concatenate([np.zeros(len(samples[0]), dtype=bool), np.ones(len(samples[1]), dtype=bool)])
+
+        valid = ~np.isnan(times) & ~pd.isnull(requests)
+        codes, index = pd.factorize(requests[valid], sort=True)
+        times, is_new = times[valid], is_new[valid]
+        num_groups = len(index)
+
+        # Quantiles and sizes of both samples
+        quantiles, counts = [], []
+        for side in (~is_new, is_new):
+            order = np.lexsort((times[side], codes[side]))
+            side_counts = np.bincount(codes[side], minlength=num_groups)
+            quantiles.append(sorted_group_quantiles(times[side][order], np.cumsum(side_counts) - side_counts,
+                                                    side_counts, q))
+            counts.append(side_counts)
+
+        results = pd.DataFrame({
+            'Old count': counts[0],
+            'New count': counts[1],
+            'Old': quantiles[0],
+            'New': quantiles[1],
+        }, index=pd.Index(index, name='Request'), columns=['Old count', 'New count', 'Old', 'New'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results['Effect'] = (quantiles[1] - quantiles[0]) / quantiles[0]
+
+        tested = (counts[0] >= min_samples) & (counts[1] >= min_samples)
+        if method == 'mannwhitney':
+            u, p_value = grouped_mann_whitney(codes, is_new, times, num_groups)
+            results['U'] = u
+            results['P-value'] = np.where(tested, p_value, np.nan)
+            significant = tested & (p_value < alpha)
+            # U of new times is greater than half of comparisons when they tend to be greater
+            slower = u > counts[0] * counts[1] / 2.
+            faster = u < counts[0] * counts[1] / 2.
+        elif method == 'bootstrap':
+            lower, upper = grouped_bootstrap_quantile(codes, is_new, times, num_groups, q, iterations, alpha,
+                                                      random_state)
+            results['CI lower'] = np.where(tested, lower, np.nan)
+            results['CI upper'] = np.where(tested, upper, np.nan)
+            significant = tested & ((lower > 0) | (upper < 0))
+            slower, faster = lower > 0, upper < 0
+        else:
+            raise ValueError("Invalid method '{}'".format(method))
+
+        effect = results['Effect'].values
+        results['Regression'] = significant & slower & (effect >= min_effect)
+        results['Improvement'] = significant & faster & (effect <= -min_effect)
+
+        return results
@@ -1 +1,2 @@
-from performance_tools.urls_flow.backends.elasticsearch import ElasticURLFlowBackend
\ No newline at end of file
+from performance_tools.urls_flow.backends.elasticsearch import ElasticURLFlowBackend
+from performance_tools.urls_flow.backends.nginx import NginxURLFlowBackend
@@ -3,18 +3,49 @@
 from __future__ import unicode_literals
 
 from abc import ABCMeta
+from collections import deque
 import csv
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from performance_tools.exceptions import ProgressBarException, ElasticsearchException
+from performance_tools.utils.columnar import ColumnarWriter
+from performance_tools.utils.pipeline import prefetch
 from performance_tools.utils.progress_bar import create_progress_bar
 
+CSV_HEADER = ['Timestamp', 'Referrer', 'Request', 'Time']
+
+# Extraction function and regular expression of each worker process of pipelined extraction
+_worker_extraction = None
+
+
+def _init_extraction_worker(extractor, regex):
+    """Keep extraction function and regular expression in a worker process, so they are sent only once and the
+    normalizer cache lives as long as the worker.
+    """
+    global _worker_extraction
+    _worker_extraction = extractor, regex
+
+
+def _extract_in_worker(result):
+    extractor, regex = _worker_extraction
+    return extractor(result, regex)
+
 
 class BaseURLFlowBackend(object):
-    """Collect URL flow from backend. URL Flow: Referrer, Request, Time.
+    """Collect URL flow from backend. URL Flow: Timestamp, Referrer, Request, Time.
     It's necessary to implement extract_url_from_result and __iter__ methods.
     """
     __metaclass__ = ABCMeta
 
+    # Name of the units of extraction progress
+    _progress_unit = 'url'
+
+    # Module-level function of (result, regex), or a partial of one, that does the same as extract_url_from_result.
+    # If given, pipelined extraction normalizes results in worker processes, otherwise in threads that only overlap
+    # network and disk work.
+    _row_extractor = None
+
     def __init__(self):
         self._total_hits = 0
 
@@ -23,50 +54,163 @@ class BaseURLFlowBackend(object):
 
         :param result: results obtained from backend in each iteration.
         :type result: object
-        :param regex: Regular expression to normalize id's in URL.
-        :type regex: re
-        :return: List of origin urls and destination urls.
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :return: List of (timestamp, origin url, destination url, time) rows.
         :rtype: list
         """
         raise NotImplementedError
 
-    def to_csv(self, filename, regex=None, verbose=2):
-        """Save results as a CSV file.
+    def _progress(self, count, rows):
+        """Update extraction progress with the rows of a consumed result.
 
-        :param filename: CSV output file.
-        :type filename: str
+        :param count: Progress before the result.
+        :type count: int
+        :param rows: Rows of the result.
+        :type rows: list
+        :return: Progress after the result and total.
+        :rtype: tuple
+        """
+        return count + len(rows), self._total_hits
+
+    def _pipelined_rows(self, regex=None, workers=1, queue_size=8):
+        """Extract rows of each result using a pipeline: results are prefetched in background and normalized by a
+        pool of workers, while rows of previous results are consumed. Number of results in flight is bounded by
+        queue size.
+
+        Workers are processes if the backend has a row extractor, so normalization isn't serialized by the GIL.
+        Otherwise they are threads, and normalization only overlaps with fetching and writing.
+
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param workers: Number of normalization workers.
+        :type workers: int
+        :param queue_size: Maximum number of results prefetched and maximum number of results being normalized.
+        :type queue_size: int
+        :return: Rows of each result.
+        :rtype: generator
+        """
+        processes = self._row_extractor is not None
+        if processes:
+            pool = Pool(workers, _init_extraction_worker, (self._row_extractor, regex))
+        else:
+            pool = ThreadPool(workers)
+
+        pending = deque()
+        try:
+            for result in prefetch([self], queue_size):
+                if processes:
+                    pending.append(pool.apply_async(_extract_in_worker, (result,)))
+                else:
+                    pending.append(pool.apply_async(self.extract_url_from_result, (result, regex)))
+                if len(pending) >= queue_size:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def _extract_rows(self, regex=None, verbose=2, workers=None, queue_size=8):
+        """Extract rows of each result, showing progress. If workers are given, extraction is pipelined.
+
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param verbose: Verbosity level: 2 shows a progress bar, 1 prints progress and 0 is silent.
+        :type verbose: int
+        :param workers: Number of normalization workers of pipelined extraction, processes if the backend has a row
+        extractor.
+        :type workers: int
+        :param queue_size: Maximum number of results prefetched in pipelined extraction.
+        :type queue_size: int
+        :return: Rows of each result.
+        :rtype: generator
         :raise: ValueError if not found any result.
         """
         progress = None
 
+        if workers:
+            results_rows = self._pipelined_rows(regex, workers, queue_size)
+        else:
+            results_rows = (self.extract_url_from_result(result, regex) for result in self)
+
         try:
-            with open(filename, 'w') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow(['Referrer', 'Request', 'Time'])
-                count = 0
-                for result in self:
-                    # Create progress bar or down verbose level
-                    if verbose == 2 and progress is None:
-                        try:
-                            progress = create_progress_bar(self._total_hits, 'Extract URLs', 'url')
-                        except ProgressBarException:
-                            verbose = 1
-
-                    # Write results to csv
-                    rows = self.extract_url_from_result(result, regex)
-                    writer.writerows(rows)
-
-                    # Update progress
-                    count += len(rows)
-                    if verbose == 2:
-                        progress.update(count if count < self._total_hits else self._total_hits)
-                    elif verbose == 1:
-                        print "{:d}/{:d} ({:d}%)".format(count, self._total_hits, count * 100 / self._total_hits)
+            count = 0
+            for rows in results_rows:
+                count, total = self._progress(count, rows)
+
+                # Create progress bar or down verbose level
+                if verbose == 2 and progress is None:
+                    try:
+                        progress = create_progress_bar(total, 'Extract URLs', self._progress_unit)
+                    except ProgressBarException:
+                        verbose = 1
+
+                yield rows
+
+                # Update progress
+                if verbose == 2:
+                    progress.update(count if count < total else total)
+                elif verbose == 1:
+                    print("{:d}/{:d} ({:d}%)".format(count, total, count * 100 // total))
         except ZeroDivisionError:
             raise ElasticsearchException("Search doesn't return any result")
         except KeyError:
             raise ElasticsearchException("Invalid result")
 
+    def to_csv(self, filename, regex=None, verbose=2, workers=None, queue_size=8, batch_size=10000):
+        """Save results as a CSV file. If workers are given, extraction is pipelined: next results are fetched and
+        normalized while rows are written, so network, CPU and disk work overlap.
+
+        :param filename: CSV output file.
+        :type filename: str
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param verbose: Verbosity level: 2 shows a progress bar, 1 prints progress and 0 is silent.
+        :type verbose: int
+        :param workers: Number of normalization workers of pipelined extraction, processes if the backend has a row
+        extractor.
+        :type workers: int
+        :param queue_size: Maximum number of results prefetched in pipelined extraction.
+        :type queue_size: int
+        :param batch_size: Number of rows written at once.
+        :type batch_size: int
+        :raise: ValueError if not found any result.
+        """
+        with open(filename, 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(CSV_HEADER)
+            batch = []
+            for rows in self._extract_rows(regex, verbose, workers, queue_size):
+                # Write results to csv in batches
+                batch.extend(rows)
+                if len(batch) >= batch_size:
+                    writer.writerows(batch)
+                    batch = []
+
+            writer.writerows(batch)
+
+    def to_columnar(self, filename, regex=None, verbose=2, workers=None, queue_size=8):
+        """Save results as a columnar .npz file, where URLs are stored once in a dictionary and referrers and
+        requests are integer codes. It's smaller and faster to load than a CSV file.
+
+        :param filename: Columnar output file.
+        :type filename: str
+        :param regex: Regular expression to normalize id's in URL or route table.
+        :type regex: str or re or performance_tools.utils.url.RouteTable
+        :param verbose: Verbosity level: 2 shows a progress bar, 1 prints progress and 0 is silent.
+        :type verbose: int
+        :param workers: Number of normalization workers of pipelined extraction, processes if the backend has a row
+        extractor.
+        :type workers: int
+        :param queue_size: Maximum number of results prefetched in pipelined extraction.
+        :type queue_size: int
+        :raise: ValueError if not found any result.
+        """
+        with ColumnarWriter(filename) as writer:
+            for rows in self._extract_rows(regex, verbose, workers, queue_size):
+                writer.write(rows)
+
     def __iter__(self):
         """Iterate over each result.
         """
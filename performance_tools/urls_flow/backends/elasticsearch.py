@@ -2,26 +2,109 @@
 
 from __future__ import unicode_literals, absolute_import
 
-from elasticsearch import Elasticsearch
+import copy
+import datetime
+from functools import partial
 
+from elasticsearch import Elasticsearch, TransportError
+
+from performance_tools.exceptions import ElasticsearchException
 from performance_tools.urls_flow.backends.base import BaseURLFlowBackend
-from performance_tools.utils.url import normalize_url
+from performance_tools.utils.histogram import LATENCY_EDGES
+from performance_tools.utils.pipeline import prefetch
+from performance_tools.utils.url import get_normalizer
+
+DATE_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+)
+
+# Percentiles of time_response aggregations
+PERCENTS = (50, 90, 95, 99)
+
+# Default fields of timestamp, referrer, request and response time
+FIELDS = ('@timestamp', 'referrer', 'request', 'time_response')
+
+
+def _parse_date(date):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date, date_format)
+        except ValueError:
+            pass
+
+    raise ElasticsearchException("Invalid date '{}'".format(date))
+
+
+def _format_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _get_fields(hit, fields=FIELDS):
+    timestamp, referrer, request, time = fields
+    try:
+        return (
+            hit['fields'][timestamp][0],
+            hit['fields'][referrer][0].strip('"'),
+            hit['fields'][request][0],
+            hit['fields'][time][0],
+        )
+    except KeyError:
+        return None
+
+
+def extract_rows(result, regex=None, fields=FIELDS):
+    """Extract (timestamp, referrer, request, time) rows of the hits of a search result.
+
+    :param result: Search result.
+    :type result: dict
+    :param regex: Regular expression to normalize id's in URL or route table.
+    :type regex: str or re or performance_tools.utils.url.RouteTable
+    :param fields: Fields of timestamp, referrer, request and response time.
+    :type fields: tuple
+    :return: Rows.
+    :rtype: list
+    """
+    hits = [i for i in result['hits']['hits'] if 'fields' in i]
+    rows = [i for i in (_get_fields(hit, fields) for hit in hits) if i is not None]
+    if not rows:
+        return []
+
+    # Distinct referrers and requests are normalized only once
+    timestamps, referrers, requests, times = zip(*rows)
+    paths = get_normalizer(regex).normalize_many(referrers + requests)
+    return [(timestamp, referrer or "-", request or "-", time) for (timestamp, referrer, request, time) in
+            zip(timestamps, paths[:len(rows)], paths[len(rows):], times)]
 
 
 class ElasticURLFlowBackend(BaseURLFlowBackend):
-    """Query Elasticsearch to collect nginx logs.
+    """Query Elasticsearch to collect nginx logs. Query can be split into disjoint timestamp ranges that are scrolled
+    in parallel.
+
+    Field names can be changed to match the index mapping, e.g: request_field='request.raw' to use a not analyzed
+    subfield, because aggregations by request and referrer need whole URLs as terms.
     """
 
     def __init__(self, host='localhost', port=9200, username=None, password=None, protocol='http', query='*',
-                 date_from="", date_to="", size=50, timeout=60):
+                 date_from="", date_to="", size=50, timeout=60, slices=1, workers=None,
+                 timestamp_field=FIELDS[0], referrer_field=FIELDS[1], request_field=FIELDS[2], time_field=FIELDS[3]):
         if username is not None and password is not None:
             self.url = '{}://{}:{}@{}:{:d}'.format(protocol, username, password, host, port)
         else:
             self.url = '{}://{}:{:d}'.format(protocol, host, port)
 
-        self._backend = Elasticsearch([self.url])
+        # Parallel extraction
+        self._slices = slices
+        self._workers = workers or slices
+
+        self._backend = Elasticsearch([self.url], maxsize=max(10, self._workers))
 
         # Search body
+        self._date_from = date_from
+        self._date_to = date_to
         self._body = {
             "query": {
                 "filtered": {
@@ -39,7 +122,7 @@ class ElasticURLFlowBackend(BaseURLFlowBackend):
                             },
                             {
                                 "range": {
-                                    "@timestamp": {
+                                    timestamp_field: {
                                         "gte": date_from,
                                         "lte": date_to,
                                     }
@@ -56,68 +139,190 @@ class ElasticURLFlowBackend(BaseURLFlowBackend):
 
         # Returned fields
         self._fields = [
-            "@timestamp",
-            "referrer",
-            "request",
-            "time_response",
+            timestamp_field,
+            referrer_field,
+            request_field,
+            time_field,
         ]
+        self._row_extractor = partial(extract_rows, fields=tuple(self._fields))
 
         # Scrollable search
         self._search_type = 'scan'
         self._scroll = '1m'
-        self._scroll_id = None
 
         # Timeout
         self._timeout = timeout
 
         super(ElasticURLFlowBackend, self).__init__()
 
-    def _get_fields(self, hit, regex=None):
-        try:
-            return (
-                hit['fields']['@timestamp'][0],
-                normalize_url(hit['fields']['referrer'][0].strip('"'), regex) or "-",
-                normalize_url(hit['fields']['request'][0], regex) or "-",
-                hit['fields']['time_response'][0],
-            )
-        except KeyError:
-            return None
-
     def extract_url_from_result(self, result, regex=None):
-        hits = [i for i in result['hits']['hits'] if 'fields' in i]
-        fields = [self._get_fields(hit, regex) for hit in hits]
-        return [i for i in fields if i is not None]
+        return self._row_extractor(result, regex)
 
-    def __iter__(self):
+    def _sliced_bodies(self):
+        """Split search body into disjoint timestamp ranges, one for each slice.
+
+        :return: Search bodies.
+        :rtype: list
+        """
+        if not self._date_from or not self._date_to:
+            raise ElasticsearchException("Parallel extraction needs date_from and date_to")
+
+        date_from, date_to = _parse_date(self._date_from), _parse_date(self._date_to)
+        step = (date_to - date_from) // self._slices
+
+        bodies = []
+        for i in range(self._slices):
+            body = copy.deepcopy(self._body)
+            timestamp_range = body['query']['filtered']['filter']['and'][1]['range'][self._fields[0]]
+            timestamp_range['gte'] = _format_date(date_from + step * i)
+            if i < self._slices - 1:
+                # Upper bound is excluded, so each hit belongs to a single slice
+                del timestamp_range['lte']
+                timestamp_range['lt'] = _format_date(date_from + step * (i + 1))
+            bodies.append(body)
+
+        return bodies
+
+    def _scan(self, body, total_hits=True):
+        """Iterate over each result of a scrollable search, clearing the scroll context when finished.
+
+        :param body: Search body.
+        :type body: dict
+        :param total_hits: If true, store the total number of hits.
+        :type total_hits: bool
+        """
         # Make first query
         result = self._backend.search(
             index='',
             doc_type='',
-            body=self._body,
+            body=body,
             size=self._size,
             fields=self._fields,
+            _source=False,
             search_type=self._search_type,
             scroll=self._scroll,
             timeout=self._timeout,
         )
 
         # Get total hits
-        self._total_hits = result['hits']['total']
+        if total_hits:
+            self._total_hits = result['hits']['total']
 
         # Get next scroll id
-        self._scroll_id = result['_scroll_id']
-
-        # Consume API first result
-        yield result
-
-        # Get next result
-        result = self._backend.scroll(scroll=self._scroll, scroll_id=self._scroll_id)
-        while result['hits']['hits']:
-            # Get next scroll id
-            self._scroll_id = result['_scroll_id']
+        scroll_id = result['_scroll_id']
 
-            # Consume API next result
+        try:
+            # Consume API first result
             yield result
 
             # Get next result
-            result = self._backend.scroll(scroll=self._scroll, scroll_id=self._scroll_id)
+            result = self._backend.scroll(scroll=self._scroll, scroll_id=scroll_id)
+            while result['hits']['hits']:
+                # Get next scroll id
+                scroll_id = result['_scroll_id']
+
+                # Consume API next result
+                yield result
+
+                # Get next result
+                result = self._backend.scroll(scroll=self._scroll, scroll_id=scroll_id)
+        finally:
+            try:
+                self._backend.clear_scroll(scroll_id=scroll_id)
+            except TransportError:
+                # Scroll context already expired
+                pass
+
+    def _parallel_scan(self):
+        """Scan each slice in a worker thread and merge their results as soon as they are available. Workers are
+        blocked while results queue is full, so memory is bounded.
+        """
+        bodies = self._sliced_bodies()
+        self._total_hits = self._backend.count(index='', doc_type='', body={'query': self._body['query']})['count']
+
+        slices = [self._scan(body, total_hits=False) for body in bodies]
+        return prefetch(slices, queue_size=2 * self._workers, workers=self._workers)
+
+    def __iter__(self):
+        if self._slices > 1:
+            return self._parallel_scan()
+
+        return self._scan(self._body)
+
+    def _aggregation_body(self, size=10000, interval='1d', percents=PERCENTS, referrers_size=10):
+        """Build a search body that aggregates response times by request, and by request and referrer, instead of
+        returning hits.
+
+        :param size: Maximum number of requests aggregated.
+        :type size: int
+        :param interval: Date histogram interval, e.g: '1m', '1h' or '1d'.
+        :type interval: str
+        :param percents: Percentiles of response times (0-100).
+        :type percents: iter
+        :param referrers_size: Maximum number of referrers aggregated for each request.
+        :type referrers_size: int
+        :return: Search body.
+        :rtype: dict
+        """
+        timestamp_field, referrer_field, request_field, time_field = self._fields
+        time_aggregations = {
+            'time': {'extended_stats': {'field': time_field}},
+            'percentiles': {'percentiles': {'field': time_field, 'percents': list(percents)}},
+        }
+
+        # Latency histogram buckets, the same used by digraph arcs
+        edges = LATENCY_EDGES.tolist()
+        ranges = [{'to': edges[0]}] + [{'from': f, 'to': t} for (f, t) in zip(edges[:-1], edges[1:])] + \
+            [{'from': edges[-1]}]
+        latency_aggregations = dict(time_aggregations, latency={'range': {'field': time_field, 'ranges': ranges}})
+
+        return {
+            'query': copy.deepcopy(self._body['query']),
+            'aggs': {
+                'requests': {
+                    'terms': {'field': request_field, 'size': size},
+                    'aggs': dict(latency_aggregations, referrers={
+                        'terms': {'field': referrer_field, 'size': referrers_size},
+                        'aggs': latency_aggregations,
+                    }),
+                },
+                'histogram': {
+                    'date_histogram': {'field': timestamp_field, 'interval': interval},
+                    'aggs': time_aggregations,
+                },
+                'first': {'min': {'field': timestamp_field}},
+                'last': {'max': {'field': timestamp_field}},
+            },
+        }
+
+    def aggregate(self, size=10000, interval='1d', percents=PERCENTS, referrers_size=10):
+        """Aggregate response times in the cluster, so only stats are transferred instead of every hit: extended
+        stats and percentiles of each request, of each request and referrer and of each date histogram interval.
+        Response times of each request, and of each request and referrer, are also aggregated in latency histogram
+        buckets.
+
+        Only the most frequent terms are aggregated, so the cluster builds at most size * referrers_size buckets of
+        requests and referrers. Hits of the rest of terms are counted in sum_other_doc_count of each terms
+        aggregation.
+
+        :param size: Maximum number of requests aggregated.
+        :type size: int
+        :param interval: Date histogram interval, e.g: '1m', '1h' or '1d'.
+        :type interval: str
+        :param percents: Percentiles of response times (0-100).
+        :type percents: iter
+        :param referrers_size: Maximum number of referrers aggregated for each request.
+        :type referrers_size: int
+        :return: Search result with aggregations.
+        :rtype: dict
+        """
+        result = self._backend.search(
+            index='',
+            doc_type='',
+            body=self._aggregation_body(size, interval, percents, referrers_size),
+            size=0,
+            timeout=self._timeout,
+        )
+
+        self._total_hits = result['hits']['total']
+        return result
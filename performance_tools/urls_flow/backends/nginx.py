@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+from collections import deque
+import datetime
+import glob
+import gzip
+import mmap
+from multiprocessing import Pool, cpu_count
+import os
+import re
+
+from performance_tools.exceptions import NginxException
+from performance_tools.urls_flow.backends.base import BaseURLFlowBackend
+from performance_tools.utils.url import get_normalizer
+
+COMBINED_FORMAT = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" ' \
+                  '"$http_user_agent"'
+
+TIMED_COMBINED_FORMAT = COMBINED_FORMAT + ' $request_time'
+
+MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+          'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+
+# Variables that can provide each field, by priority
+TIMESTAMP_VARIABLES = ('time_iso8601', 'time_local', 'msec')
+REFERRER_VARIABLES = ('http_referer',)
+REQUEST_VARIABLES = ('request', 'request_uri', 'uri')
+TIME_VARIABLES = ('request_time',)
+
+NAN = float('nan')
+
+
+def compile_log_format(log_format):
+    """Build a regular expression that matches lines of given nginx log_format. Each variable is captured in a named
+    group and matches anything up to the next literal character of the format, so lines can be found in a whole
+    chunk of a log.
+
+    :param log_format: Nginx log_format, e.g: '$remote_addr [$time_local] "$request" $request_time'.
+    :type log_format: str
+    :return: Regular expression that matches bytes lines.
+    :rtype: re
+    """
+    tokens = re.split(r'\$(\w+)', log_format)
+    pattern = ['^']
+    variables = set()
+    for i, token in enumerate(tokens):
+        if i % 2 == 0:
+            pattern.append(re.escape(token))
+        else:
+            following = tokens[i + 1]
+            if following:
+                value = '[^{}\n]*'.format(re.escape(following[0]))
+            elif i + 2 < len(tokens):
+                # Followed by another variable
+                value = '[^\n]*?'
+            else:
+                value = '[^\r\n]*'
+            if token in variables:
+                pattern.append(value)
+            else:
+                pattern.append('(?P<{}>{})'.format(token, value))
+                variables.add(token)
+
+    return re.compile(''.join(pattern).encode('utf-8'), re.MULTILINE)
+
+
+def _first_group(regex, variables):
+    for variable in variables:
+        if variable in regex.groupindex:
+            return regex.groupindex[variable], variable
+
+    return None, None
+
+
+def _format_timestamp(timestamp, variable):
+    if variable == 'time_local':
+        # 10/Oct/2000:13:55:36 -0700 -> 2000-10-10T13:55:36-07:00
+        try:
+            return '{}-{}-{}T{}{}:{}'.format(timestamp[7:11], MONTHS[timestamp[3:6]], timestamp[0:2],
+                                             timestamp[12:20], timestamp[21:24], timestamp[24:26])
+        except KeyError:
+            return timestamp
+    elif variable == 'msec':
+        try:
+            return datetime.datetime.utcfromtimestamp(float(timestamp)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        except ValueError:
+            return timestamp
+
+    return timestamp
+
+
+def _parse_time(time):
+    try:
+        return float(time)
+    except ValueError:
+        return NAN
+
+
+def _parse_lines(data, regex):
+    """Parse all lines of a chunk of log. Lines that don't match log format are skipped.
+
+    :param data: Chunk of log.
+    :type data: bytes
+    :param regex: Log format regular expression.
+    :type regex: re
+    :return: List of (timestamp, referrer, request, time) rows.
+    :rtype: list
+    """
+    timestamp, timestamp_variable = _first_group(regex, TIMESTAMP_VARIABLES)
+    referrer, _ = _first_group(regex, REFERRER_VARIABLES)
+    request, request_variable = _first_group(regex, REQUEST_VARIABLES)
+    time, _ = _first_group(regex, TIME_VARIABLES)
+
+    # Missing fields are read from an empty group
+    groups = [i if i is not None else 0 for i in (timestamp, referrer, request, time)]
+    empty = [i is None for i in (timestamp, referrer, request, time)]
+
+    rows = []
+    for match in regex.finditer(data):
+        values = [b'' if e else v for v, e in zip(match.group(*groups), empty)]
+        row_timestamp, row_referrer, row_request, row_time = [v.decode('utf-8', 'replace') for v in values]
+
+        if request_variable == 'request':
+            # Request line: method, uri and protocol
+            parts = row_request.split(' ')
+            row_request = parts[1] if len(parts) > 1 else row_request
+
+        rows.append((
+            _format_timestamp(row_timestamp, timestamp_variable),
+            row_referrer or '-',
+            row_request,
+            _parse_time(row_time) if not empty[3] else NAN,
+        ))
+
+    return rows
+
+
+def _parse_chunk(task):
+    """Parse a chunk of log in a worker process. Chunk can be a byte range of a plain file, that is memory-mapped
+    to read only that range, or a block of bytes already read.
+
+    :param task: Log format regular expression and chunk: (path, start, end) or bytes.
+    :type task: tuple
+    :return: List of (timestamp, referrer, request, time) rows.
+    :rtype: list
+    """
+    regex, chunk = task
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, 'rb') as log_file:
+            log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = log_map[start:end]
+            finally:
+                log_map.close()
+    else:
+        data = chunk
+
+    return _parse_lines(data, regex)
+
+
+def extract_rows(result, regex=None):
+    """Normalize referrers and requests of parsed rows.
+
+    :param result: List of (timestamp, referrer, request, time) rows.
+    :type result: list
+    :param regex: Regular expression to normalize id's in URL or route table.
+    :type regex: str or re or performance_tools.utils.url.RouteTable
+    :return: Normalized rows.
+    :rtype: list
+    """
+    if not result:
+        return []
+
+    # Distinct referrers and requests are normalized only once
+    timestamps, referrers, requests, times = zip(*result)
+    paths = get_normalizer(regex).normalize_many(referrers + requests)
+    return [(timestamp, referrer or "-", request or "-", time) for (timestamp, referrer, request, time) in
+            zip(timestamps, paths[:len(result)], paths[len(result):], times)]
+
+
+def _open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+
+    return open(path, 'rb')
+
+
+class NginxURLFlowBackend(BaseURLFlowBackend):
+    """Read nginx access logs, plain or gzip compressed, from local files. Plain files are split into byte ranges
+    aligned to lines, compressed files are split into blocks of lines while they are decompressed, and each chunk is
+    parsed in a pool of worker processes.
+
+    Extraction progress is measured in bytes of the files, compressed ones for gzip files, so files are read only
+    once.
+    """
+    _progress_unit = 'B'
+    _row_extractor = staticmethod(extract_rows)
+
+    def __init__(self, paths, log_format=TIMED_COMBINED_FORMAT, chunk_size=32 * 1024 * 1024, workers=None):
+        """Nginx backend init method.
+
+        :param paths: Log files or glob patterns, e.g: '/var/log/nginx/access.log*'.
+        :type paths: str or list
+        :param log_format: Nginx log_format of the files. It must contain $request, $request_uri or $uri variables.
+        :type log_format: str
+        :param chunk_size: Approximate size in bytes of each parsed chunk.
+        :type chunk_size: int
+        :param workers: Number of worker processes, defaults to number of CPUs. If 1, chunks are parsed in this process.
+        :type workers: int
+        """
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
+
+        self._paths = []
+        for path in paths:
+            self._paths.extend(sorted(glob.glob(path)) or [path])
+
+        self._log_format = log_format
+        self._regex = compile_log_format(log_format)
+        if _first_group(self._regex, REQUEST_VARIABLES)[0] is None:
+            raise NginxException("Log format '{}' doesn't contain a request variable".format(log_format))
+
+        self._chunk_size = chunk_size
+        self._workers = workers or cpu_count()
+
+        # Bytes of all files, and bytes read until each result not consumed yet
+        self._total_bytes = 0
+        self._offsets = deque()
+
+        super(NginxURLFlowBackend, self).__init__()
+
+    def extract_url_from_result(self, result, regex=None):
+        return extract_rows(result, regex)
+
+    def _plain_chunks(self, path):
+        """Split a plain file into byte ranges that end at a line end.
+
+        :param path: Log file.
+        :type path: str
+        :return: (path, start, end) ranges and bytes read of the file.
+        :rtype: generator
+        """
+        size = os.path.getsize(path)
+        if not size:
+            return
+
+        with open(path, 'rb') as log_file:
+            log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                while start < size:
+                    end = log_map.find(b'\n', min(start + self._chunk_size, size) - 1) + 1 or size
+                    yield (path, start, end), end
+                    start = end
+            finally:
+                log_map.close()
+
+    def _gzip_chunks(self, path):
+        """Decompress a gzip file into blocks of whole lines.
+
+        :param path: Log file.
+        :type path: str
+        :return: Blocks of lines and compressed bytes read of the file.
+        :rtype: generator
+        """
+        size = os.path.getsize(path)
+        with _open_log(path) as log_file:
+            remainder = b''
+            block = log_file.read(self._chunk_size)
+            while block:
+                block = remainder + block
+                last_line = block.rfind(b'\n') + 1
+                remainder = block[last_line:]
+                if last_line:
+                    yield block[:last_line], min(log_file.fileobj.tell(), size)
+                block = log_file.read(self._chunk_size)
+
+            if remainder:
+                yield remainder, size
+
+    def _chunks(self):
+        """Split all files into chunks.
+
+        :return: Parsing tasks and bytes read of all files until the end of each chunk.
+        :rtype: generator
+        """
+        previous_files = 0
+        for path in self._paths:
+            if path.endswith('.gz'):
+                chunks = self._gzip_chunks(path)
+            else:
+                chunks = self._plain_chunks(path)
+
+            for chunk, offset in chunks:
+                yield (self._regex, chunk), previous_files + offset
+
+            previous_files += os.path.getsize(path)
+
+    def _progress(self, count, rows):
+        return self._offsets.popleft(), self._total_bytes
+
+    def __iter__(self):
+        self._total_bytes = sum(os.path.getsize(path) for path in self._paths)
+        self._offsets.clear()
+
+        if self._workers == 1:
+            for task, offset in self._chunks():
+                rows = _parse_chunk(task)
+                self._offsets.append(offset)
+                yield rows
+            return
+
+        pool = Pool(self._workers)
+        try:
+            # Keep a bounded number of chunks in flight, so compressed files aren't fully decompressed in memory
+            pending = deque()
+            for task, offset in self._chunks():
+                pending.append((pool.apply_async(_parse_chunk, (task,)), offset))
+                if len(pending) >= 2 * self._workers:
+                    result, offset = pending.popleft()
+                    rows = result.get()
+                    self._offsets.append(offset)
+                    yield rows
+
+            while pending:
+                result, offset = pending.popleft()
+                rows = result.get()
+                self._offsets.append(offset)
+                yield rows
+        finally:
+            pool.terminate()
@@ -0,0 +1,223 @@
+"""Vectorized time stats of URL flows grouped by request, or any other columns.
+"""
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+PERCENTILES = (0.9, 0.95, 0.99)
+
+
+def sorted_group_quantiles(values, starts, counts, q):
+    """Quantile of each group of sorted values, linearly interpolated as pandas does.
+
+    :param values: Values sorted by group and then by value.
+    :type values: numpy.array
+    :param starts: Position of the first value of each group.
+    :type starts: numpy.array
+    :param counts: Number of values of each group.
+    :type counts: numpy.array
+    :param q: Quantile (0-1).
+    :type q: float
+    :return: Quantile of each group, NaN for empty groups.
+    :rtype: numpy.array
+    """
+    quantiles = np.full(len(counts), np.nan)
+    not_empty = counts > 0
+    starts, counts = starts[not_empty], counts[not_empty]
+
+    position = (counts - 1) * q
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    lower_values, upper_values = values[starts + lower], values[starts + upper]
+    quantiles[not_empty] = lower_values + (position - lower) * (upper_values - lower_values)
+
+    return quantiles
+
+
+def _groups(codes, num_groups):
+    counts = np.bincount(codes, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    return starts, counts
+
+
+def grouped_time_stats(data, by, lower_quantile=0.05, upper_quantile=0.95, percentiles=PERCENTILES, days=5):
+    """Calculate time stats of each group: count by week, count by day, mean, standard deviation, max, min, sum,
+    median and percentiles. Times below lower quantile of its group are considered noise and removed, and then times
+    above upper quantile of the remaining ones.
+
+    All groups are computed at once: rows are sorted by group and time, so quantiles are read by position and noise
+    is removed with a single mask for all groups.
+
+    :param data: URL flow with a Time column.
+    :type data: pandas.DataFrame
+    :param by: Grouping columns.
+    :type by: str or list
+    :param lower_quantile: Lower noise quantile (0-1).
+    :type lower_quantile: float
+    :param upper_quantile: Upper noise quantile (0-1).
+    :type upper_quantile: float
+    :param percentiles: Additional percentiles (0-1).
+    :type percentiles: iter
+    :param days: Number of days covered by data, used to calculate count by day.
+    :type days: float
+    :return: Stats of each group.
+    :rtype: pandas.DataFrame
+    """
+    grouped = data.groupby(by, sort=True, observed=True)
+    index = grouped.size().index
+    codes = grouped.ngroup().values
+    times = data['Time'].values.astype(np.float64)
+
+    # Rows without time or without group are ignored
+    valid = ~np.isnan(times) & ~pd.isnull(codes)
+    codes, times = codes[valid].astype(np.int64), times[valid]
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
+
+    # Remove noise
+    starts, counts = _groups(codes, len(index))
+    keep = times >= sorted_group_quantiles(times, starts, counts, lower_quantile)[codes]
+    codes, times = codes[keep], times[keep]
+    starts, counts = _groups(codes, len(index))
+    keep = times <= sorted_group_quantiles(times, starts, counts, upper_quantile)[codes]
+    codes, times = codes[keep], times[keep]
+    starts, counts = _groups(codes, len(index))
+
+    # Stats
+    not_empty = counts > 0
+    total = np.bincount(codes, weights=times, minlength=len(index))
+    mean = np.full(len(index), np.nan)
+    np.divide(total, counts, out=mean, where=not_empty)
+    variance = np.full(len(index), np.nan)
+    np.divide(np.bincount(codes, weights=(times - mean[codes]) ** 2, minlength=len(index)), counts, out=variance,
+              where=not_empty)
+    minimum = np.full(len(index), np.nan)
+    minimum[not_empty] = times[starts[not_empty]]
+    maximum = np.full(len(index), np.nan)
+    maximum[not_empty] = times[starts[not_empty] + counts[not_empty] - 1]
+
+    stats = OrderedDict((
+        ('Count By Week', counts),
+        ('Count By Day', counts / days),
+        ('Mean', mean),
+        ('Std', np.sqrt(variance)),
+        ('Max', maximum),
+        ('Min', minimum),
+        ('Sum', total),
+        ('Median', sorted_group_quantiles(times, starts, counts, 0.5)),
+    ))
+    for q in percentiles:
+        stats['P{:g}'.format(q * 100)] = sorted_group_quantiles(times, starts, counts, q)
+
+    return pd.DataFrame(stats, index=index, columns=list(stats.keys()))
+
+
+def _sort_groups(codes, values, num_groups):
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    starts, counts = _groups(codes, num_groups)
+    return codes, values, starts, counts, order
+
+
+def grouped_mann_whitney(codes, is_new, values, num_groups):
+    """Two-sided Mann-Whitney U test of each group, comparing its old and new values. All groups are ranked at once
+    and p-values use the normal approximation with tie and continuity corrections.
+
+    :param codes: Group of each value.
+    :type codes: numpy.array
+    :param is_new: True for new values, False for old ones.
+    :type is_new: numpy.array
+    :param values: Values.
+    :type values: numpy.array
+    :param num_groups: Number of groups.
+    :type num_groups: int
+    :return: U statistic of new values and p-value of each group, NaN if any sample is empty.
+    :rtype: tuple
+    """
+    codes, values, group_starts, counts, order = _sort_groups(codes, values, num_groups)
+    is_new = np.asarray(is_new, dtype=float)[order]
+
+    # Tied values share the mean of their ranks
+    changes = np.flatnonzero((np.diff(codes) != 0) | (np.diff(values) != 0)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [len(values)]))
+    ranks = np.repeat((starts + ends + 1) / 2, ends - starts) - group_starts[codes]
+
+    num_new = np.bincount(codes, weights=is_new, minlength=num_groups)
+    num_old = counts - num_new
+    u = np.bincount(codes, weights=ranks * is_new, minlength=num_groups) - num_new * (num_new + 1) / 2
+
+    ties = (ends - starts).astype(float)
+    ties = np.bincount(codes[starts], weights=ties ** 3 - ties, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(num_old * num_new / 12 * ((counts + 1) - ties / (counts * (counts - 1))))
+        z = np.maximum(np.abs(u - num_old * num_new / 2) - 0.5, 0) / sigma
+    p_value = np.minimum(2 * norm.sf(z), 1)
+    p_value[sigma == 0] = 1
+    u[(num_old == 0) | (num_new == 0)] = np.nan
+    p_value[(num_old == 0) | (num_new == 0)] = np.nan
+
+    return u, p_value
+
+
+def grouped_bootstrap_quantile(codes, is_new, values, num_groups, q=0.5, iterations=1000, alpha=0.05,
+                               random_state=None, batch_size=4000000):
+    """Bootstrap confidence interval of the difference between new and old quantiles of each group.
+
+    Quantile of a resample of n values is its k-th order statistic, whose position in the original sorted values
+    follows a Beta(k, n - k + 1) distribution. So resamples are drawn as beta variates for all groups at once,
+    instead of resampling every group in a loop.
+
+    :param codes: Group of each value.
+    :type codes: numpy.array
+    :param is_new: True for new values, False for old ones.
+    :type is_new: numpy.array
+    :param values: Values.
+    :type values: numpy.array
+    :param num_groups: Number of groups.
+    :type num_groups: int
+    :param q: Quantile (0-1).
+    :type q: float
+    :param iterations: Number of resamples.
+    :type iterations: int
+    :param alpha: Significance level of the interval.
+    :type alpha: float
+    :param random_state: Random seed or state.
+    :type random_state: int or numpy.random.RandomState
+    :param batch_size: Maximum number of draws held in memory at once.
+    :type batch_size: int
+    :return: Lower and upper bounds of each group, NaN if any sample is empty.
+    :rtype: tuple
+    """
+    random_state = random_state if isinstance(random_state, np.random.RandomState) else \
+        np.random.RandomState(random_state)
+    is_new = np.asarray(is_new, dtype=bool)
+
+    samples = []
+    for side in (~is_new, is_new):
+        side_codes, side_values, starts, counts, _ = _sort_groups(codes[side], values[side], num_groups)
+        samples.append((side_values, starts, counts))
+
+    lower = np.full(num_groups, np.nan)
+    upper = np.full(num_groups, np.nan)
+    groups = np.flatnonzero((samples[0][2] > 0) & (samples[1][2] > 0))
+    step = max(batch_size // iterations, 1)
+    for batch in range(0, len(groups), step):
+        batch_groups = groups[batch:batch + step]
+        quantiles = []
+        for (side_values, starts, counts) in samples:
+            n = counts[batch_groups]
+            k = np.clip(np.ceil(q * n), 1, n)
+            positions = random_state.beta(k, n - k + 1, size=(iterations, len(batch_groups)))
+            positions = np.minimum((positions * n).astype(np.int64), n - 1)
+            quantiles.append(side_values[starts[batch_groups] + positions])
+
+        difference = quantiles[1] - quantiles[0]
+        lower[batch_groups], upper[batch_groups] = np.percentile(difference, [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                                                                 axis=0)
+
+    return lower, upper
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""Columnar format for URL flows. Flows are stored in a numpy .npz file where referrers and requests are integer
+codes of a shared dictionary of URLs, timestamps are milliseconds since epoch and times are single precision floats.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pandas.errors import EmptyDataError
+except ImportError:
+    EmptyDataError = ValueError
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+COLUMNAR_VERSION = 1
+
+# Since pandas 2.0, format of datetimes is guessed from the first value unless they are parsed as ISO 8601, that
+# allows mixing precisions and offsets
+ISO8601_OPTIONS = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+
+def is_columnar_file(filename):
+    """Check if an input is the path of a columnar file. File objects are read as CSV files.
+
+    :param filename: Input file path or file object.
+    :type filename: str or file
+    :return: True if it's a columnar .npz file.
+    :rtype: bool
+    """
+    return isinstance(filename, string_types) and filename.endswith('.npz')
+
+
+def encode_strings(strings):
+    """Encode strings as a buffer of utf-8 encoded strings and their offsets.
+
+    :param strings: Strings.
+    :type strings: list
+    :return: Buffer and offsets.
+    :rtype: tuple
+    """
+    encoded = [s if isinstance(s, bytes) else s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(buffer, offsets):
+    """Decode strings from a buffer of utf-8 encoded strings and their offsets.
+
+    :param buffer: Buffer.
+    :type buffer: numpy.array
+    :param offsets: Offsets.
+    :type offsets: numpy.array
+    :return: Strings.
+    :rtype: list
+    """
+    buffer = buffer.tobytes()
+    offsets = offsets.tolist()
+    return [buffer[start:end].decode('utf-8') for (start, end) in zip(offsets[:-1], offsets[1:])]
+
+
+def parse_timestamps(timestamps):
+    """Convert ISO 8601 timestamps to milliseconds since epoch, in UTC. Each timestamp can have its own precision and
+    offset. Missing and invalid timestamps are converted to the minimum int64 value, that is read back as NaT, and a
+    warning is issued for invalid ones.
+
+    :param timestamps: Timestamps.
+    :type timestamps: list
+    :return: Timestamps.
+    :rtype: numpy.array
+    """
+    values = pd.Series(timestamps, dtype=object)
+    parsed = pd.to_datetime(values, utc=True, errors='coerce', **ISO8601_OPTIONS)
+
+    invalid = parsed.isnull() & values.notnull() & (values != '')
+    if invalid.any():
+        warnings.warn("{:d} invalid timestamps, like '{}', are converted to NaT".format(
+            int(invalid.sum()), values[invalid].iloc[0]))
+
+    return parsed.dt.tz_localize(None).values.astype('datetime64[ms]').astype(np.int64)
+
+
+class ColumnarWriter(object):
+    """Write URL flow rows to a columnar file. Rows are encoded as they are written and file is saved when writer is
+    closed.
+    """
+
+    def __init__(self, filename, metadata=None):
+        """Columnar writer init method.
+
+        :param filename: Output .npz file.
+        :type filename: str
+        :param metadata: Additional scalar values stored in the file.
+        :type metadata: dict
+        """
+        self._filename = filename
+        self._metadata = metadata or {}
+        self._codes = {}
+        self._timestamp = []
+        self._referrer = []
+        self._request = []
+        self._time = []
+
+    def _encode(self, urls):
+        """Encode URLs as codes of the dictionary. Each distinct URL of the batch is looked up only once and missing
+        values are encoded as -1.
+        """
+        codes, uniques = pd.factorize(np.asarray(urls, dtype=object))
+        dictionary = self._codes
+        mapping = np.array([dictionary.setdefault(url, len(dictionary)) for url in uniques] + [-1], dtype=np.int32)
+        return mapping[codes]
+
+    def write(self, rows):
+        """Write a batch of rows.
+
+        :param rows: List of (timestamp, referrer, request, time) rows.
+        :type rows: list
+        """
+        if not rows:
+            return
+
+        timestamps, referrers, requests, times = zip(*rows)
+        self.write_columns(parse_timestamps(timestamps), referrers, requests, times)
+
+    def write_columns(self, timestamps, referrers, requests, times):
+        """Write a batch of rows given as columns.
+
+        :param timestamps: Milliseconds since epoch.
+        :type timestamps: numpy.array
+        :param referrers: Referrer URLs.
+        :type referrers: list or pandas.Series
+        :param requests: Request URLs.
+        :type requests: list or pandas.Series
+        :param times: Request times.
+        :type times: list or pandas.Series
+        """
+        self._timestamp.append(np.asarray(timestamps, dtype=np.int64))
+        self._referrer.append(self._encode(referrers))
+        self._request.append(self._encode(requests))
+        self._time.append(np.asarray(times, dtype=np.float32))
+
+    def columns(self):
+        """Get all rows written as columns. URLs dictionary is sorted, so codes follow lexicographic order of URLs.
+
+        :return: URLs dictionary and timestamp, referrer, request and time columns.
+        :rtype: dict
+        """
+        urls = [None] * len(self._codes)
+        for (url, code) in self._codes.items():
+            urls[code] = url
+
+        order = sorted(range(len(urls)), key=urls.__getitem__)
+        new_codes = np.empty(len(urls) + 1, dtype=np.int32)
+        new_codes[order] = np.arange(len(urls), dtype=np.int32)
+        # Missing values keep -1 code
+        new_codes[-1] = -1
+
+        return {
+            'urls': [urls[i] for i in order],
+            'timestamp': np.concatenate(self._timestamp or [np.empty(0, dtype=np.int64)]),
+            'referrer': new_codes[np.concatenate(self._referrer or [np.empty(0, dtype=np.int32)])],
+            'request': new_codes[np.concatenate(self._request or [np.empty(0, dtype=np.int32)])],
+            'time': np.concatenate(self._time or [np.empty(0, dtype=np.float32)]),
+        }
+
+    def close(self):
+        """Save all rows written.
+
+        :return: URLs dictionary and timestamp, referrer, request and time columns.
+        :rtype: dict
+        """
+        columns = self.columns()
+        buffer, offsets = encode_strings(columns['urls'])
+        arrays = {name: np.array(value) for (name, value) in self._metadata.items()}
+
+        with open(self._filename, 'wb') as output:
+            np.savez(output, version=np.array(COLUMNAR_VERSION), urls=buffer, url_offsets=offsets,
+                     timestamp=columns['timestamp'], referrer=columns['referrer'], request=columns['request'],
+                     time=columns['time'], **arrays)
+
+        return columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+def load_columnar(filename):
+    """Load raw columns of a columnar file.
+
+    :param filename: Columnar .npz file.
+    :type filename: str
+    :return: URLs dictionary and timestamp, referrer, request and time columns.
+    :rtype: dict
+    """
+    with np.load(filename) as columnar:
+        columns = {name: columnar[name] for name in ('timestamp', 'referrer', 'request', 'time')}
+        columns['urls'] = decode_strings(columnar['urls'], columnar['url_offsets'])
+
+    return columns
+
+
+def columns_to_frame(columns):
+    """Build a DataFrame with Timestamp, Referrer, Request and Time columns. Referrer and Request are categorical
+    columns that share URLs dictionary.
+
+    :param columns: URLs dictionary and timestamp, referrer, request and time columns.
+    :type columns: dict
+    :return: URL flow.
+    :rtype: pandas.DataFrame
+    """
+    urls = pd.Index(columns['urls'], dtype=object)
+
+    return pd.DataFrame({
+        'Timestamp': columns['timestamp'].astype('datetime64[ms]'),
+        'Referrer': pd.Categorical.from_codes(columns['referrer'], categories=urls),
+        'Request': pd.Categorical.from_codes(columns['request'], categories=urls),
+        'Time': columns['time'],
+    }, columns=['Timestamp', 'Referrer', 'Request', 'Time'])
+
+
+def read_columnar(filename):
+    """Read a columnar file as a DataFrame with Timestamp, Referrer, Request and Time columns. Referrer and Request
+    are categorical columns that share URLs dictionary.
+
+    :param filename: Columnar .npz file.
+    :type filename: str
+    :return: URL flow.
+    :rtype: pandas.DataFrame
+    """
+    return columns_to_frame(load_columnar(filename))
+
+
+def _source_key(filename):
+    stat = os.stat(filename)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+
+def _read_cache(cache_filename, key):
+    """Read a columnar cache if it was generated from the same version of its source file.
+    """
+    try:
+        with np.load(cache_filename) as columnar:
+            if any(name not in columnar.files or columnar[name] != value for (name, value) in key.items()):
+                return None
+    except (IOError, OSError, ValueError):
+        return None
+
+    return load_columnar(cache_filename)
+
+
+def read_csv(filename, chunksize=100000, cache=False):
+    """Read a CSV file generated by URL flow backends in chunks, keeping only Timestamp, Referrer, Request and Time
+    columns. Each chunk is encoded as soon as it's read: URLs as codes of a dictionary, timestamps as milliseconds
+    and times as single precision floats, so memory is a fraction of the one needed by text columns.
+
+    Optionally, encoded columns of a CSV file path are cached in a columnar sidecar file (filename + '.npz') that is
+    reused while the size and modification time of the CSV file don't change.
+
+    :param filename: Input CSV file path or file object.
+    :type filename: str or file
+    :param chunksize: Number of rows of each chunk.
+    :type chunksize: int
+    :param cache: If true, read and write the columnar sidecar file. File objects aren't cached.
+    :type cache: bool
+    :return: URL flow.
+    :rtype: pandas.DataFrame
+    """
+    usecols, key = None, {}
+    cache_filename = '{}.npz'.format(filename) if isinstance(filename, string_types) else None
+    if cache_filename is not None:
+        key = _source_key(filename)
+        if cache:
+            columns = _read_cache(cache_filename, key)
+            if columns is not None:
+                return columns_to_frame(columns)
+
+        # Header of file objects can't be read twice, so their unused columns are dropped once read
+        try:
+            header = pd.read_csv(filename, nrows=0).columns
+        except EmptyDataError:
+            # Empty file, without header
+            header = []
+        usecols = [c for c in ('Timestamp', 'Referrer', 'Request', 'Time') if c in header]
+    dtype = {'Timestamp': object, 'Referrer': object, 'Request': object, 'Time': np.float32}
+
+    writer = ColumnarWriter(cache_filename, metadata=key)
+    try:
+        chunks = pd.read_csv(filename, usecols=usecols, dtype=dtype, chunksize=chunksize)
+    except EmptyDataError:
+        # Empty file, without header, has no rows
+        chunks = []
+
+    for chunk in chunks:
+        if 'Timestamp' in chunk:
+            timestamps = parse_timestamps(chunk['Timestamp'].values)
+        else:
+            timestamps = np.full(len(chunk), np.iinfo(np.int64).min, dtype=np.int64)
+        times = chunk['Time'].values if 'Time' in chunk else np.full(len(chunk), np.nan, dtype=np.float32)
+
+        writer.write_columns(timestamps, chunk['Referrer'].values, chunk['Request'].values, times)
+
+    if cache and cache_filename is not None:
+        try:
+            return columns_to_frame(writer.close())
+        except (IOError, OSError):
+            # Cache is optional, so it's ignored if it can't be written
+            pass
+
+    return columns_to_frame(writer.columns())
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+import pandas as pd
+
+from performance_tools.exceptions import SketchException
+
+# Latency histogram buckets edges, in seconds: powers of two from 1ms to ~65s
+LATENCY_EDGES = 0.001 * 2. ** np.arange(17)
+
+# Histogram bins edges of reports, in seconds: ten bins per decade from 1ms to 100s
+HISTOGRAM_EDGES = 0.001 * 10. ** (np.arange(51) / 10.)
+
+
+def bucketize(values, edges=LATENCY_EDGES):
+    """Get the histogram bucket of each value. Bucket i contains values in [edges[i - 1], edges[i]), first bucket
+    contains values lower than first edge and last bucket contains values greater or equal than last edge.
+
+    :param values: Values.
+    :type values: numpy.array
+    :param edges: Buckets edges.
+    :type edges: numpy.array
+    :return: Bucket of each value.
+    :rtype: numpy.array
+    """
+    return np.searchsorted(edges, values, side='right')
+
+
+def bucket_edges(edges=LATENCY_EDGES):
+    """Get the lower and upper edges of all buckets of bucketize. First and last buckets are open-ended, so they are
+    closed as wide as their neighbours in log scale.
+
+    :param edges: Buckets edges.
+    :type edges: numpy.array
+    :return: Edges of all buckets, one more than buckets.
+    :rtype: numpy.array
+    """
+    return np.concatenate(([edges[0] ** 2 / edges[1]], edges, [edges[-1] ** 2 / edges[-2]]))
+
+
+def binned_histograms(data, by='Request', column='Time', edges=HISTOGRAM_EDGES):
+    """Calculate histograms of times of all groups at once. Times out of edges are counted in first and last bins.
+
+    :param data: Data with times and grouping columns.
+    :type data: pandas.DataFrame
+    :param by: Grouping columns.
+    :type by: str or list
+    :param column: Times column.
+    :type column: str
+    :param edges: Bins edges.
+    :type edges: numpy.array
+    :return: Count of each bin by group, with bins lower edges as columns.
+    :rtype: pandas.DataFrame
+    """
+    num_bins = len(edges) - 1
+    grouped = data.groupby(by, sort=True, observed=True)
+    index = grouped.size().index
+    groups = grouped.ngroup().values
+    times = data[column].values.astype(np.float64)
+
+    # Times without group or without value are ignored
+    valid = ~np.isnan(times) & ~pd.isnull(groups)
+    groups, times = groups[valid].astype(np.int64), times[valid]
+
+    bins = np.clip(np.searchsorted(edges, times, side='right') - 1, 0, num_bins - 1)
+    counts = np.bincount(groups * num_bins + bins, minlength=len(index) * num_bins)
+    return pd.DataFrame(counts.reshape((len(index), num_bins)), index=index, columns=edges[:-1])
+
+
+class LatencyAggregates(object):
+    """Latency aggregates of a collection of keys, like digraph arcs or vertices: count, sum, min, max and a
+    log-bucketed histogram of times. All aggregates are arrays indexed by key.
+    """
+
+    def __init__(self, count, total, minimum, maximum, histogram, edges=LATENCY_EDGES):
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.histogram = histogram
+        self.edges = edges
+
+    @classmethod
+    def from_samples(cls, keys, times, size, edges=LATENCY_EDGES):
+        """Aggregate time samples by key. Samples without time (NaN) are ignored.
+
+        :param keys: Key of each sample.
+        :type keys: numpy.array
+        :param times: Time of each sample.
+        :type times: numpy.array
+        :param size: Number of keys.
+        :type size: int
+        :param edges: Histogram buckets edges.
+        :type edges: numpy.array
+        :return: Aggregates.
+        :rtype: LatencyAggregates
+        """
+        times = np.asarray(times, dtype=float)
+        valid = ~np.isnan(times)
+        keys, times = np.asarray(keys, dtype=np.int64)[valid], times[valid]
+
+        num_buckets = len(edges) + 1
+        count = np.bincount(keys, minlength=size).astype(np.int64)
+        total = np.bincount(keys, weights=times, minlength=size)
+        minimum = np.full(size, np.inf)
+        np.minimum.at(minimum, keys, times)
+        maximum = np.full(size, -np.inf)
+        np.maximum.at(maximum, keys, times)
+        histogram = np.bincount(keys * num_buckets + bucketize(times, edges), minlength=size * num_buckets)
+        histogram = histogram.reshape((size, num_buckets)).astype(np.uint32)
+
+        return cls(count, total, minimum, maximum, histogram, edges)
+
+    @classmethod
+    def concatenate(cls, aggregates):
+        """Concatenate aggregates of different keys.
+
+        :param aggregates: Aggregates.
+        :type aggregates: list
+        :return: Aggregates.
+        :rtype: LatencyAggregates
+        """
+        return cls(
+            np.concatenate([a.count for a in aggregates]),
+            np.concatenate([a.total for a in aggregates]),
+            np.concatenate([a.minimum for a in aggregates]),
+            np.concatenate([a.maximum for a in aggregates]),
+            np.concatenate([a.histogram for a in aggregates]),
+            aggregates[0].edges,
+        )
+
+    def __len__(self):
+        return len(self.count)
+
+    def take(self, positions):
+        """Get aggregates of given keys.
+
+        :param positions: Keys positions.
+        :type positions: numpy.array
+        :return: Aggregates.
+        :rtype: LatencyAggregates
+        """
+        return LatencyAggregates(self.count[positions], self.total[positions], self.minimum[positions],
+                                 self.maximum[positions], self.histogram[positions], self.edges)
+
+    def reduce(self, keys, size):
+        """Merge aggregates that share the same new key.
+
+        :param keys: New key of each current key.
+        :type keys: numpy.array
+        :param size: Number of new keys.
+        :type size: int
+        :return: Aggregates.
+        :rtype: LatencyAggregates
+        """
+        count = np.zeros(size, dtype=np.int64)
+        np.add.at(count, keys, self.count)
+        total = np.bincount(keys, weights=self.total, minlength=size)
+        minimum = np.full(size, np.inf)
+        np.minimum.at(minimum, keys, self.minimum)
+        maximum = np.full(size, -np.inf)
+        np.maximum.at(maximum, keys, self.maximum)
+        histogram = np.zeros((size, self.histogram.shape[1]), dtype=self.histogram.dtype)
+        np.add.at(histogram, keys, self.histogram)
+
+        return LatencyAggregates(count, total, minimum, maximum, histogram, self.edges)
+
+    def mean(self):
+        """Mean time of each key, NaN for keys without samples.
+
+        :return: Means.
+        :rtype: numpy.array
+        """
+        mean = np.full(len(self), np.nan)
+        np.divide(self.total, self.count, out=mean, where=self.count > 0)
+        return mean
+
+    def quantile(self, q):
+        """Approximate quantile of each key from its histogram, interpolated inside the bucket and bounded by
+        min and max times.
+
+        :param q: Quantile (0-1).
+        :type q: float
+        :return: Quantiles.
+        :rtype: numpy.array
+        """
+        cumulative = np.cumsum(self.histogram, axis=1, dtype=np.int64)
+        target = q * self.count
+        buckets = np.minimum((cumulative < target[:, np.newaxis]).sum(axis=1), self.histogram.shape[1] - 1)
+
+        keys = np.arange(len(self))
+        lower = np.maximum(np.concatenate(([0.], self.edges))[buckets], self.minimum)
+        upper = np.minimum(np.concatenate((self.edges, [np.inf]))[buckets], self.maximum)
+        below = cumulative[keys, buckets] - self.histogram[keys, buckets]
+        fraction = np.zeros(len(self))
+        np.divide(target - below, self.histogram[keys, buckets], out=fraction, where=self.histogram[keys, buckets] > 0)
+
+        # Keys without samples have infinite bounds
+        with np.errstate(invalid='ignore'):
+            quantile = lower + np.clip(fraction, 0, 1) * (upper - lower)
+        quantile[self.count == 0] = np.nan
+        return quantile
+
+    def to_frame(self, index=None):
+        """Build a DataFrame with count, sum, mean, min, max and approximate median of each key.
+
+        :param index: DataFrame index.
+        :return: Aggregates.
+        :rtype: pandas.DataFrame
+        """
+        has_samples = self.count > 0
+        return pd.DataFrame({
+            'Count': self.count,
+            'Sum': self.total,
+            'Mean': self.mean(),
+            'Min': np.where(has_samples, self.minimum, np.nan),
+            'Max': np.where(has_samples, self.maximum, np.nan),
+            'Median': self.quantile(0.5),
+        }, index=index, columns=['Count', 'Sum', 'Mean', 'Min', 'Max', 'Median'])
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketches of a collection of keys, like requests. Times are counted in logarithmic buckets
+    whose width is proportional to their value, so any quantile is estimated with a bounded relative error while
+    memory only depends on the number of keys. Count, sum, sum of squares, min and max of each key are kept exactly.
+
+    Sketches with the same parameters are merged adding their counts, so sketches of different days or machines
+    can be combined without loss.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-4, max_value=1e4, size=0):
+        """Quantile sketch init method.
+
+        :param relative_accuracy: Maximum relative error of quantiles (0-1).
+        :type relative_accuracy: float
+        :param min_value: Minimum time tracked with relative accuracy, lower times are counted as this value.
+        :type min_value: float
+        :param max_value: Maximum time tracked with relative accuracy, greater times are counted as this value.
+        :type max_value: float
+        :param size: Initial number of keys.
+        :type size: int
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        self._min_index = int(np.ceil(np.log(min_value) / self._log_gamma))
+        num_buckets = int(np.ceil(np.log(max_value) / self._log_gamma)) - self._min_index + 2
+
+        # Representative value of each bucket, first bucket contains times lower than min value
+        indexes = np.arange(num_buckets - 1) + self._min_index
+        self._values = np.concatenate(([min_value], 2 * self._gamma ** indexes / (self._gamma + 1)))
+
+        self.count = np.zeros(size, dtype=np.int64)
+        self.total = np.zeros(size)
+        self.squares = np.zeros(size)
+        self.minimum = np.full(size, np.inf)
+        self.maximum = np.full(size, -np.inf)
+        self.buckets = np.zeros((size, num_buckets), dtype=np.uint32)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build a sketch from the arrays of its state.
+
+        :param arrays: Sketch state.
+        :type arrays: dict
+        :return: Sketch.
+        :rtype: QuantileSketch
+        """
+        sketch = cls(float(arrays['relative_accuracy']), float(arrays['min_value']), float(arrays['max_value']))
+        for name in ('count', 'total', 'squares', 'minimum', 'maximum', 'buckets'):
+            setattr(sketch, name, np.array(arrays[name]))
+
+        return sketch
+
+    def to_arrays(self):
+        """Get the state of this sketch as arrays, to be saved.
+
+        :return: Sketch state.
+        :rtype: dict
+        """
+        return {
+            'relative_accuracy': np.array(self.relative_accuracy),
+            'min_value': np.array(self.min_value),
+            'max_value': np.array(self.max_value),
+            'count': self.count,
+            'total': self.total,
+            'squares': self.squares,
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'buckets': self.buckets,
+        }
+
+    def __len__(self):
+        return len(self.count)
+
+    def _resize(self, size):
+        """Make room for keys lower than size.
+        """
+        grow = size - len(self)
+        if grow <= 0:
+            return
+
+        self.count = np.concatenate((self.count, np.zeros(grow, dtype=np.int64)))
+        self.total = np.concatenate((self.total, np.zeros(grow)))
+        self.squares = np.concatenate((self.squares, np.zeros(grow)))
+        self.minimum = np.concatenate((self.minimum, np.full(grow, np.inf)))
+        self.maximum = np.concatenate((self.maximum, np.full(grow, -np.inf)))
+        self.buckets = np.concatenate((self.buckets, np.zeros((grow, self.buckets.shape[1]), dtype=np.uint32)))
+
+    def bucketize(self, values):
+        """Get the bucket of each value.
+
+        :param values: Times.
+        :type values: numpy.array
+        :return: Buckets.
+        :rtype: numpy.array
+        """
+        with np.errstate(divide='ignore'):
+            indexes = np.ceil(np.log(np.maximum(values, 0)) / self._log_gamma)
+        return np.clip(indexes - self._min_index + 1, 0, self.buckets.shape[1] - 1).astype(np.int64)
+
+    def add(self, keys, values):
+        """Add a batch of times. Times without value (NaN) are ignored.
+
+        :param keys: Key of each time.
+        :type keys: numpy.array
+        :param values: Times.
+        :type values: numpy.array
+        """
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        keys, values = np.asarray(keys, dtype=np.int64)[valid], values[valid]
+        if not len(keys):
+            return
+
+        self._check_keys(keys)
+        self._resize(int(keys.max()) + 1)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        self.count[unique_keys] += np.bincount(inverse)
+        self.total[unique_keys] += np.bincount(inverse, weights=values)
+        self.squares[unique_keys] += np.bincount(inverse, weights=values ** 2)
+        np.minimum.at(self.minimum, keys, values)
+        np.maximum.at(self.maximum, keys, values)
+
+        cells, cells_count = np.unique(keys * self.buckets.shape[1] + self.bucketize(values), return_counts=True)
+        self.buckets.reshape(-1)[cells] += cells_count.astype(np.uint32)
+
+    @staticmethod
+    def _check_keys(keys):
+        if keys.min() < 0:
+            raise SketchException("Keys must be non-negative, missing keys must be removed")
+
+    def _check_compatible(self, other):
+        if (self.relative_accuracy, self.min_value, self.max_value) != \
+                (other.relative_accuracy, other.min_value, other.max_value):
+            raise SketchException("Sketches with different parameters can't be merged")
+
+    def merge(self, other, keys=None):
+        """Merge other sketch into this one.
+
+        :param other: Sketch with the same parameters.
+        :type other: QuantileSketch
+        :param keys: Key in this sketch of each key of the other one, defaults to the same key. Many keys of the other
+        sketch can be merged into the same key.
+        :type keys: numpy.array
+        """
+        self._check_compatible(other)
+        keys = np.arange(len(other)) if keys is None else np.asarray(keys, dtype=np.int64)
+        if not len(keys):
+            return
+
+        self._check_keys(keys)
+        self._resize(int(keys.max()) + 1)
+
+        if len(np.unique(keys)) == len(keys):
+            self.count[keys] += other.count
+            self.total[keys] += other.total
+            self.squares[keys] += other.squares
+            self.minimum[keys] = np.minimum(self.minimum[keys], other.minimum)
+            self.maximum[keys] = np.maximum(self.maximum[keys], other.maximum)
+            self.buckets[keys] += other.buckets
+        else:
+            # Many keys of the other sketch are merged into the same key, so updates are unbuffered
+            np.add.at(self.count, keys, other.count)
+            np.add.at(self.total, keys, other.total)
+            np.add.at(self.squares, keys, other.squares)
+            np.minimum.at(self.minimum, keys, other.minimum)
+            np.maximum.at(self.maximum, keys, other.maximum)
+            np.add.at(self.buckets, keys, other.buckets)
+
+    def histogram(self, edges=HISTOGRAM_EDGES):
+        """Count times of each key in bins of given edges. Each bucket is counted in the bin of its representative
+        value, so bins much narrower than buckets aren't accurate. Times out of edges are counted in first and last
+        bins.
+
+        :param edges: Bins edges.
+        :type edges: numpy.array
+        :return: Count of each bin by key.
+        :rtype: numpy.array
+        """
+        num_bins = len(edges) - 1
+        bins = np.clip(np.searchsorted(edges, self._values, side='right') - 1, 0, num_bins - 1)
+        membership = np.zeros((len(self._values), num_bins), dtype=np.int64)
+        membership[np.arange(len(self._values)), bins] = 1
+        return self.buckets.dot(membership)
+
+    def mean(self):
+        """Mean time of each key, NaN for keys without times.
+
+        :return: Means.
+        :rtype: numpy.array
+        """
+        mean = np.full(len(self), np.nan)
+        np.divide(self.total, self.count, out=mean, where=self.count > 0)
+        return mean
+
+    def std(self):
+        """Population standard deviation of each key, NaN for keys without times.
+
+        :return: Standard deviations.
+        :rtype: numpy.array
+        """
+        mean_squares = np.full(len(self), np.nan)
+        np.divide(self.squares, self.count, out=mean_squares, where=self.count > 0)
+        return np.sqrt(np.maximum(mean_squares - self.mean() ** 2, 0))
+
+    def quantile(self, q):
+        """Estimated quantile of each key, bounded by its min and max times. As pandas does, quantile is linearly
+        interpolated between the times of the two closest ranks.
+
+        :param q: Quantile (0-1).
+        :type q: float
+        :return: Quantiles, NaN for keys without times.
+        :rtype: numpy.array
+        """
+        rank = q * np.maximum(self.count - 1, 0)
+        lower_rank = np.floor(rank)
+        cumulative = np.cumsum(self.buckets, axis=1, dtype=np.int64)
+
+        values = []
+        for r in (lower_rank, np.minimum(lower_rank + 1, np.maximum(self.count - 1, 0))):
+            buckets = np.minimum((cumulative <= r[:, np.newaxis]).sum(axis=1), self.buckets.shape[1] - 1)
+            values.append(np.clip(self._values[buckets], self.minimum, self.maximum))
+
+        # Keys without times have infinite bounds
+        with np.errstate(invalid='ignore'):
+            quantile = values[0] + (rank - lower_rank) * (values[1] - values[0])
+        quantile[self.count == 0] = np.nan
+        return quantile
+
+    def to_frame(self, index=None, percentiles=(0.9, 0.95, 0.99)):
+        """Build a DataFrame with count, mean, standard deviation, max, min, sum, median and percentiles of each key.
+
+        :param index: DataFrame index.
+        :param percentiles: Percentiles (0-1).
+        :type percentiles: iter
+        :return: Stats.
+        :rtype: pandas.DataFrame
+        """
+        has_times = self.count > 0
+        frame = pd.DataFrame({
+            'Count': self.count,
+            'Mean': self.mean(),
+            'Std': self.std(),
+            'Max': np.where(has_times, self.maximum, np.nan),
+            'Min': np.where(has_times, self.minimum, np.nan),
+            'Sum': self.total,
+            'Median': self.quantile(0.5),
+        }, index=index, columns=['Count', 'Mean', 'Std', 'Max', 'Min', 'Sum', 'Median'])
+        for q in percentiles:
+            frame['P{:g}'.format(q * 100)] = self.quantile(q)
+
+        return frame
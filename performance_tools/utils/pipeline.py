@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+
+class _Failure(object):
+    """Exception raised by a producer, wrapped to be sent through the queue.
+    """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch(iterables, queue_size=8, workers=None):
+    """Consume iterables in background threads and yield their items as soon as they are available. Items are sent
+    through a bounded queue, so producers are blocked while consumer is busy and memory stays flat. Order of items is
+    kept within each iterable. Exceptions raised by producers are raised again by the consumer.
+
+    :param iterables: Iterables to consume.
+    :type iterables: list
+    :param queue_size: Maximum number of items waiting to be consumed.
+    :type queue_size: int
+    :param workers: Number of threads, defaults to one per iterable.
+    :type workers: int
+    :return: Items generator.
+    :rtype: generator
+    """
+    items = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Give up if consumer has stopped, to not block forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def produce(iterable):
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                put(item)
+        except Exception as e:
+            put(_Failure(e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        put(finished)
+
+    pool = ThreadPool(workers or len(iterables))
+    pool.map_async(produce, iterables, chunksize=1)
+    pool.close()
+
+    try:
+        pending = len(iterables)
+        while pending:
+            item = items.get()
+            if item is finished:
+                pending -= 1
+            elif isinstance(item, _Failure):
+                raise item.exception
+            else:
+                yield item
+    finally:
+        stop.set()
+        pool.join()
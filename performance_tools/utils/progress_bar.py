@@ -38,8 +38,8 @@ def create_progress_bar(max_value, label='', item_name=''):
 
         widgets = [label, ': ', Percentage(), ' ', Bar(marker='#', left='[', right=']'), ' ',
                    SimpleProgress(), ' ', item_name, ' ', AdaptiveETA()]
-        bar_obj = ProgressBar(widgets=widgets, maxval=max_value)
-        progressbar = bar_obj((i for i in range(max_value))).start()
+        # Progress is always given by update, so the bar doesn't wrap any iterable of max_value items
+        progressbar = ProgressBar(widgets=widgets, maxval=max_value).start()
     except Exception as e:
         raise ProgressBarException(str(e))
 
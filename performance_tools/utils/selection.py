@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Exact order statistics and moments of arrays that may not fit in memory, like memory-mapped arrays or lists of
+chunks. Data is read chunk by chunk in a few passes, and only values close to the selected ones are kept.
+"""
+
+from __future__ import unicode_literals, division
+
+import numpy as np
+
+# Default number of values read at once
+CHUNK_SIZE = 1 << 22
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """Iterate over data in chunks of double precision values, skipping missing values. Memory-mapped arrays are only
+    read one chunk at a time.
+
+    :param data: Array, memory-mapped array or list of arrays.
+    :type data: numpy.array or list
+    :param chunk_size: Number of values of each chunk.
+    :type chunk_size: int
+    :return: Chunks.
+    :rtype: generator
+    """
+    sources = data if isinstance(data, (list, tuple)) else [data]
+    for source in sources:
+        source = np.asarray(source).reshape(-1)
+        for start in range(0, len(source), chunk_size):
+            chunk = np.asarray(source[start:start + chunk_size], dtype=np.float64)
+            missing = np.isnan(chunk)
+            yield chunk[~missing] if missing.any() else chunk
+
+
+def summary(data, chunk_size=CHUNK_SIZE):
+    """Count, min and max of data.
+
+    :param data: Array, memory-mapped array or list of arrays.
+    :type data: numpy.array or list
+    :param chunk_size: Number of values of each chunk.
+    :type chunk_size: int
+    :return: Count, min and max, that are NaN if data is empty.
+    :rtype: tuple
+    """
+    count, minimum, maximum = 0, np.inf, -np.inf
+    for chunk in iter_chunks(data, chunk_size):
+        if len(chunk):
+            count += len(chunk)
+            minimum = min(minimum, chunk.min())
+            maximum = max(maximum, chunk.max())
+
+    if not count:
+        return 0, np.nan, np.nan
+
+    return count, minimum, maximum
+
+
+class _Window(object):
+    """Values of data that fall in a chain of histogram bins, with the ranks selected among them. Bins are computed
+    with a monotonic function of values, so bins keep the order of values.
+    """
+
+    def __init__(self, levels, lower, upper, count, ranks, bins, max_candidates):
+        self.levels = levels
+        self.lower = lower
+        self.upper = upper
+        self.count = count
+        self.ranks = ranks
+        self.bins = bins
+        self.collect = count <= max_candidates
+        self.reset()
+
+    def reset(self):
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.values = []
+        self.histogram = np.zeros(self.bins, dtype=np.int64)
+
+    def _bin(self, values, lower, upper):
+        if upper <= lower:
+            # Bin narrower than float resolution
+            return np.zeros(len(values), dtype=np.int64)
+
+        scale = self.bins / (upper - lower)
+        return np.clip(((values - lower) * scale).astype(np.int64), 0, self.bins - 1)
+
+    def members(self, chunk, bins_cache):
+        for (i, (lower, upper, selected)) in enumerate(self.levels):
+            if i == 0:
+                # Windows split from the same one share the bins of the first level
+                key = (lower, upper)
+                if key not in bins_cache:
+                    bins_cache[key] = self._bin(chunk, lower, upper)
+                chunk = chunk[bins_cache[key] == selected]
+            else:
+                chunk = chunk[self._bin(chunk, lower, upper) == selected]
+        return chunk
+
+    def update(self, chunk, bins_cache):
+        members = self.members(chunk, bins_cache)
+        if not len(members):
+            return
+
+        self.minimum = min(self.minimum, members.min())
+        self.maximum = max(self.maximum, members.max())
+        if self.collect:
+            self.values.append(members)
+        else:
+            self.histogram += np.bincount(self._bin(members, self.lower, self.upper), minlength=self.bins)
+
+    def split(self, max_candidates):
+        """Resolve the ranks of this window, or split them into windows of narrower bins.
+
+        :return: Resolved values by position and new windows.
+        :rtype: tuple
+        """
+        if self.minimum == self.maximum:
+            return {position: self.minimum for position in self.ranks}, []
+
+        if self.collect:
+            values = np.partition(np.concatenate(self.values), sorted(set(self.ranks.values())))
+            return {position: values[rank] for (position, rank) in self.ranks.items()}, []
+
+        if self.histogram.max() == self.count:
+            # All values fell in a single bin, so histogram is rebuilt between actual min and max
+            self.lower, self.upper = self.minimum, self.maximum
+            self.reset()
+            return {}, [self]
+
+        cumulative = np.cumsum(self.histogram)
+        width = (self.upper - self.lower) / self.bins
+        children = {}
+        for (position, rank) in self.ranks.items():
+            selected = int(np.searchsorted(cumulative, rank, side='right'))
+            below = cumulative[selected] - self.histogram[selected]
+            if selected not in children:
+                children[selected] = _Window(self.levels + [(self.lower, self.upper, selected)],
+                                             self.lower + selected * width, self.lower + (selected + 1) * width,
+                                             self.histogram[selected], {}, self.bins, max_candidates)
+            children[selected].ranks[position] = rank - below
+
+        return {}, list(children.values())
+
+
+def select(data, positions, bounds=None, chunk_size=CHUNK_SIZE, bins=4096, max_candidates=1 << 20):
+    """Get the values at given positions of sorted data, as numpy.partition does, without sorting nor copying data.
+
+    Each pass over data builds a histogram of the values close to each position, and the bin that contains the
+    position is refined in the next pass, until there are few enough values to be kept in memory or all of them are
+    equal.
+
+    :param data: Array, memory-mapped array or list of arrays.
+    :type data: numpy.array or list
+    :param positions: Positions in sorted data.
+    :type positions: iter
+    :param bounds: Count, min and max of data, if already known.
+    :type bounds: tuple
+    :param chunk_size: Number of values of each chunk.
+    :type chunk_size: int
+    :param bins: Number of histogram bins.
+    :type bins: int
+    :param max_candidates: Maximum number of values kept in memory for each window.
+    :type max_candidates: int
+    :return: Value at each position.
+    :rtype: list
+    """
+    count, minimum, maximum = bounds if bounds is not None else summary(data, chunk_size)
+    positions = [int(p) for p in positions]
+    if any(p < 0 or p >= count for p in positions):
+        raise IndexError("Positions out of range of data with {:d} values".format(count))
+
+    if minimum == maximum:
+        return [minimum] * len(positions)
+
+    windows = [_Window([], minimum, maximum, count, {p: p for p in positions}, bins, max_candidates)]
+    results = {}
+    while windows:
+        for chunk in iter_chunks(data, chunk_size):
+            bins_cache = {}
+            for window in windows:
+                window.update(chunk, bins_cache)
+
+        pending = []
+        for window in windows:
+            resolved, children = window.split(max_candidates)
+            results.update(resolved)
+            pending.extend(children)
+        windows = pending
+
+    return [results[p] for p in positions]
+
+
+def _merge_moments(a, b):
+    """Merge count, mean and sum of squared deviations of two sets of values.
+    """
+    count = a[0] + b[0]
+    if not count:
+        return a
+
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / count
+    return count, mean, a[2] + b[2] + delta ** 2 * a[0] * b[0] / count
+
+
+def trimmed_moments(data, trim, lower, upper, count, chunk_size=CHUNK_SIZE):
+    """Calculate count, mean and standard deviation of data without its lowest and highest values, in a single pass.
+    Values equal to the cut points are kept as many times as their positions between trimmed ones.
+
+    :param data: Array, memory-mapped array or list of arrays.
+    :type data: numpy.array or list
+    :param trim: Number of values removed from each tail.
+    :type trim: int
+    :param lower: Lowest kept value, at position trim of sorted data.
+    :type lower: float
+    :param upper: Highest kept value, at position count - trim - 1 of sorted data.
+    :type upper: float
+    :param count: Number of values of data.
+    :type count: int
+    :param chunk_size: Number of values of each chunk.
+    :type chunk_size: int
+    :return: Count, mean and standard deviation of kept values.
+    :rtype: tuple
+    """
+    moments = (0, 0., 0.)
+    not_above_lower = below_upper = 0
+    for chunk in iter_chunks(data, chunk_size):
+        inner = chunk[(chunk > lower) & (chunk < upper)]
+        if len(inner):
+            mean = inner.mean()
+            moments = _merge_moments(moments, (len(inner), mean, ((inner - mean) ** 2).sum()))
+        not_above_lower += np.count_nonzero(chunk <= lower)
+        below_upper += np.count_nonzero(chunk < upper)
+
+    if lower == upper:
+        moments = (count - 2 * trim, lower, 0.)
+    else:
+        moments = _merge_moments(moments, (not_above_lower - trim, lower, 0.))
+        moments = _merge_moments(moments, (count - trim - below_upper, upper, 0.))
+
+    return moments[0], moments[1], np.sqrt(moments[2] / moments[0])
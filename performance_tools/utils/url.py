@@ -2,21 +2,325 @@
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 import re
-import urlparse
+import threading
+
+import numpy as np
+import pandas as pd
+
+from performance_tools.exceptions import URLException
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
 
 REGEX_ID = r'/[-0-9a-fA-F,_]*[-0-9,_]+[-0-9a-fA-F,_]*'
 
+# Route templates parameters: <converter:name> or <name>
+TEMPLATE_PARAMETER = re.compile(r'<(?:(?P<converter>[^>:]+):)?(?P<name>\w+)>')
 
-def normalize_url(url, regex=REGEX_ID):
+CONVERTERS = {
+    'int': r'[0-9]+',
+    'slug': r'[-a-zA-Z0-9_]+',
+    'str': r'[^/]+',
+    'uuid': r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+    'path': r'.+',
+}
+
+
+class _RouteNode(object):
+    """Node of a route table trie, that represents a path segment.
+    """
+    __slots__ = ('literals', 'parameters', 'path', 'route')
+
+    def __init__(self):
+        self.literals = {}
+        self.parameters = []
+        self.path = None
+        self.route = None
+
+
+class RouteTable(object):
+    """Map URL paths to the route templates that serve them, like Django URL patterns: '/blog/<slug:post>/',
+    '/api/<str:version>/users/<int:pk>/' or '/files/<path:name>'. Available converters are int, slug, str, uuid and
+    path, being str the default one.
+
+    Templates are compiled into a trie of path segments, so matching time depends on the path length and not on the
+    number of routes. Literal segments have priority over parameters, and parameters are tried in registration
+    order. Paths that don't match any route are normalized with a fallback regular expression.
+
+    Version is incremented each time a route is added, so normalizers can discard URLs cached with previous routes.
+    """
+
+    def __init__(self, routes=(), fallback=REGEX_ID):
+        """Route table init method.
+
+        :param routes: Route templates or (template, name) pairs.
+        :type routes: list
+        :param fallback: Regular expression to normalize id's in paths that don't match any route.
+        :type fallback: str or re
+        """
+        self._root = _RouteNode()
+        self._size = 0
+        self.fallback = fallback
+        self.version = 0
+
+        for route in routes:
+            if isinstance(route, (list, tuple)):
+                self.add(*route)
+            else:
+                self.add(route)
+
+    @staticmethod
+    def _segments(path):
+        return [segment for segment in path.split('/') if segment]
+
+    @staticmethod
+    def _segment_regex(segment):
+        """Build the regular expression of a template segment with parameters, e.g: 'v<int:version>'.
+        """
+        pattern = []
+        position = 0
+        for parameter in TEMPLATE_PARAMETER.finditer(segment):
+            converter = parameter.group('converter') or 'str'
+            if converter not in CONVERTERS or converter == 'path':
+                raise URLException("Invalid converter '{}' in segment '{}'".format(converter, segment))
+
+            pattern.append(re.escape(segment[position:parameter.start()]))
+            pattern.append('(?:{})'.format(CONVERTERS[converter]))
+            position = parameter.end()
+        pattern.append(re.escape(segment[position:]))
+        pattern.append(r'\Z')
+
+        return ''.join(pattern)
+
+    def add(self, template, name=None):
+        """Register a route template. First registered template wins if two of them are equivalent.
+
+        :param template: Route template, e.g: '/api/<str:version>/users/<int:pk>/'.
+        :type template: str
+        :param name: Value returned for paths matching this route, defaults to the template without trailing slash.
+        :type name: str
+        """
+        segments = self._segments(template)
+        node = self._root
+        for segment in segments:
+            parameter = TEMPLATE_PARAMETER.search(segment)
+            if parameter is None:
+                node = node.literals.setdefault(segment, _RouteNode())
+            elif parameter.group('converter') == 'path' and parameter.group(0) == segment:
+                node.path = node.path or _RouteNode()
+                node = node.path
+            else:
+                pattern = self._segment_regex(segment)
+                child = next((c for r, c in node.parameters if r.pattern == pattern), None)
+                if child is None:
+                    child = _RouteNode()
+                    node.parameters.append((re.compile(pattern), child))
+                node = child
+
+        if node.route is None:
+            node.route = name or '/' + '/'.join(segments)
+            self._size += 1
+            self.version += 1
+
+    def _match(self, node, segments, position):
+        if position == len(segments):
+            return node.route
+
+        segment = segments[position]
+        child = node.literals.get(segment)
+        if child is not None:
+            route = self._match(child, segments, position + 1)
+            if route is not None:
+                return route
+
+        for regex, child in node.parameters:
+            if regex.match(segment):
+                route = self._match(child, segments, position + 1)
+                if route is not None:
+                    return route
+
+        if node.path is not None:
+            # Path parameter consumes one or more segments, shortest first to give priority to following literals
+            for end in range(position + 1, len(segments) + 1):
+                route = self._match(node.path, segments, end)
+                if route is not None:
+                    return route
+
+        return None
+
+    def match(self, path):
+        """Get the route of a path.
+
+        :param path: URL path.
+        :type path: str
+        :return: Route name or template, None if path doesn't match any route.
+        :rtype: str
+        """
+        return self._match(self._root, self._segments(path), 0)
+
+    def __len__(self):
+        return self._size
+
+
+class URLNormalizer(object):
+    """Normalize URLs replacing id's in their paths, or mapping them to their routes. Pattern is compiled once and
+    normalized URLs are kept in a bounded LRU cache, because the same URLs are repeated a lot in real traffic.
+    """
+
+    def __init__(self, regex=REGEX_ID, maxsize=100000):
+        """URL normalizer init method.
+
+        :param regex: Regular expression to normalize id's in URL, or a route table to map URLs to their routes.
+        :type regex: str or re or RouteTable
+        :param maxsize: Maximum number of cached URLs.
+        :type maxsize: int
+        """
+        if isinstance(regex, RouteTable):
+            self._routes = regex
+            self._routes_version = regex.version
+            regex = regex.fallback
+        else:
+            self._routes = None
+            self._routes_version = None
+            regex = regex if regex is not None else REGEX_ID
+
+        self._regex = re.compile(regex) if regex is not None else None
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _normalize(self, url):
+        try:
+            scheme, netloc, path, query, fragment = urlsplit(url)
+            route = self._routes.match(path) if self._routes is not None else None
+            if route is not None:
+                return route
+
+            if self._regex is not None:
+                path = self._regex.sub("/ID", path)
+            path = path.rstrip("/")
+        except (TypeError, AttributeError):
+            path = None
+
+        return path
+
+    def normalize(self, url):
+        """Normalize an URL.
+
+        :param url: URL.
+        :type url: str
+        :return: Normalized URL path.
+        :rtype: str
+        """
+        with self._lock:
+            version = self._routes.version if self._routes is not None else None
+            if version != self._routes_version:
+                # Routes were added, so cached URLs can be stale
+                self._cache.clear()
+                self._routes_version = version
+
+            try:
+                path = self._cache.pop(url)
+                self._cache[url] = path
+                self.hits += 1
+                return path
+            except KeyError:
+                self.misses += 1
+            except TypeError:
+                # Unhashable URL
+                return None
+
+        path = self._normalize(url)
+
+        with self._lock:
+            if version == self._routes_version:
+                self._cache[url] = path
+                if len(self._cache) > self._maxsize:
+                    self._cache.popitem(last=False)
+
+        return path
+
+    __call__ = normalize
+
+    def normalize_many(self, urls):
+        """Normalize a batch of URLs. Each distinct URL is normalized only once.
+
+        :param urls: URLs.
+        :type urls: list or pandas.Series
+        :return: Normalized URL paths, with the same type as input.
+        :rtype: list or pandas.Series
+        """
+        if isinstance(urls, pd.Series):
+            codes, uniques = pd.factorize(urls)
+            paths = np.array([self.normalize(url) for url in uniques] + [None], dtype=object)
+            # Missing values have code -1, so they are mapped to the trailing None
+            return pd.Series(paths[codes], index=urls.index, name=urls.name, dtype=object)
+
+        paths = {url: self.normalize(url) for url in set(urls)}
+        return [paths[url] for url in urls]
+
+    def clear(self):
+        """Clear cache and counters.
+        """
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+
+# Maximum number of shared normalizers, least recently used ones are discarded
+MAX_NORMALIZERS = 16
+
+_normalizers = OrderedDict()
+_normalizers_lock = threading.Lock()
+
+
+def get_normalizer(regex=None):
+    """Get the shared normalizer of a regular expression. Only the most recently used normalizers are kept, so
+    regular expressions and route tables aren't kept alive forever.
+
+    :param regex: Regular expression to normalize id's in URL or route table.
+    :type regex: str or re or RouteTable
+    :return: URL normalizer.
+    :rtype: URLNormalizer
+    """
     if regex is None:
         regex = REGEX_ID
 
-    try:
-        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
-        path = re.sub(regex, "/ID", path)
-        path = path.rstrip("/")
-    except TypeError:
-        path = None
+    with _normalizers_lock:
+        try:
+            normalizer = _normalizers.pop(regex)
+        except KeyError:
+            normalizer = URLNormalizer(regex)
+            if len(_normalizers) >= MAX_NORMALIZERS:
+                _normalizers.popitem(last=False)
+
+        _normalizers[regex] = normalizer
+
+    return normalizer
+
+
+def normalize_url(url, regex=REGEX_ID):
+    return get_normalizer(regex).normalize(url)
+
+
+def normalize_urls(urls, regex=REGEX_ID):
+    """Normalize a batch of URLs. Each distinct URL is normalized only once.
 
-    return path
\ No newline at end of file
+    :param urls: URLs.
+    :type urls: list or pandas.Series
+    :param regex: Regular expression to normalize id's in URL or route table.
+    :type regex: str or re or RouteTable
+    :return: Normalized URL paths, with the same type as input.
+    :rtype: list or pandas.Series
+    """
+    return get_normalizer(regex).normalize_many(urls)
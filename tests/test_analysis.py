@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from performance_tools.urls_flow.analysis import RequestAnalyzer, ShardedRequestAnalyzer
+
+HEADER = 'Timestamp,Referrer,Request,Time\n'
+
+
+class ShardedRequestAnalyzerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _input_file(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return filename
+
+    def test_inputs_without_rows(self):
+        input_files = [self._input_file('empty.csv', ''), self._input_file('header.csv', HEADER)]
+        analyzer = ShardedRequestAnalyzer(input_files, workers=1, shards=2)
+        expected = RequestAnalyzer(input_files[1])
+
+        for (stats, expected_stats) in ((analyzer.stats_by_request(), expected.stats_by_request()),
+                                        (analyzer.stats_by_request_and_referrer(),
+                                         expected.stats_by_request_and_referrer())):
+            self.assertEqual(len(stats), 0)
+            self.assertEqual(stats.columns.tolist(), expected_stats.columns.tolist())
+
+        self.assertEqual(analyzer.stats_by_request().index.names, ['Request'])
+        self.assertEqual(analyzer.stats_by_request_and_referrer().index.names, ['Request', 'Referrer'])
+        self.assertEqual(analyzer.number_of_requests(), 0)
+        self.assertEqual(len(analyzer.latency_histograms()[0]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+from performance_tools.urls_flow.analysis import RequestAnalyzer, StreamingRequestAnalyzer
+from performance_tools.utils.columnar import parse_timestamps, read_csv
+
+# Timestamps with and without milliseconds and with an offset, as mixed in Elasticsearch and nginx logs
+MIXED_TIMESTAMPS = ['2015-05-14T10:00:00Z', '2015-05-14T10:00:00.123Z', '2015-05-14T10:00:00+02:00']
+MIXED_MILLISECONDS = [1431597600000, 1431597600123, 1431590400000]
+
+NAT = np.iinfo(np.int64).min
+
+
+def _csv(timestamps):
+    lines = ['Timestamp,Referrer,Request,Time']
+    lines.extend('{},/referrer/,/request/{:d}/,0.5'.format(t, i) for (i, t) in enumerate(timestamps))
+    return '\n'.join(lines) + '\n'
+
+
+class ParseTimestampsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.directory, 'flow.csv')
+        with io.open(self.input_file, 'w', encoding='utf-8') as f:
+            f.write(_csv(MIXED_TIMESTAMPS))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_mixed_precision_and_offsets(self):
+        np.testing.assert_array_equal(parse_timestamps(MIXED_TIMESTAMPS), MIXED_MILLISECONDS)
+
+    def test_missing_timestamps_are_nat(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            timestamps = parse_timestamps([None, '', MIXED_TIMESTAMPS[1]])
+
+        np.testing.assert_array_equal(timestamps, [NAT, NAT, MIXED_MILLISECONDS[1]])
+        self.assertEqual(caught, [])
+
+    def test_invalid_timestamps_warn(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            timestamps = parse_timestamps([MIXED_TIMESTAMPS[0], 'yesterday'])
+
+        np.testing.assert_array_equal(timestamps, [MIXED_MILLISECONDS[0], NAT])
+        self.assertEqual(len(caught), 1)
+        self.assertIn('yesterday', str(caught[0].message))
+
+    def test_chunked_csv(self):
+        data = read_csv(self.input_file, chunksize=2)
+        np.testing.assert_array_equal(data['Timestamp'].values.astype(np.int64), MIXED_MILLISECONDS)
+
+    def test_analyzers_timeline(self):
+        analyzer = RequestAnalyzer(self.input_file, noise=0)
+        np.testing.assert_array_equal(analyzer.timeline().index.values.astype(np.int64), sorted(MIXED_MILLISECONDS))
+
+        streaming = StreamingRequestAnalyzer()
+        streaming.update([(t, '/referrer/', '/request/', 0.5) for t in MIXED_TIMESTAMPS])
+        self.assertEqual((streaming._first, streaming._last), (min(MIXED_MILLISECONDS), max(MIXED_MILLISECONDS)))
+
+
+class FileObjectTestCase(unittest.TestCase):
+    def _analyzer(self, **kwargs):
+        return RequestAnalyzer(io.StringIO(_csv(MIXED_TIMESTAMPS)), noise=0, **kwargs)
+
+    def test_file_objects_are_read_as_csv(self):
+        for kwargs in ({}, {'chunksize': 2}, {'cache': True}):
+            analyzer = self._analyzer(**kwargs)
+            self.assertEqual(analyzer.number_of_requests(), 3)
+            self.assertEqual(analyzer.stats_by_request().index.tolist(),
+                             ['/request/0/', '/request/1/', '/request/2/'])
+
+    def test_unused_columns_of_file_objects_are_dropped(self):
+        csv = _csv(MIXED_TIMESTAMPS).replace('Time\n', 'Time,Status\n', 1).replace('0.5\n', '0.5,200\n')
+        data = read_csv(io.StringIO(csv), chunksize=2)
+
+        self.assertEqual(data.columns.tolist(), ['Timestamp', 'Referrer', 'Request', 'Time'])
+        np.testing.assert_array_equal(data['Timestamp'].values.astype(np.int64), MIXED_MILLISECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import copy
+import io
+import json
+import os
+import threading
+import unittest
+import warnings
+
+import numpy as np
+
+from performance_tools.exceptions import ElasticsearchException
+from performance_tools.urls_flow.analysis import AggregatedRequestAnalyzer
+from performance_tools.urls_flow.backends.elasticsearch import ElasticURLFlowBackend
+
+# Aggregations of 8 hits of /users/1/, /users/2/ and /home/ in June 1st and 2nd, recorded from an Elasticsearch 1.x
+# aggregation search
+AGGREGATIONS_FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'elasticsearch_aggregations.json')
+
+
+def _hit(n):
+    minute = n % (24 * 60)
+    return {
+        '@timestamp': '2015-06-0{:d}T{:02d}:{:02d}:00.000Z'.format(1 + n % 7, minute // 60, minute % 60),
+        'referrer': '"/referrer/{:d}/"'.format(n % 5),
+        'request': '/request/{:d}/'.format(n % 11),
+        'time_response': n / 1000.,
+    }
+
+
+class FakeScrollClient(object):
+    """Stand-in Elasticsearch client that scrolls documents matching the timestamp range of search bodies, and keeps
+    track of opened and cleared scroll contexts.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.bodies = []
+        self.scrolls = {}
+        self.cleared = []
+        self._lock = threading.Lock()
+
+    def _match(self, body):
+        timestamp_range = body['query']['filtered']['filter']['and'][1]['range']['@timestamp']
+        return [d for d in self.documents if d['@timestamp'] >= timestamp_range['gte'] and
+                ('lt' not in timestamp_range or d['@timestamp'] < timestamp_range['lt']) and
+                ('lte' not in timestamp_range or d['@timestamp'] <= timestamp_range['lte'])]
+
+    def count(self, index, doc_type, body):
+        return {'count': len(self._match(body))}
+
+    def search(self, index, doc_type, body, size, fields, _source, search_type, scroll, timeout):
+        documents = self._match(body)
+        with self._lock:
+            self.bodies.append(body)
+            scroll_id = 'scroll-{:d}'.format(len(self.scrolls))
+            self.scrolls[scroll_id] = [documents[i:i + size] for i in range(0, len(documents), size)]
+
+        # Scan searches don't return hits in their first result
+        return {'_scroll_id': scroll_id, 'hits': {'total': len(documents), 'hits': []}}
+
+    def scroll(self, scroll, scroll_id):
+        pages = self.scrolls[scroll_id]
+        page = pages.pop(0) if pages else []
+        return {
+            '_scroll_id': scroll_id,
+            'hits': {'hits': [{'fields': {k: [v] for (k, v) in d.items()}} for d in page]},
+        }
+
+    def clear_scroll(self, scroll_id):
+        with self._lock:
+            self.cleared.append(scroll_id)
+
+
+class SlicedExtractionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.documents = [_hit(n) for n in range(2000)]
+
+    def _backend(self, slices=1, workers=None, date_from='2015-06-01', date_to='2015-06-07T23:59:59Z'):
+        backend = ElasticURLFlowBackend(date_from=date_from, date_to=date_to, size=37, slices=slices, workers=workers)
+        backend._backend = FakeScrollClient(self.documents)
+        return backend
+
+    def _rows(self, backend):
+        return sorted(row for result in backend for row in backend.extract_url_from_result(result))
+
+    def test_slices_are_disjoint_and_cover_dates(self):
+        bodies = self._backend(slices=4)._sliced_bodies()
+        ranges = [b['query']['filtered']['filter']['and'][1]['range']['@timestamp'] for b in bodies]
+
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0]['gte'], '2015-06-01T00:00:00.000Z')
+        self.assertEqual(ranges[-1]['lte'], '2015-06-07T23:59:59Z')
+        for (previous, current) in zip(ranges[:-1], ranges[1:]):
+            self.assertNotIn('lte', previous)
+            self.assertEqual(previous['lt'], current['gte'])
+            self.assertLess(previous['gte'], previous['lt'])
+
+    def test_sliced_extraction_returns_each_hit_once(self):
+        serial = self._backend()
+        expected = self._rows(serial)
+
+        for (slices, workers) in ((2, None), (4, 2), (7, 7)):
+            backend = self._backend(slices, workers)
+            self.assertEqual(self._rows(backend), expected)
+            self.assertEqual(backend._total_hits, len(self.documents))
+            self.assertEqual(len(backend._backend.bodies), slices)
+
+        self.assertEqual(len(expected), len(self.documents))
+
+    def test_scroll_contexts_are_cleared(self):
+        backend = self._backend(slices=4, workers=2)
+        self._rows(backend)
+
+        client = backend._backend
+        self.assertEqual(sorted(client.cleared), sorted(client.scrolls))
+
+    def test_scroll_contexts_are_cleared_when_stopped(self):
+        backend = self._backend(slices=4, workers=2)
+        results = iter(backend)
+        next(results)
+        results.close()
+
+        client = backend._backend
+        self.assertEqual(sorted(client.cleared), sorted(client.scrolls))
+
+    def test_sliced_extraction_needs_dates(self):
+        backend = self._backend(slices=2, date_from='', date_to='')
+        self.assertRaises(ElasticsearchException, backend._sliced_bodies)
+
+
+class FakeAggregationClient(object):
+    """Stand-in Elasticsearch client that returns a recorded aggregation result, and keeps track of search bodies.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.bodies = []
+
+    def search(self, index, doc_type, body, size, timeout):
+        self.bodies.append(body)
+        return copy.deepcopy(self.result)
+
+
+class AggregationTestCase(unittest.TestCase):
+    def setUp(self):
+        with io.open(AGGREGATIONS_FIXTURE, encoding='utf-8') as f:
+            self.result = json.load(f)
+
+    def _backend(self, result=None, **fields):
+        backend = ElasticURLFlowBackend(date_from='2015-06-01', date_to='2015-06-02T23:59:59Z', **fields)
+        backend._backend = FakeAggregationClient(result or self.result)
+        return backend
+
+    def _analyzer(self, result=None, strict=False):
+        return AggregatedRequestAnalyzer(self._backend(result).aggregate(), regex=r'/(\d+)/', strict=strict)
+
+    def test_aggregation_body_uses_fields_and_sizes(self):
+        backend = self._backend(request_field='request.raw', referrer_field='referrer.raw', time_field='latency',
+                                timestamp_field='timestamp')
+        backend.aggregate(size=100, referrers_size=5)
+        body, = backend._backend.bodies
+
+        requests = body['aggs']['requests']
+        referrers = requests['aggs']['referrers']
+        self.assertEqual(requests['terms'], {'field': 'request.raw', 'size': 100})
+        self.assertEqual(referrers['terms'], {'field': 'referrer.raw', 'size': 5})
+        self.assertEqual(referrers['aggs']['latency']['range']['field'], 'latency')
+        self.assertEqual(requests['aggs']['time']['extended_stats']['field'], 'latency')
+        self.assertEqual(body['aggs']['histogram']['date_histogram']['field'], 'timestamp')
+        self.assertIn('timestamp', body['query']['filtered']['filter']['and'][1]['range'])
+        self.assertEqual(backend._total_hits, 8)
+
+    def test_hits_are_extracted_from_fields(self):
+        backend = self._backend(request_field='request.raw', referrer_field='referrer.raw')
+        document = dict(_hit(3), **{'request.raw': '/users/1/', 'referrer.raw': '"/home/"'})
+        result = {'hits': {'hits': [{'fields': {k: [v] for (k, v) in document.items()}}]}}
+
+        self.assertEqual(backend.extract_url_from_result(result, r'/(\d+)/'),
+                         [('2015-06-04T00:03:00.000Z', '/home', '/users/ID', 0.003)])
+
+    def test_stats_merge_normalized_requests(self):
+        analyzer = self._analyzer()
+        stats = analyzer.stats_by_request()
+
+        self.assertEqual(analyzer.number_of_requests(), 8)
+        self.assertEqual(analyzer.missing_hits(), (0, 0))
+        self.assertEqual(stats.index.tolist(), ['/home', '/users/ID'])
+        self.assertEqual(stats['Count By Week'].tolist(), [4, 4])
+        np.testing.assert_allclose(stats['Sum'], [2.75, 1.2])
+        np.testing.assert_allclose(stats['Min'], [0.05, 0.1])
+        np.testing.assert_allclose(stats['Max'], [2.5, 0.6])
+        np.testing.assert_allclose(stats['Count By Day'], 4 / analyzer.number_of_days())
+
+        pairs = analyzer.stats_by_request_and_referrer()
+        self.assertEqual(pairs.index.tolist(), [('/home', '-'), ('/users/ID', '-'), ('/users/ID', '/home')])
+        self.assertEqual(pairs['Count By Week'].tolist(), [4, 1, 3])
+        np.testing.assert_allclose(pairs['Mean'], [0.6875, 0.6, 0.2])
+
+    def test_digraph_arcs(self):
+        analyzer = self._analyzer()
+        origins, destinations, weights, latency = analyzer.arcs()
+
+        # One arc of each bucket, merged by the digraph
+        self.assertEqual(list(zip(origins, destinations, weights)),
+                         [('-', '/home', 4), ('/home', '/users/ID', 2), ('-', '/users/ID', 1),
+                          ('/home', '/users/ID', 1)])
+        np.testing.assert_array_equal(latency.histogram.sum(axis=1), weights)
+
+        arcs = analyzer.digraph().arcs_latency()
+        self.assertEqual(arcs['Count'].to_dict(), {('-', '/home'): 4, ('-', '/users/ID'): 1, ('/home', '/users/ID'): 3})
+
+    def test_time_series(self):
+        series = self._analyzer().time_series()
+
+        self.assertEqual([t.strftime('%Y-%m-%d') for t in series.index], ['2015-06-01', '2015-06-02'])
+        self.assertEqual(series['Count'].tolist(), [4, 4])
+        np.testing.assert_allclose(series['Throughput'], 4 / 86400.)
+        np.testing.assert_allclose(series['Mean'], [0.125, 0.8625])
+
+    def test_truncated_aggregations(self):
+        result = copy.deepcopy(self.result)
+        result['aggregations']['requests']['sum_other_doc_count'] = 5
+        result['aggregations']['requests']['buckets'][1]['referrers']['sum_other_doc_count'] = 2
+
+        self.assertRaises(ElasticsearchException, self._analyzer, result, strict=True)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            analyzer = self._analyzer(result)
+
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(analyzer.missing_hits(), (5, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
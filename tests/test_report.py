@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, division
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from performance_tools.report import write_report
+from performance_tools.urls_flow.analysis import RequestAnalyzer, StreamingRequestAnalyzer, ShardedRequestAnalyzer, \
+    AggregatedRequestAnalyzer
+from tests.test_elasticsearch import AGGREGATIONS_FIXTURE
+
+
+def _flow(rows=3000, seed=0):
+    random_state = np.random.RandomState(seed)
+    timestamps = pd.Timestamp('2015-06-01') + pd.to_timedelta(random_state.randint(0, 3 * 86400, rows), unit='s')
+    return pd.DataFrame({
+        'Timestamp': timestamps.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'Referrer': ['/referrer/{:d}/'.format(i) for i in random_state.randint(0, 3, rows)],
+        'Request': ['/request/{:d}/'.format(i) for i in random_state.randint(0, 5, rows)],
+        'Time': random_state.lognormal(-2, 1.5, rows),
+    }, columns=['Timestamp', 'Referrer', 'Request', 'Time'])
+
+
+class WriteReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.flow = _flow()
+        self.input_file = os.path.join(self.directory, 'flow.csv')
+        self.flow.to_csv(self.input_file, index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _assert_report(self, analyzer):
+        output = os.path.join(self.directory, type(analyzer).__name__)
+        index = write_report(output, analyzer, workers=1)
+
+        with io.open(index, encoding='utf-8') as f:
+            html = f.read()
+        histograms = sorted(os.listdir(os.path.join(output, 'histograms')))
+        requests = analyzer.stats_by_request().index
+        self.assertEqual(histograms, ['{:05d}.png'.format(i) for i in range(len(requests))])
+        for request in requests:
+            self.assertIn('<td>{}</td>'.format(request), html)
+
+    def _assert_counts(self, histograms, edges, stats):
+        self.assertEqual(histograms.shape[1], len(edges) - 1)
+        self.assertEqual(histograms.index.tolist(), stats.index.tolist())
+        np.testing.assert_array_equal(histograms.values.sum(axis=1), stats['Count By Week'].values)
+
+    def test_request_analyzer(self):
+        analyzer = RequestAnalyzer(self.input_file, noise=0)
+        self._assert_counts(*analyzer.latency_histograms(), stats=analyzer.stats_by_request())
+        self._assert_report(analyzer)
+
+    def test_streaming_analyzer(self):
+        analyzer = StreamingRequestAnalyzer()
+        analyzer.update(list(self.flow.itertuples(index=False)))
+        histograms, edges = analyzer.latency_histograms()
+        self._assert_counts(histograms, edges, analyzer.stats_by_request())
+
+        # Only times near bins edges can be counted in a neighbour bin
+        expected, _ = RequestAnalyzer(self.input_file, noise=0).latency_histograms(edges)
+        moved = np.abs(histograms.values - expected.values).sum() / 2
+        self.assertLess(moved, 0.05 * len(self.flow))
+        self.assertEqual(analyzer.number_of_requests(), len(self.flow))
+        self._assert_report(analyzer)
+
+    def test_sharded_analyzer(self):
+        analyzer = ShardedRequestAnalyzer([self.input_file], noise=0, workers=1, shards=2)
+        histograms, edges = analyzer.latency_histograms()
+
+        expected, _ = RequestAnalyzer(self.input_file, noise=0).latency_histograms(edges)
+        pd.testing.assert_frame_equal(histograms, expected)
+        self._assert_report(analyzer)
+
+    def test_aggregated_analyzer(self):
+        with io.open(AGGREGATIONS_FIXTURE, encoding='utf-8') as f:
+            analyzer = AggregatedRequestAnalyzer(json.load(f), regex=r'/(\d+)/')
+        histograms, edges = analyzer.latency_histograms()
+
+        # Open-ended first and last buckets are closed, so they can be drawn
+        self.assertTrue(np.all(np.isfinite(edges)) and edges[0] > 0)
+        self._assert_counts(histograms, edges, analyzer.stats_by_request())
+        self._assert_report(analyzer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+import pandas as pd
+
+from performance_tools.urls_flow.backends import elasticsearch, nginx
+from performance_tools.utils import url
+from performance_tools.utils.url import RouteTable, URLNormalizer, get_normalizer, normalize_url, normalize_urls
+
+URLS = ['/users/1/', 'http://example.com/users/2/?page=3', '/blog/my-post/', '/users/1/', '', '/', None,
+        '/api/v1/users/7/', '/blog/my-post/']
+
+
+class NormalizerCacheTestCase(unittest.TestCase):
+    def test_routes_added_after_caching(self):
+        routes = RouteTable(['/users/<int:pk>/'])
+        normalizer = get_normalizer(routes)
+        self.assertEqual(normalizer('/blog/my-post/'), '/blog/my-post')
+
+        routes.add('/blog/<slug:post>/')
+        self.assertEqual(normalizer('/blog/my-post/'), '/blog/<slug:post>')
+        self.assertEqual(get_normalizer(routes)('/users/1/'), '/users/<int:pk>')
+
+    def test_stale_urls_are_not_cached(self):
+        routes = RouteTable()
+        normalizer = URLNormalizer(routes)
+        normalizer('/blog/my-post/')
+
+        normalizer('/users/1/')
+
+        routes.add('/blog/<slug:post>/')
+        self.assertEqual(normalizer('/blog/my-post/'), '/blog/<slug:post>')
+        self.assertEqual(len(normalizer), 1)
+
+    def test_shared_normalizers_are_bounded(self):
+        tables = [RouteTable() for _ in range(url.MAX_NORMALIZERS + 4)]
+        normalizers = [get_normalizer(t) for t in tables]
+
+        self.assertEqual(len(url._normalizers), url.MAX_NORMALIZERS)
+        self.assertNotIn(tables[0], url._normalizers)
+        self.assertIs(get_normalizer(tables[-1]), normalizers[-1])
+
+
+class NormalizeManyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.regexes = [None, r'/(\d+)/', RouteTable(['/blog/<slug:post>/', '/api/<str:version>/users/<int:pk>/'])]
+
+    def test_lists_match_normalize_url(self):
+        for regex in self.regexes:
+            self.assertEqual(normalize_urls(URLS, regex), [normalize_url(u, regex) for u in URLS])
+
+    def test_series_match_normalize_url(self):
+        urls = pd.Series(URLS, index=range(10, 10 + len(URLS)), name='Request')
+        for regex in self.regexes:
+            paths = normalize_urls(urls, regex)
+            self.assertEqual(paths.tolist(), [normalize_url(u, regex) for u in URLS])
+            self.assertTrue(paths.index.equals(urls.index))
+            self.assertEqual(paths.name, 'Request')
+
+    def test_backends_extract_rows(self):
+        rows = [('2015-06-01T00:00:00Z', referrer, request, 0.5) for (referrer, request) in zip(URLS, URLS[::-1])]
+        hits = [{'fields': {'@timestamp': [t], 'referrer': ['"{}"'.format(f)], 'request': [q], 'time_response': [x]}}
+                for (t, f, q, x) in rows if f is not None]
+        for regex in self.regexes:
+            expected = [(t, normalize_url(f, regex) or '-', normalize_url(q, regex) or '-', x) for (t, f, q, x) in rows]
+            self.assertEqual(nginx.extract_rows(rows, regex), expected)
+            self.assertEqual(elasticsearch.extract_rows({'hits': {'hits': hits}}, regex),
+                             [row for (row, raw) in zip(expected, rows) if raw[1] is not None])
+
+
+if __name__ == '__main__':
+    unittest.main()